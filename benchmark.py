@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import multiprocessing
+from docopt import docopt
+from utility import standin
+standin.install()
+
+import pandas
+from Pegasus.DAX3 import ADAG
+from components.normalize import normalize
+from components.preprocess import preprocess
+from utility.console import Console, Notice, Progress
+from utility.parse import matrixparser
+from utility.daxwriter import StreamingADAG
+
+__version__ = "0.1"
+__doc__ = """DIPA DAX-Generation Benchmark. v{0}
+
+Builds synthetic input matrices and times each phase of DAX generation, using a
+stand-in for Pegasus.DAX3 so that no Pegasus install is required. Jobs and edges are
+those added by each phase; the writexml row reports the totals written to the DAX.
+
+Usage:
+ benchmark.py [options]
+
+Options:
+     -h --help                       Show this screen. [default: False]
+     -v --version                    Show the current version. [default: False]
+     --subjects <list>               Comma separated cohort sizes. [default: 1000,5000,10000,50000]
+     --tiers <list>                  Comma separated counts of hierarchy tiers between PROJECT and ID (0 is flat). [default: 0,2,3,4]
+     --fanout <int>                  Number of groups each hierarchy tier splits its parent group into. [default: 4]
+     --template <str>                Run with a static template: 'no', 'yes', or 'both'. [default: both]
+     --rigid <rigidcount>            Number of rigid iterations. [default: 3]
+     --affine <affinecount>          Number of affine iterations. [default: 3]
+     --diffeo <diffeocount>          Number of diffeomorphic iterations. [default: 6]
+     --stream                        Stream jobs to the DAX file as they are added (dipa.py --stream_dax). [default: False]
+     --output <path>                 Also save the results as csv. [default: None]
+""".format(__version__)
+
+def synthetic_matrix(subjects, tiers, fanout):
+    """
+    A cohort of 'subjects' rows, with 'tiers' hierarchy columns (TIER1 the coarsest).
+    Each tier splits the groups of the tier above it into 'fanout' groups.
+    """
+    ids = pandas.Series(range(subjects)).apply(lambda i: "S{0:06d}".format(i))
+    matrix = pandas.DataFrame({"ID": ids})
+    for tier in range(1, tiers+1):
+        matrix["TIER{0}".format(tier)] = (pandas.Series(range(subjects)) * (fanout ** tier) // subjects).apply(lambda g: "G{0}".format(g))
+    matrix["DWI"] = "/synthetic/" + ids + "_dwi.nii.gz"
+    matrix["MASK"] = "/synthetic/" + ids + "_dwi_mask.nii.gz"
+    matrix["BVALS"] = "/synthetic/" + ids + "_bvals.txt"
+    matrix["BVECS"] = "/synthetic/" + ids + "_bvecs.txt"
+    matrix["INDEX"] = "/synthetic/IndexFile.txt"
+    matrix["ACQPARAMS"] = "/synthetic/AcqParamsFile.txt"
+    return matrix
+
+def peak_rss_mb():
+    #ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_case(case):
+    """
+    Plans one synthetic cohort, phase by phase, in the current process.
+    Returns one result row per phase.
+    """
+    quiet = Console("Error")
+    results = []
+    state = {"jobs": 0, "edges": 0, "start": 0}
+
+    def begin():
+        state["start"] = time.time()
+
+    def end(phase, dax):
+        if dax is None:
+            jobs, edges = 0, 0
+        elif case["stream"]:
+            jobs, edges = dax.job_count, dax.edge_count
+        else:
+            jobs, edges = len(dax.jobs), len(dax.dependencies)
+        results.append({"SUBJECTS": case["subjects"], "TIERS": case["tiers"], "TEMPLATE": "yes" if case["template"] else "no", "PHASE": phase,
+                        "SECONDS": round(time.time() - state["start"], 3), "PEAK_RSS_MB": round(peak_rss_mb(), 1),
+                        "JOBS": jobs - state["jobs"], "EDGES": edges - state["edges"]})
+        state["jobs"] = jobs
+        state["edges"] = edges
+
+    matrix = synthetic_matrix(case["subjects"], case["tiers"], case["fanout"])
+    hierarchy = ["PROJECT"] + ["TIER{0}".format(tier) for tier in range(1, case["tiers"]+1)]
+    template = "/synthetic/template.nii.gz" if case["template"] else None
+
+    begin()
+    parser = matrixparser(matrix, hierarchy, name="Project", template=template)
+    end("matrixparser", None)
+    matrix = parser.matrix
+
+    handle, path = tempfile.mkstemp(suffix=".dax")
+    os.close(handle)
+    if case["stream"]:
+        dax = StreamingADAG("DIPA", path)
+    else:
+        dax = ADAG("DIPA")
+    begin()
+    preprocessing_section = preprocess(matrix, hierarchy=parser.hierarchy, name="Project")
+    dax = preprocessing_section.add_to_dax(dax, Progress(quiet, "Adding preprocessing jobs", count=20, limited=False))
+    end("preprocess", dax)
+
+    begin()
+    normalize_section = normalize(matrix, hierarchy=parser.hierarchy, name="Project", template=template,
+                                  rigid=case["rigid"], affine=case["affine"], diffeomorphic=case["diffeo"], species="HUMAN", fit_dimensions=True)
+    dax = normalize_section.add_to_dax(dax, Progress(quiet, "Adding normalize jobs", count=20, limited=False))
+    end("normalize", dax)
+
+    #Mirrors the linkage step of dipa.create_workflow
+    begin()
+    for subset_id in list(matrix["FULL"].unique()):
+        dax.depends(parent="{0}_Preprocess_Fit".format(subset_id), child=normalize_section.initial_step_ids[subset_id])
+    end("linking", dax)
+
+    begin()
+    if case["stream"]:
+        dax.close()
+    else:
+        with open(path, "w") as f:
+            dax.writeXML(f)
+    os.remove(path)
+    state["jobs"] = 0
+    state["edges"] = 0
+    end("writexml", dax)
+    return results
+
+def main():
+    arguments = docopt(__doc__, version='DIPA Benchmark v{0}'.format(__version__))
+    console = Console("Log")
+
+    template_choices = {"no": [False], "yes": [True], "both": [False, True]}
+    if arguments["--template"] not in template_choices:
+        console.log(Notice("Error", "--template must be one of {0}".format(", ".join(template_choices.keys()))))
+
+    cases = []
+    for subjects in [int(value) for value in arguments["--subjects"].split(",")]:
+        for tiers in [int(value) for value in arguments["--tiers"].split(",")]:
+            for template in template_choices[arguments["--template"]]:
+                #A static template always normalizes flat, so only run it once per cohort size.
+                if template and tiers != 0:
+                    continue
+                cases.append({"subjects": subjects, "tiers": tiers, "template": template, "fanout": int(arguments["--fanout"]), "stream": arguments["--stream"],
+                              "rigid": int(arguments["--rigid"]), "affine": int(arguments["--affine"]), "diffeo": int(arguments["--diffeo"])})
+
+    #Each case runs in a fresh process, so peak RSS is reported per case rather than per session.
+    columns = ["SUBJECTS", "TIERS", "TEMPLATE", "PHASE", "SECONDS", "PEAK_RSS_MB", "JOBS", "EDGES"]
+    row_format = "{0:>9} {1:>6} {2:>9} {3:>13} {4:>10} {5:>12} {6:>10} {7:>10}"
+    print(row_format.format(*columns))
+    rows = []
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    for case in cases:
+        for result in pool.apply(run_case, (case,)):
+            print(row_format.format(*[result[column] for column in columns]))
+            sys.stdout.flush()
+            rows.append(result)
+    pool.close()
+    pool.join()
+
+    if arguments["--output"] not in ["None", None]:
+        pandas.DataFrame(rows).to_csv(arguments["--output"], columns=columns, index=False)
+        console.log(Notice("Log", "Saved results to {0}".format(os.path.abspath(arguments["--output"]))))
+
+if __name__ == "__main__":
+    main()
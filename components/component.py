@@ -8,7 +8,7 @@ class Component(object):
     """
     Component parent class.
     """
-    def __init__(self, matrix, hierarchy=["PROJECT", "ID"], name="Project", transferflag=True):
+    def __init__(self, matrix, hierarchy=["PROJECT", "ID"], name="Project", transferflag=True, clusterer=None):
         self.name = name
         self.messages = []
         self.matrix = matrix.copy()
@@ -17,6 +17,7 @@ class Component(object):
         self.initial_steps = []
         self.final_steps = []
         self.transferflag = transferflag
+        self.clusterer = clusterer
 
     @classmethod
     def get_arg_mappings(cls):
@@ -26,6 +27,11 @@ class Component(object):
     def add_to_dax(self, dax, process):
         return dax
 
+    def __cluster__(self, job, level):
+        #Labels the job for clustering. Must be called before the job is added to the dax.
+        if self.clusterer != None:
+            self.clusterer.label(job.pegasus_job, level)
+
     def save_files(self, root):
         for filename, contents in self.files.iteritems():
             with open(root+"/"+filename, "w") as f:
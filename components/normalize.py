@@ -2,17 +2,69 @@
 from Pegasus.DAX3 import *
 import os
 import sys
+import math
 import pandas
+from collections import OrderedDict
+from utility.console import Notice
 from component import Component
 
+MEAN_ENGINES = ["dtitk", "native", "log_euclidean"]
+#Seconds a pipelined mean waits for its sources before it fails
+PIPELINE_TIMEOUT = 172800
+
 class normalize(Component):
     """
     Normalize component of DIPA.
     Uses DTI-TK to normalize subjects to an iteratively improved template, or a predefined one.
     matrix is assumed to be a pandas dataframe. "hierarchy" is a list referencing headers in the matrix.
     """
-    def __init__(self, matrix, hierarchy=["PROJECT", "ID"], name="Project", template=None, similarity_metric="NMI", species="Human", rigid=3, affine=3, diffeomorphic=6, transferflag=True):
-        Component.__init__(self, matrix, hierarchy, name, transferflag)
+    def __init__(self, matrix, hierarchy=["PROJECT", "ID"], name="Project", template=None, similarity_metric="NMI", species="Human", rigid=3, affine=3, diffeomorphic=6, transferflag=True, clusterer=None, fit_dimensions=False, mean_fanin=0, mean_engine="dtitk", pipelined_means=False, mean_quorum=100, template_tolerance=0, fused_registration=False, pyramid_factor=1, warm_diffeomorphic=False, single_affine_barrier=False, template_subset=0, template_strata=[]):
+        Component.__init__(self, matrix, hierarchy, name, transferflag, clusterer)
+        #When the fit job already writes each subject's dimensions record, no ImageDim jobs are needed for the base tier.
+        self.fit_dimensions = fit_dimensions
+        #Group means over more than mean_fanin sources are reduced through partial means (0 disables this).
+        self.mean_fanin = int(mean_fanin)
+        #Group means use DTI-TK's TVMean/VVMean, or tensormean.py: 'native' (Euclidean) or 'log_euclidean'.
+        self.mean_engine = mean_engine
+        if self.mean_engine not in MEAN_ENGINES:
+            self.messages.append(Notice("Error", "The mean engine you specified is not recognized. Select one of {0}".format(MEAN_ENGINES)))
+        #Intermediate rigid and diffeomorphic group means of only the first mean_quorum percent of sources to
+        #finish (100 waits for all). The quorum is counted by a pipelined mean's accumulator.
+        self.mean_quorum = float(mean_quorum)
+        if self.mean_quorum <= 0 or self.mean_quorum > 100:
+            self.messages.append(Notice("Error", "The mean quorum must be a percentage above 0, and at most 100."))
+        #Group means are accumulated by a job that runs beside the warps, rather than after them.
+        self.pipelined_means = pipelined_means or self.mean_quorum < 100
+        if self.pipelined_means and self.mean_fanin >= 2:
+            self.messages.append(Notice("Warning", "Pipelined means (--pipelined_means, or a --mean_quorum below 100) accumulate every source in one job; --mean_fanin is not used."))
+        #Rigid and affine iterations stop early, carrying the last one forward, once the template
+        #changes by at most template_tolerance (relative) in an iteration (0 runs them all).
+        self.template_tolerance = float(template_tolerance)
+        if self.template_tolerance < 0:
+            self.messages.append(Notice("Error", "The template tolerance cannot be negative."))
+        #With a template, each subject's warps run as two fused jobs, either side of the affine mean.
+        self.fused_registration = fused_registration and template != None
+        if fused_registration and template == None:
+            self.messages.append(Notice("Warning", "Fused registration needs a template (--template); the iterations are planned as separate jobs."))
+        #Coarse rigid and affine iterations register images downsampled by pyramid_factor (1 disables this).
+        self.pyramid_factor = int(pyramid_factor)
+        if self.pyramid_factor < 1:
+            self.messages.append(Notice("Error", "The pyramid factor must be a positive integer."))
+        #Diffeomorphic iterations after the first refine the previous one's field, rather than starting over.
+        self.warm_diffeomorphic = warm_diffeomorphic
+        #Template building affine iterations have one group mean, which also applies the inverse average affine.
+        self.single_affine_barrier = single_affine_barrier and template == None
+        #Groups of more than template_subset subjects build their template from a subset of that many, stratified
+        #by the template_strata columns, and then register the rest to it (0 builds it from every subject).
+        self.template_subset = int(template_subset) if template == None else 0
+        self.template_sources = None
+        if int(template_subset) > 0 and template != None:
+            self.messages.append(Notice("Warning", "A template subset is only used to build a template; every subject is registered to the one you specified (--template)."))
+        if self.template_subset < 0:
+            self.messages.append(Notice("Error", "The template subset cannot be negative."))
+        missing_strata = [column for column in template_strata if column not in self.matrix.columns]
+        if len(missing_strata) > 0:
+            self.messages.append(Notice("Error", "The spreadsheet you supplied did not have the template strata columns [{0}].".format(", ".join(missing_strata))))
 
         if template != None:
             self.rigid = 1
@@ -55,13 +107,19 @@ class normalize(Component):
 
         if "PROJECT" not in self.matrix.columns:
             self.matrix["PROJECT"] = self.name
+        #The strata columns are dropped from the matrix below, so the subsets are chosen first.
+        if self.template_subset > 0 and len(missing_strata) == 0 and set(self.hierarchy).issubset(set(self.matrix.columns)):
+            self.template_sources = template_sources(self.matrix, self.hierarchy, self.template_subset, template_strata)
         try:
             self.matrix = self.matrix[self.hierarchy + ["SPD"]]
         except:
             self.messages.append(Notice("Error", "The spreadsheet you supplied did not have columns for the hierarchy specified."))
 
         self.initial_steps = []
+        self.initial_step_ids = {}
         self.final_steps = []
+        #Composed warp file -> ComposeWarp job, for the sources registered to a template they did not build
+        self.remaining_warps = {}
 
     @classmethod
     def get_arg_mappings(cls):
@@ -71,175 +129,494 @@ class normalize(Component):
         "--species": "Species",
         "--rigid": "RigidIterations",
         "--affine": "AffineIterations",
-        "--diffeo": "DiffeomorphicIterations"}
+        "--diffeo": "DiffeomorphicIterations",
+        "--mean_fanin": "MeanFanin",
+        "--mean_engine": "MeanEngine",
+        "--pipelined_means": "PipelinedMeans",
+        "--mean_quorum": "MeanQuorum",
+        "--template_tolerance": "TemplateTolerance",
+        "--fused_registration": "FusedRegistration",
+        "--pyramid_factor": "PyramidFactor",
+        "--warm_diffeo": "WarmDiffeomorphic",
+        "--single_affine_barrier": "SingleAffineBarrier",
+        "--template_subset": "TemplateSubset",
+        "--template_strata": "TemplateStrata"}
 
         return args
 
-    def __plan_tier__(self, matrix, hierarchies, dax, process, initial=True, previous_template_subset_id=None):
-
-        #Plan normalization here
-        template_tier = hierarchies[0]
-        template_id = matrix[hierarchies[0]].unique()[0]
-        source_tier = hierarchies[1]
-
-        if initial == True or previous_template_subset_id == None:
-            template_subset_id = template_tier+"-"+template_id
-        else:
-            template_subset_id = previous_template_subset_id+"_"+template_tier+"-"+template_id
-
-        source_zips = pandas.Series(matrix[matrix[template_tier] == template_id][source_tier].unique()).apply(lambda val: (val, template_subset_id+"_{0}-{1}".format(source_tier, val)))
-
-        #template_subset_id = self.hierarchy[0:self.hierarchy.index(template_tier)+1]
-        #source_subset_hierarchies = self.hierarchy[0:self.hierarchy.index(source_tier)+1]
-        #source_zips = self.matrix[source_subset_hierarchies].drop_duplicates().apply(lambda row: (row[source_tier], self.__get_subset_id__(row, source_subset_hierarchies)),axis=1)
-
-
-        #ImageDim
-        ImageDim_Jobs = []
-        for values in source_zips:
-            source_id, subset_id = values
-            imagedimjob = normalize_ImageDim(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, template=self.resampled_template, transferflag=self.transferflag)
-            self.files.update(imagedimjob.files)
-            ImageDim_Jobs.append(imagedimjob)
-            dax.addJob(imagedimjob.pegasus_job)
-            if source_tier == hierarchies[-1]:
-                #Base Tier, add to self.initial_steps
-                self.initial_steps.append(imagedimjob)
-            process.increment()
-
-        #CreateTemplate
-        createtemplatejob = normalize_CreateTemplate(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, template=self.resampled_template, transferflag=self.transferflag)
-        self.files.update(createtemplatejob.files)
-        dax.addJob(createtemplatejob.pegasus_job)
-        for ImageDim_Job in ImageDim_Jobs:
-            dax.depends(parent=ImageDim_Job.pegasus_job, child=createtemplatejob.pegasus_job)
+    def __index_sources__(self, matrix, template_tier, template_id, source_tier):
+        """
+        Returns an ordered mapping of source id -> SPD for the members of one template group.
+        Order follows the first appearance of each source in the matrix.
+        """
+        group = matrix[matrix[template_tier] == template_id].drop_duplicates(subset=[source_tier])
+        return OrderedDict(zip(group[source_tier], group["SPD"]))
+
+    def __reducer__(self, dax, process, subset_id, tag, level, source_jobs, after=None, quorum=100):
+        #A reduction that the group means call with their inputs. Without a fan-in, it plans nothing.
+        #'after' is the job the source jobs wait for, which a pipelined mean starts after too.
+        if self.pipelined_means:
+            return normalize_MeanPipeline(self, dax, process, subset_id, tag, source_jobs, after, quorum)
+        return normalize_MeanReduction(self, dax, process, self.mean_fanin, subset_id, tag, level, source_jobs)
+
+    def __pyramid__(self, stage, iteration):
+        #The downsampling factor of a template building iteration: every rigid one, and the affine ones but the last.
+        if self.template != None or (stage == "affine" and iteration == self.affine):
+            return 1
+        return self.pyramid_factor
+
+    def __template_change__(self, dax, process, subset_id, template_id, stage, iteration, level, meanjob, previous_gate):
+        #From the second iteration on, checks whether the mean has converged, if another iteration follows.
+        if self.template != None or self.template_tolerance <= 0 or iteration < 2:
+            return None
+        if iteration == (self.rigid if stage == "rigid" else self.affine):
+            return None
+        gate = normalize_TemplateChange(subset_id=subset_id, template_id=template_id, stage=stage, iteration=iteration, tolerance=self.template_tolerance, transferflag=self.transferflag,
+                                        converged=previous_gate.converged_file if previous_gate != None else None)
+        self.__cluster__(gate, level)
+        dax.addJob(gate.pegasus_job)
+        self.files.update(gate.files)
+        dax.depends(parent=meanjob.pegasus_job, child=gate.pegasus_job)
+        if previous_gate != None:
+            dax.depends(parent=previous_gate.pegasus_job, child=gate.pegasus_job)
         process.increment()
-
+        return gate
+
+    def __gate__(self, gate, previous, job):
+        #Has 'job' carry 'previous' (the same job, an iteration before) forward if the template has converged.
+        #Must be called before the job is added to the dax.
+        job.pegasus_job.addArguments("--converged", gate.converged_file)
+        job.pegasus_job.uses(gate.converged_file, link=Link.INPUT)
+        used = [use.name for use in job.pegasus_job.used]
+        for previous_file, current_file in zip(previous.output_files, job.output_files):
+            job.pegasus_job.addArguments("--carry", "{0}:{1}".format(previous_file, current_file))
+            if previous_file not in used:
+                job.pegasus_job.uses(previous_file, link=Link.INPUT, optional=True)
+
+    def __plan_iterations__(self, dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, source_index, source_zips, level, createtemplatejob):
+        #The rigid, affine and diffeomorphic iterations of one group, and the composition. Returns its ComposeMean job.
         #Rigid
+        rigidgate = None
+        RigidWarp_Jobs = []
         for rigid_iteration in range(1,self.rigid+1):
+            Previous_RigidWarp_Jobs = RigidWarp_Jobs
             RigidWarp_Jobs = []
             #Individual Warp
-            for values in source_zips:
+            for index, values in enumerate(source_zips):
                 source_id, subset_id = values
-                rigidjob = normalize_RigidWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, iteration=rigid_iteration, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, transferflag=self.transferflag)
+                rigidjob = normalize_RigidWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=rigid_iteration, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, transferflag=self.transferflag, downsample=self.__pyramid__("rigid", rigid_iteration))
                 self.files.update(rigidjob.files)
                 RigidWarp_Jobs.append(rigidjob)
+                if rigidgate != None:
+                    self.__gate__(rigidgate, Previous_RigidWarp_Jobs[index], rigidjob)
+                self.__cluster__(rigidjob, level+"_i{0}".format(rigid_iteration))
                 dax.addJob(rigidjob.pegasus_job)
                 if rigid_iteration == 1:
                     dax.depends(parent=createtemplatejob.pegasus_job, child=rigidjob.pegasus_job)
                 else:
-                    dax.depends(parent=rigidmeanjob.pegasus_job, child=rigidjob.pegasus_job)
+                    dax.depends(parent=rigidmeanjob.pegasus_job if rigidgate == None else rigidgate.pegasus_job, child=rigidjob.pegasus_job)
+                    reduction.follow(index, rigidjob)
                 process.increment()
 
             #Group Mean
             if self.template == None:
-                rigidmeanjob=normalize_RigidMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, iteration=rigid_iteration, smoption=self.similarity_metric, transferflag=self.transferflag)
+                reduction = self.__reducer__(dax, process, template_subset_id, "rigid_i{0}".format(rigid_iteration), level+"_i{0}".format(rigid_iteration), RigidWarp_Jobs,
+                                             after=createtemplatejob if rigid_iteration == 1 else rigidgate if rigidgate != None else rigidmeanjob, quorum=self.mean_quorum)
+                previous_rigidmeanjob = rigidmeanjob if rigid_iteration > 1 else None
+                rigidmeanjob=normalize_RigidMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=rigid_iteration, smoption=self.similarity_metric, transferflag=self.transferflag, reducer=reduction, engine=self.mean_engine)
+                if rigidgate != None:
+                    self.__gate__(rigidgate, previous_rigidmeanjob, rigidmeanjob)
+                self.__cluster__(rigidmeanjob, level+"_i{0}".format(rigid_iteration))
                 dax.addJob(rigidmeanjob.pegasus_job)
                 self.files.update(rigidmeanjob.files)
-                for RigidWarp_Job in RigidWarp_Jobs:
-                    dax.depends(parent=RigidWarp_Job.pegasus_job, child=rigidmeanjob.pegasus_job)
+                for parent in reduction.parents:
+                    dax.depends(parent=parent.pegasus_job, child=rigidmeanjob.pegasus_job)
                 process.increment()
 
+                #Convergence
+                rigidgate = self.__template_change__(dax, process, template_subset_id, template_id, "rigid", rigid_iteration, level+"_i{0}".format(rigid_iteration), rigidmeanjob, rigidgate)
+
         #Affine
+        affinegate = None
+        AffineWarpA_Jobs = []
+        AffineWarpB_Jobs = []
         for affine_iteration in range(1,self.affine+1):
+            Previous_AffineWarpA_Jobs = AffineWarpA_Jobs
+            Previous_AffineWarpB_Jobs = AffineWarpB_Jobs
             AffineWarpA_Jobs = []
             AffineWarpB_Jobs = []
             #Individual Warp, Part A
             for index, values in enumerate(source_zips):
                 source_id, subset_id = values
-                affinewarpajob = normalize_AffineWarpA(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, iteration=affine_iteration, template=self.resampled_template, smoption=self.similarity_metric, rigid=self.rigid, sepcoarse=self.sep_coarse, transferflag=self.transferflag)
+                affinewarpajob = normalize_AffineWarpA(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, template=self.resampled_template, smoption=self.similarity_metric, rigid=self.rigid, sepcoarse=self.sep_coarse, transferflag=self.transferflag, downsample=self.__pyramid__("affine", affine_iteration), fold=self.single_affine_barrier)
                 AffineWarpA_Jobs.append(affinewarpajob)
+                if affinegate != None:
+                    self.__gate__(affinegate, Previous_AffineWarpA_Jobs[index], affinewarpajob)
+                self.__cluster__(affinewarpajob, level+"_i{0}".format(affine_iteration))
                 dax.addJob(affinewarpajob.pegasus_job)
                 self.files.update(affinewarpajob.files)
                 if affine_iteration == 1:
                     if self.template == None:
                         dax.depends(parent=rigidmeanjob.pegasus_job, child=affinewarpajob.pegasus_job)
+                        reduction.follow(index, affinewarpajob)
                     else:
                         dax.depends(parent=RigidWarp_Jobs[index].pegasus_job, child=affinewarpajob.pegasus_job)
                 else:
-                    dax.depends(parent=affinemeanbjob.pegasus_job, child=affinewarpajob.pegasus_job)
+                    dax.depends(parent=affinemeanbjob.pegasus_job if affinegate == None else affinegate.pegasus_job, child=affinewarpajob.pegasus_job)
+                    reduction.follow(index, affinewarpajob)
                 process.increment()
 
-            #Group Mean, Part A
-            affinemeanajob = normalize_AffineMeanA(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, iteration=affine_iteration, smoption=self.similarity_metric, template=self.resampled_template, rigid=self.rigid, transferflag=self.transferflag)
-            dax.addJob(affinemeanajob.pegasus_job)
-            self.files.update(affinemeanajob.files)
-            for AffineWarpA_Job in AffineWarpA_Jobs:
-                dax.depends(parent=AffineWarpA_Job.pegasus_job, child=affinemeanajob.pegasus_job)
-            process.increment()
+            if self.single_affine_barrier:
+                #Group Mean, with the inverse average affine applied to it
+                reduction = self.__reducer__(dax, process, template_subset_id, "affine_i{0}".format(affine_iteration), level+"_i{0}".format(affine_iteration), AffineWarpA_Jobs,
+                                             after=rigidmeanjob if affine_iteration == 1 else affinegate if affinegate != None else affinemeanbjob)
+                previous_affinemeanbjob = affinemeanbjob if affine_iteration > 1 else None
+                affinemeanbjob = normalize_AffineMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, rigid=self.rigid, transferflag=self.transferflag, reducer=reduction, engine=self.mean_engine)
+                if affinegate != None:
+                    self.__gate__(affinegate, previous_affinemeanbjob, affinemeanbjob)
+                self.__cluster__(affinemeanbjob, level+"_i{0}".format(affine_iteration))
+                dax.addJob(affinemeanbjob.pegasus_job)
+                self.files.update(affinemeanbjob.files)
+                for parent in reduction.parents:
+                    dax.depends(parent=parent.pegasus_job, child=affinemeanbjob.pegasus_job)
+                process.increment()
 
-            #Individual Warp, Part B
-            for values in source_zips:
-                source_id, subset_id = values
-                affinewarpbjob = normalize_AffineWarpB(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, iteration=affine_iteration, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, rigid=self.rigid, transferflag=self.transferflag)
-                AffineWarpB_Jobs.append(affinewarpbjob)
-                dax.addJob(affinewarpbjob.pegasus_job)
-                self.files.update(affinewarpbjob.files)
-                dax.depends(parent=affinemeanajob.pegasus_job, child=affinewarpbjob.pegasus_job)
+                #Individual Warp, Part B, which only the diffeomorphic stage needs
+                if affine_iteration == self.affine:
+                    for index, values in enumerate(source_zips):
+                        source_id, subset_id = values
+                        affinewarpbjob = normalize_AffineWarpB(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, rigid=self.rigid, transferflag=self.transferflag)
+                        AffineWarpB_Jobs.append(affinewarpbjob)
+                        self.__cluster__(affinewarpbjob, level+"_i{0}".format(affine_iteration))
+                        dax.addJob(affinewarpbjob.pegasus_job)
+                        self.files.update(affinewarpbjob.files)
+                        dax.depends(parent=affinemeanbjob.pegasus_job, child=affinewarpbjob.pegasus_job)
+                        process.increment()
+            else:
+                #Group Mean, Part A
+                previous_affinemeanajob = affinemeanajob if affine_iteration > 1 else None
+                affinemeanajob = normalize_AffineMeanA(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, smoption=self.similarity_metric, template=self.resampled_template, rigid=self.rigid, transferflag=self.transferflag)
+                if affinegate != None:
+                    self.__gate__(affinegate, previous_affinemeanajob, affinemeanajob)
+                self.__cluster__(affinemeanajob, level+"_i{0}".format(affine_iteration))
+                dax.addJob(affinemeanajob.pegasus_job)
+                self.files.update(affinemeanajob.files)
+                for AffineWarpA_Job in AffineWarpA_Jobs:
+                    dax.depends(parent=AffineWarpA_Job.pegasus_job, child=affinemeanajob.pegasus_job)
                 process.increment()
 
-            #Group Mean, Part B
-            affinemeanbjob = normalize_AffineMeanB(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, iteration=affine_iteration, smoption=self.similarity_metric, template=self.resampled_template, transferflag=self.transferflag)
-            dax.addJob(affinemeanbjob.pegasus_job)
-            self.files.update(affinemeanbjob.files)
-            for AffineWarpB_Job in AffineWarpB_Jobs:
-                dax.depends(parent=AffineWarpB_Job.pegasus_job, child=affinemeanbjob.pegasus_job)
-            process.increment()
+                #Individual Warp, Part B
+                for index, values in enumerate(source_zips):
+                    source_id, subset_id = values
+                    affinewarpbjob = normalize_AffineWarpB(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, rigid=self.rigid, transferflag=self.transferflag)
+                    AffineWarpB_Jobs.append(affinewarpbjob)
+                    if affinegate != None:
+                        self.__gate__(affinegate, Previous_AffineWarpB_Jobs[index], affinewarpbjob)
+                    self.__cluster__(affinewarpbjob, level+"_i{0}".format(affine_iteration))
+                    dax.addJob(affinewarpbjob.pegasus_job)
+                    self.files.update(affinewarpbjob.files)
+                    dax.depends(parent=affinemeanajob.pegasus_job, child=affinewarpbjob.pegasus_job)
+                    process.increment()
+
+                #Group Mean, Part B. No quorum: Part A, the inverse average affine, has already waited for every subject.
+                reduction = self.__reducer__(dax, process, template_subset_id, "affine_i{0}".format(affine_iteration), level+"_i{0}".format(affine_iteration), AffineWarpB_Jobs,
+                                             after=affinemeanajob)
+                previous_affinemeanbjob = affinemeanbjob if affine_iteration > 1 else None
+                affinemeanbjob = normalize_AffineMeanB(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=affine_iteration, smoption=self.similarity_metric, template=self.resampled_template, transferflag=self.transferflag, reducer=reduction, engine=self.mean_engine)
+                if affinegate != None:
+                    self.__gate__(affinegate, previous_affinemeanbjob, affinemeanbjob)
+                self.__cluster__(affinemeanbjob, level+"_i{0}".format(affine_iteration))
+                dax.addJob(affinemeanbjob.pegasus_job)
+                self.files.update(affinemeanbjob.files)
+                for parent in reduction.parents:
+                    dax.depends(parent=parent.pegasus_job, child=affinemeanbjob.pegasus_job)
+                process.increment()
+
+            #Convergence
+            affinegate = self.__template_change__(dax, process, template_subset_id, template_id, "affine", affine_iteration, level+"_i{0}".format(affine_iteration), affinemeanbjob, affinegate)
 
         #Diffeomorphic
         for diffeo_iteration in range(1,self.diffeomorphic+1):
             DiffeoWarp_Jobs = []
             #Individual Warp
-            for values in source_zips:
+            for index, values in enumerate(source_zips):
                 source_id, subset_id = values
-                diffeowarpjob = normalize_DiffeomorphicWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, iteration=diffeo_iteration, template=self.resampled_template, affine=self.affine, transferflag=self.transferflag)
+                diffeowarpjob = normalize_DiffeomorphicWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=diffeo_iteration, template=self.resampled_template, affine=self.affine, transferflag=self.transferflag, warm=self.warm_diffeomorphic)
+                self.__cluster__(diffeowarpjob, level+"_i{0}".format(diffeo_iteration))
                 dax.addJob(diffeowarpjob.pegasus_job)
                 DiffeoWarp_Jobs.append(diffeowarpjob)
                 self.files.update(diffeowarpjob.files)
-                if diffeo_iteration == 1:
+                if diffeo_iteration == 1 and self.single_affine_barrier:
+                    dax.depends(parent=AffineWarpB_Jobs[index].pegasus_job, child=diffeowarpjob.pegasus_job)
+                elif diffeo_iteration == 1:
                     dax.depends(parent=affinemeanbjob.pegasus_job, child=diffeowarpjob.pegasus_job)
                 else:
                     dax.depends(parent=diffeomeanjob.pegasus_job, child=diffeowarpjob.pegasus_job)
+                reduction.follow(index, diffeowarpjob)
                 process.increment()
 
             #Group Mean
             if self.template == None:
-                diffeomeanjob = normalize_DiffeomorphicMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, iteration=diffeo_iteration, transferflag=self.transferflag)
+                reduction = self.__reducer__(dax, process, template_subset_id, "diffeomorphic_i{0}".format(diffeo_iteration), level+"_i{0}".format(diffeo_iteration), DiffeoWarp_Jobs,
+                                             after=affinemeanbjob if diffeo_iteration == 1 else diffeomeanjob, quorum=self.mean_quorum)
+                diffeomeanjob = normalize_DiffeomorphicMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=diffeo_iteration, transferflag=self.transferflag, reducer=reduction, engine=self.mean_engine)
+                self.__cluster__(diffeomeanjob, level+"_i{0}".format(diffeo_iteration))
                 dax.addJob(diffeomeanjob.pegasus_job)
                 self.files.update(diffeomeanjob.files)
-                for DiffeoWarp_Job in DiffeoWarp_Jobs:
-                    dax.depends(parent=DiffeoWarp_Job.pegasus_job, child=diffeomeanjob.pegasus_job)
+                for parent in reduction.parents:
+                    dax.depends(parent=parent.pegasus_job, child=diffeomeanjob.pegasus_job)
                 process.increment()
 
         #Composition
         ComposeWarp_Jobs = []
         for index, values in enumerate(source_zips):
             source_id, subset_id = values
-            composewarpjob = normalize_ComposeWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, matrix=matrix, template=self.resampled_template, affine=self.affine, diffeomorphic=self.diffeomorphic, transferflag=self.transferflag)
+            composewarpjob = normalize_ComposeWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, affine=self.affine, diffeomorphic=self.diffeomorphic, transferflag=self.transferflag)
+            self.__cluster__(composewarpjob, level)
             dax.addJob(composewarpjob.pegasus_job)
             ComposeWarp_Jobs.append(composewarpjob)
             self.files.update(composewarpjob.files)
             if self.template == None:
                 dax.depends(parent=diffeomeanjob.pegasus_job, child=composewarpjob.pegasus_job)
+                reduction.follow(index, composewarpjob)
             else:
                 dax.depends(parent=DiffeoWarp_Jobs[index].pegasus_job, child=composewarpjob.pegasus_job)
             process.increment()
 
-        composemeanjob = normalize_ComposeMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, matrix=matrix, template=self.resampled_template, transferflag=self.transferflag)
+        reduction = self.__reducer__(dax, process, template_subset_id, "compose", level, ComposeWarp_Jobs,
+                                     after=diffeomeanjob if self.template == None else None)
+        composemeanjob = normalize_ComposeMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, transferflag=self.transferflag, reducer=reduction, engine=self.mean_engine)
+        self.__cluster__(composemeanjob, level)
+        dax.addJob(composemeanjob.pegasus_job)
+        self.files.update(composemeanjob.files)
+        for parent in reduction.parents:
+            dax.depends(parent=parent.pegasus_job, child=composemeanjob.pegasus_job)
+        process.increment()
+
+        return composemeanjob
+
+    def __plan_registration__(self, dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, source_index, source_zips, level, createtemplatejob):
+        #Registration to a template, each subject's warps fused into two chains of steps. Returns its ComposeMean job.
+        #Only the affine mean (the inverse of the group's average affine) needs every subject.
+        AffineChain_Jobs = []
+        for values in source_zips:
+            source_id, subset_id = values
+            rigidjob = normalize_RigidWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, transferflag=self.transferflag)
+            affinewarpajob = normalize_AffineWarpA(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, template=self.resampled_template, smoption=self.similarity_metric, rigid=1, sepcoarse=self.sep_coarse, transferflag=self.transferflag)
+            #Only the affine transform leaves the chain: the affine mean and the second chain read it.
+            affinechainjob = normalize_Chain(subset_id=subset_id, name="Normalize_RegisterAffine", steps=[rigidjob, affinewarpajob], outputs=affinewarpajob.output_files[1:], transferflag=self.transferflag)
+            self.files.update(affinechainjob.files)
+            AffineChain_Jobs.append(affinechainjob)
+            self.__cluster__(affinechainjob, level)
+            dax.addJob(affinechainjob.pegasus_job)
+            dax.depends(parent=createtemplatejob.pegasus_job, child=affinechainjob.pegasus_job)
+            process.increment()
+
+        #Group Mean, Part A
+        affinemeanajob = normalize_AffineMeanA(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, template=self.resampled_template, rigid=1, transferflag=self.transferflag)
+        self.__cluster__(affinemeanajob, level)
+        dax.addJob(affinemeanajob.pegasus_job)
+        self.files.update(affinemeanajob.files)
+        for AffineChain_Job in AffineChain_Jobs:
+            dax.depends(parent=AffineChain_Job.pegasus_job, child=affinemeanajob.pegasus_job)
+        process.increment()
+
+        #Template mask, which needs only the template
+        affinemeanbjob = normalize_AffineMeanB(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, template=self.resampled_template, transferflag=self.transferflag)
+        self.__cluster__(affinemeanbjob, level)
+        dax.addJob(affinemeanbjob.pegasus_job)
+        self.files.update(affinemeanbjob.files)
+        dax.depends(parent=createtemplatejob.pegasus_job, child=affinemeanbjob.pegasus_job)
+        process.increment()
+
+        DiffeoChain_Jobs = []
+        for values in source_zips:
+            source_id, subset_id = values
+            affinewarpbjob = normalize_AffineWarpB(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=self.resampled_template, rigid=1, transferflag=self.transferflag)
+            diffeowarpjob = normalize_DiffeomorphicWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, template=self.resampled_template, affine=1, transferflag=self.transferflag)
+            composewarpjob = normalize_ComposeWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, affine=1, diffeomorphic=1, transferflag=self.transferflag)
+            diffeochainjob = normalize_Chain(subset_id=subset_id, name="Normalize_RegisterDiffeomorphic", steps=[affinewarpbjob, diffeowarpjob, composewarpjob], outputs=composewarpjob.output_files, transferflag=self.transferflag)
+            self.files.update(diffeochainjob.files)
+            DiffeoChain_Jobs.append(diffeochainjob)
+            self.__cluster__(diffeochainjob, level)
+            dax.addJob(diffeochainjob.pegasus_job)
+            dax.depends(parent=affinemeanajob.pegasus_job, child=diffeochainjob.pegasus_job)
+            dax.depends(parent=affinemeanbjob.pegasus_job, child=diffeochainjob.pegasus_job)
+            process.increment()
+
+        composemeanjob = normalize_ComposeMean(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, transferflag=self.transferflag, engine=self.mean_engine)
+        self.__cluster__(composemeanjob, level)
         dax.addJob(composemeanjob.pegasus_job)
         self.files.update(composemeanjob.files)
-        for ComposeWarp_Job in ComposeWarp_Jobs:
-            dax.depends(parent=ComposeWarp_Job.pegasus_job, child=composemeanjob.pegasus_job)
+        for DiffeoChain_Job in DiffeoChain_Jobs:
+            dax.depends(parent=DiffeoChain_Job.pegasus_job, child=composemeanjob.pegasus_job)
+        process.increment()
+        return composemeanjob
+
+    def __plan_remaining__(self, dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, source_index, source_zips, level, composemeanjob):
+        #The subjects that did not build the group's template, registered to it as to a static one. Returns their ComposeWarp jobs.
+        #The template's own files are named after it ({tier}-{id}), and its group jobs get their own subset id, apart from the build's.
+        #They follow the template's build, so level is apart from its levels, or clusters would join jobs either side of it.
+        final_id = "{0}-{1}".format(template_tier, template_id)
+        final_template = "{0}_template.nii.gz".format(final_id)
+        remaining_subset_id = template_subset_id+"_remaining"
+        base_tier = source_tier == hierarchies[-1]
+        AffineWarpA_Jobs = []
+        for values in source_zips:
+            source_id, subset_id = values
+            rigidjob = normalize_RigidWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=final_template, transferflag=self.transferflag)
+            self.files.update(rigidjob.files)
+            self.__cluster__(rigidjob, level)
+            dax.addJob(rigidjob.pegasus_job)
+            dax.depends(parent=composemeanjob.pegasus_job, child=rigidjob.pegasus_job)
+            if base_tier:
+                self.initial_steps.append(rigidjob)
+                self.initial_step_ids[subset_id] = rigidjob.job_id
+            process.increment()
+
+            affinewarpajob = normalize_AffineWarpA(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, template=final_template, smoption=self.similarity_metric, rigid=1, sepcoarse=self.sep_coarse, transferflag=self.transferflag)
+            self.files.update(affinewarpajob.files)
+            AffineWarpA_Jobs.append(affinewarpajob)
+            self.__cluster__(affinewarpajob, level)
+            dax.addJob(affinewarpajob.pegasus_job)
+            dax.depends(parent=rigidjob.pegasus_job, child=affinewarpajob.pegasus_job)
+            process.increment()
+
+        #Group Mean, Part A
+        affinemeanajob = normalize_AffineMeanA(subset_id=remaining_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, template=final_template, rigid=1, transferflag=self.transferflag)
+        self.__cluster__(affinemeanajob, level)
+        dax.addJob(affinemeanajob.pegasus_job)
+        self.files.update(affinemeanajob.files)
+        for AffineWarpA_Job in AffineWarpA_Jobs:
+            dax.depends(parent=AffineWarpA_Job.pegasus_job, child=affinemeanajob.pegasus_job)
+        process.increment()
+
+        #Template mask, which needs only the template
+        affinemeanbjob = normalize_AffineMeanB(subset_id=remaining_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, template=final_template, transferflag=self.transferflag)
+        self.__cluster__(affinemeanbjob, level)
+        dax.addJob(affinemeanbjob.pegasus_job)
+        self.files.update(affinemeanbjob.files)
+        dax.depends(parent=composemeanjob.pegasus_job, child=affinemeanbjob.pegasus_job)
+        process.increment()
+
+        ComposeWarp_Jobs = []
+        for values in source_zips:
+            source_id, subset_id = values
+            affinewarpbjob = normalize_AffineWarpB(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, smoption=self.similarity_metric, sepcoarse=self.sep_coarse, template=final_template, rigid=1, transferflag=self.transferflag)
+            self.files.update(affinewarpbjob.files)
+            self.__cluster__(affinewarpbjob, level)
+            dax.addJob(affinewarpbjob.pegasus_job)
+            dax.depends(parent=affinemeanajob.pegasus_job, child=affinewarpbjob.pegasus_job)
+            process.increment()
+
+            diffeowarpjob = normalize_DiffeomorphicWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=final_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, iteration=1, template=final_template, affine=1, transferflag=self.transferflag)
+            self.files.update(diffeowarpjob.files)
+            self.__cluster__(diffeowarpjob, level)
+            dax.addJob(diffeowarpjob.pegasus_job)
+            dax.depends(parent=affinewarpbjob.pegasus_job, child=diffeowarpjob.pegasus_job)
+            dax.depends(parent=affinemeanbjob.pegasus_job, child=diffeowarpjob.pegasus_job)
+            process.increment()
+
+            #The composed warps keep the group's name, as the template building subjects' do.
+            composewarpjob = normalize_ComposeWarp(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, template=final_template, affine=1, diffeomorphic=1, transferflag=self.transferflag)
+            self.files.update(composewarpjob.files)
+            ComposeWarp_Jobs.append(composewarpjob)
+            self.remaining_warps[composewarpjob.output_files[0]] = composewarpjob
+            self.__cluster__(composewarpjob, level)
+            dax.addJob(composewarpjob.pegasus_job)
+            dax.depends(parent=diffeowarpjob.pegasus_job, child=composewarpjob.pegasus_job)
+            process.increment()
+        return ComposeWarp_Jobs
+
+    def __plan_tier__(self, matrix, hierarchies, dax, process, initial=True, previous_template_subset_id=None):
+
+        #Plan normalization here
+        template_tier = hierarchies[0]
+        template_id = matrix[hierarchies[0]].unique()[0]
+        source_tier = hierarchies[1]
+
+        if initial == True or previous_template_subset_id == None:
+            template_subset_id = template_tier+"-"+template_id
+        else:
+            template_subset_id = previous_template_subset_id+"_"+template_tier+"-"+template_id
+
+        #Index the group once: source id -> SPD. The job builders look sources up here
+        #instead of masking the matrix for every source of every iteration.
+        source_index = self.__index_sources__(matrix, template_tier, template_id, source_tier)
+        source_zips = [(source_id, template_subset_id+"_{0}-{1}".format(source_tier, source_id)) for source_id in source_index]
+        base_tier = source_tier == hierarchies[-1]
+
+        #Two-phase template: only the chosen subjects build it, and the remaining ones are registered to it once it is final.
+        remaining_index = OrderedDict()
+        remaining_zips = []
+        if base_tier and self.template_sources != None:
+            remaining_index = OrderedDict([(source_id, spd) for source_id, spd in source_index.items() if spd not in self.template_sources])
+            remaining_zips = [(source_id, subset_id) for source_id, subset_id in source_zips if source_id in remaining_index]
+            source_index = OrderedDict([(source_id, spd) for source_id, spd in source_index.items() if spd in self.template_sources])
+            source_zips = [(source_id, subset_id) for source_id, subset_id in source_zips if source_id in source_index]
+
+        #Clustering level: jobs of one transformation at the same depth (and iteration) are independent
+        level = "t{0}".format(len(self.hierarchy) - len(hierarchies))
+
+        #template_subset_id = self.hierarchy[0:self.hierarchy.index(template_tier)+1]
+        #source_subset_hierarchies = self.hierarchy[0:self.hierarchy.index(source_tier)+1]
+        #source_zips = self.matrix[source_subset_hierarchies].drop_duplicates().apply(lambda row: (row[source_tier], self.__get_subset_id__(row, source_subset_hierarchies)),axis=1)
+
+
+        #ImageDim
+        ImageDim_Jobs = []
+        if base_tier and self.fit_dimensions and self.template == None:
+            dimension_files = OrderedDict([(source_id, subset_id+"_dimensions.csv") for source_id, subset_id in source_zips])
+            imagedim_zips = []
+        else:
+            dimension_files = None
+            imagedim_zips = source_zips
+        for values in imagedim_zips:
+            source_id, subset_id = values
+            imagedimjob = normalize_ImageDim(subset_id=subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, source_id=source_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, transferflag=self.transferflag)
+            self.files.update(imagedimjob.files)
+            ImageDim_Jobs.append(imagedimjob)
+            self.__cluster__(imagedimjob, level)
+            dax.addJob(imagedimjob.pegasus_job)
+            if base_tier:
+                #Base Tier, add to self.initial_steps
+                self.initial_steps.append(imagedimjob)
+                self.initial_step_ids[subset_id] = imagedimjob.job_id
+            process.increment()
+
+        #CreateTemplate
+        createtemplatejob = normalize_CreateTemplate(subset_id=template_subset_id, template_tier=template_tier, source_tier=source_tier, template_id=template_id, hierarchy=hierarchies, source_index=source_index, template=self.resampled_template, transferflag=self.transferflag, dimension_files=dimension_files, engine=self.mean_engine)
+        self.files.update(createtemplatejob.files)
+        self.__cluster__(createtemplatejob, level)
+        dax.addJob(createtemplatejob.pegasus_job)
+        for ImageDim_Job in ImageDim_Jobs:
+            dax.depends(parent=ImageDim_Job.pegasus_job, child=createtemplatejob.pegasus_job)
+        if dimension_files != None:
+            #The base tier's sources go straight into CreateTemplate
+            self.initial_steps.append(createtemplatejob)
+            for source_id, subset_id in source_zips:
+                self.initial_step_ids[subset_id] = createtemplatejob.job_id
         process.increment()
 
+        #Iterations
+        if self.fused_registration:
+            composemeanjob = self.__plan_registration__(dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, source_index, source_zips, level, createtemplatejob)
+        else:
+            composemeanjob = self.__plan_iterations__(dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, source_index, source_zips, level, createtemplatejob)
+        Remaining_Jobs = []
+        if len(remaining_zips) > 0:
+            Remaining_Jobs = self.__plan_remaining__(dax, process, template_subset_id, template_tier, template_id, source_tier, hierarchies, remaining_index, remaining_zips, level+"_remaining", composemeanjob)
+
         #Possibly go deeper
         if len(hierarchies) > 2:
+            #Each child group's template is read only by its own ImageDim job in this tier,
+            #so link it there rather than to every ImageDim job (children x parents edges).
+            ImageDim_Lookup = dict(zip([source_id for source_id, subset_id in imagedim_zips], ImageDim_Jobs))
             child_matrix_set = matrix[hierarchies[1:]+["SPD"]]
             for child_group, child_matrix in child_matrix_set.groupby(hierarchies[1]):
                 dax, parents = self.__plan_tier__(child_matrix[hierarchies[1:]+["SPD"]], hierarchies[1:], dax, process, initial=False, previous_template_subset_id=template_subset_id)
                 for parent in parents:
-                    for ImageDim_Job in ImageDim_Jobs:
-                        dax.depends(parent=parent.pegasus_job, child=ImageDim_Job.pegasus_job)
+                    dax.depends(parent=parent.pegasus_job, child=ImageDim_Lookup[child_group].pegasus_job)
 
 
         if initial == True and len(hierarchies) > 2:
@@ -250,15 +627,20 @@ class normalize(Component):
                 composefullwarpjob = normalize_ComposeFullWarp(child_index, child_matrix, hierarchies, self.transferflag)
                 self.files.update(composefullwarpjob.files)
                 ComposeFullWarp_Jobs.append(composefullwarpjob)
+                self.__cluster__(composefullwarpjob, level)
                 dax.addJob(composefullwarpjob.pegasus_job)
                 dax.depends(parent=composemeanjob.pegasus_job, child=composefullwarpjob.pegasus_job)
+                for warp_file in composefullwarpjob.warp_files:
+                    if warp_file in self.remaining_warps:
+                        dax.depends(parent=self.remaining_warps[warp_file].pegasus_job, child=composefullwarpjob.pegasus_job)
                 process.increment()
             self.final_steps = ComposeFullWarp_Jobs
             return dax, ComposeFullWarp_Jobs
         else:
-            #Return the last step in normalization for each tier (ComposeMean)
+            #Return the last step in normalization for each tier (ComposeMean, and the warps of subjects registered after it)
             if initial == True:
-                self.final_steps = [composemeanjob]
+                self.final_steps = [composemeanjob] + Remaining_Jobs
+                return dax, self.final_steps
             return dax, [composemeanjob]
 
 
@@ -268,15 +650,270 @@ class normalize(Component):
         self.parents = parents
         return dax
 
+def template_sources(matrix, hierarchy, size, strata):
+    #The SPDs that build each base group's template: all of a group of at most size subjects, otherwise size of them,
+    #allotted to the strata in proportion to their sizes (largest remainder) and spread evenly through each stratum.
+    sources = set()
+    subjects = matrix.drop_duplicates(subset=hierarchy)
+    for key, group in subjects.groupby(hierarchy[:-1], sort=False):
+        if len(group) <= size:
+            sources.update(group["SPD"])
+            continue
+        if len(strata) == 0:
+            frames = [group]
+        else:
+            labels = group[strata].fillna("").astype(str).apply(lambda row: "/".join(row), axis=1)
+            frames = [frame for label, frame in group.groupby(labels)]
+        quotas = [size * len(frame) / float(len(group)) for frame in frames]
+        counts = [int(quota) for quota in quotas]
+        for index in sorted(range(len(frames)), key=lambda index: counts[index] - quotas[index])[:size - sum(counts)]:
+            counts[index] += 1
+        for frame, count in zip(frames, counts):
+            if count > 0:
+                sources.update(frame["SPD"].iloc[[int(position * len(frame) / count) for position in range(count)]])
+    return sources
+
+def mean_engine_args(engine, partials=None):
+    #The arguments that select a mean script's engine. TVMean has no weights, so weighted means of partial means are native.
+    if partials != None and engine == "dtitk":
+        engine = "native"
+    if engine == "dtitk":
+        return []
+    return ["--engine", engine]
+
+def retained_inputs(reducer):
+    #Inputs a group mean declares, as optional, without averaging them itself.
+    return reducer.retained if reducer != None else []
+
+def input_list_text(files, partials=None):
+    #The contents of a mean's input list: one image per line, followed by its weight for partial means.
+    if partials == None:
+        return "\n".join(files)+"\n"
+    return "\n".join(["{0} {1}".format(partial_file, weight) for partial_file, weight in partials])+"\n"
+
+class normalize_Chain(object):
+    """
+    Runs the steps of one subject, jobs of other transformations, one after another as a
+    single job. Normalize_Chain.sh runs them in a scratch directory on the node: the chain's
+    inputs are the files its steps read that no earlier step writes, and only 'outputs' are
+    written back, so the files passed between steps are never staged.
+    """
+    def __init__(self, subset_id, name, steps, outputs, transferflag):
+        self.job_id = subset_id+"_"+name
+        self.pegasus_job = Job(name=name, namespace="dipa", id=self.job_id)
+        self.files = {}
+
+        steps_file = "{0}_{1}_steps.txt".format(subset_id, name)
+        input_files = [steps_file]
+        produced = []
+        step_lines = []
+        for step in steps:
+            self.files.update(step.files)
+            uses = sorted(step.pegasus_job.used, key=lambda use: use.name)
+            for use in uses:
+                if use.link == Link.INPUT and use.name not in produced and use.name not in input_files:
+                    input_files.append(use.name)
+            produced.extend([use.name for use in uses if use.link == Link.OUTPUT])
+            step_lines.append(" ".join(["{0}.sh".format(step.pegasus_job.name)] + [str(argument) for argument in step.pegasus_job.arguments]))
+        self.files[steps_file] = "\n".join(step_lines)+"\n"
+
+        args = ["--steps", steps_file]
+        for inputfile in input_files[1:]:
+            args.extend(["--input", inputfile])
+        for outputfile in outputs:
+            args.extend(["--output", outputfile])
+
+        self.pegasus_job.addArguments(*args)
+
+        for inputfile in input_files:
+            self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for outputfile in outputs:
+            self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
+
+class normalize_MeanReduction(object):
+    """
+    Plans a k-ary tree of Normalize_PartialMean jobs below a group mean.
+    The group mean calls it with its channels, a list of (input files, output file), one per
+    image it averages. If there are more sources than the fan-in, each chunk of at most
+    'fanin' inputs is averaged by a partial mean job, and so on until at most 'fanin' partial
+    means remain. It returns, per channel, the (partial mean, weight) pairs that the group
+    mean then averages with those weights, or None when no reduction is needed.
+    The group mean depends on the jobs in self.parents, and also reads self.retained.
+    """
+    def __init__(self, component, dax, process, fanin, subset_id, tag, level, source_jobs):
+        self.component = component
+        self.dax = dax
+        self.process = process
+        self.fanin = fanin
+        self.subset_id = subset_id
+        self.tag = tag
+        self.level = level
+        self.parents = source_jobs
+        self.retained = []
+
+    def follow(self, index, job):
+        #Its group mean waits for every source.
+        pass
+
+    def __call__(self, channels):
+        if self.fanin < 2 or len(self.parents) <= self.fanin:
+            return None
+        weighted = [[(inputfile, 1) for inputfile in inputfiles] for inputfiles, outputfile in channels]
+        jobs = self.parents
+        depth = 0
+        while len(jobs) > self.fanin:
+            next_weighted = [[] for channel in channels]
+            next_jobs = []
+            for chunk, start in enumerate(range(0, len(jobs), self.fanin)):
+                partial_channels = []
+                for index, values in enumerate(channels):
+                    inputfiles, outputfile = values
+                    members = weighted[index][start:start+self.fanin]
+                    partial_file = outputfile.replace(".nii.gz", "_p{0}-{1}.nii.gz".format(depth, chunk))
+                    partial_channels.append((members, partial_file))
+                    next_weighted[index].append((partial_file, sum([weight for member, weight in members])))
+                partialjob = normalize_PartialMean(subset_id="{0}_{1}_p{2}-{3}".format(self.subset_id, self.tag, depth, chunk), channels=partial_channels, transferflag=self.component.transferflag, engine=self.component.mean_engine)
+                self.component.files.update(partialjob.files)
+                self.component.__cluster__(partialjob, self.level+"_p{0}".format(depth))
+                self.dax.addJob(partialjob.pegasus_job)
+                for job in jobs[start:start+self.fanin]:
+                    self.dax.depends(parent=job.pegasus_job, child=partialjob.pegasus_job)
+                next_jobs.append(partialjob)
+                self.process.increment()
+            weighted = next_weighted
+            jobs = next_jobs
+            depth += 1
+        self.parents = jobs
+        return weighted
+
+class normalize_MeanPipeline(object):
+    """
+    Plans a Normalize_MeanAccumulate job beside the source jobs of a group mean.
+    It starts with them, after the job they wait for, and adds each source's image to a
+    running mean as soon as it is written, so the mean is ready soon after the last source
+    finishes. The group mean then averages only the accumulated image, weighted by the
+    number of sources, and depends on the jobs in self.parents: the sources, whose other
+    outputs later steps read, and the accumulator. It still declares the source images,
+    in self.retained, as optional inputs, so that they are not cleaned up before the
+    accumulator reads them.
+    The accumulator finds its inputs by polling the working directory they are written to,
+    so pipelined means need a shared filesystem.
+
+    With a quorum below 100 (percent), the accumulator stops at the first quorum of sources
+    to finish, writes who they were to a contributors file, and the group mean depends on it
+    alone. The sources left out are still registered against that mean in the next step,
+    which follow() makes wait for them directly.
+    """
+    def __init__(self, component, dax, process, subset_id, tag, source_jobs, after, quorum=100):
+        self.component = component
+        self.dax = dax
+        self.process = process
+        self.subset_id = subset_id
+        self.tag = tag
+        self.after = after
+        self.quorum = quorum
+        self.sources = source_jobs
+        self.parents = source_jobs
+        self.retained = []
+        self.quorate = False
+
+    def follow(self, index, job):
+        #The group mean no longer implies that source 'index' has finished, so its next job waits for it.
+        if self.quorate:
+            self.dax.depends(parent=self.sources[index].pegasus_job, child=job.pegasus_job)
+
+    def __call__(self, channels):
+        if self.after == None or len(self.parents) < 2:
+            return None
+        accumulated_channels = []
+        for inputfiles, outputfile in channels:
+            accumulated_channels.append((inputfiles, outputfile.replace(".nii.gz", "_accumulated.nii.gz")))
+        count = len(self.sources)
+        if self.quorum < 100 and int(math.ceil(self.quorum * count / 100.0)) < count:
+            count = int(math.ceil(self.quorum * count / 100.0))
+            self.quorate = True
+        accumulatejob = normalize_MeanAccumulate(subset_id="{0}_{1}".format(self.subset_id, self.tag), channels=accumulated_channels, transferflag=self.component.transferflag, engine=self.component.mean_engine,
+                                                 quorum=self.quorum if self.quorate else 100)
+        self.component.files.update(accumulatejob.files)
+        #Not clustered: a clustered accumulator would hold up the jobs clustered after it.
+        self.dax.addJob(accumulatejob.pegasus_job)
+        self.dax.depends(parent=self.after.pegasus_job, child=accumulatejob.pegasus_job)
+        if self.quorate:
+            self.parents = [accumulatejob]
+        else:
+            self.parents = self.parents + [accumulatejob]
+        self.retained = [inputfile for inputfiles, accumulated_file in accumulated_channels for inputfile in inputfiles]
+        self.process.increment()
+        return [[(accumulated_file, count)] for inputfiles, accumulated_file in accumulated_channels]
+
+class normalize_MeanAccumulate(object):
+    def __init__(self, subset_id, channels, transferflag, engine="dtitk", quorum=100):
+        self.job_id = subset_id+"_Normalize_MeanAccumulate"
+        self.pegasus_job = Job(name="Normalize_MeanAccumulate", namespace="dipa", id=self.job_id)
+        self.files = {}
+
+        args = []
+        input_files = []
+        output_files = []
+        for inputfiles, accumulated_file in channels:
+            input_list_file = accumulated_file.replace(".nii.gz", "_input.txt")
+            self.files[input_list_file] = input_list_text(inputfiles)
+            args.extend(["--inputlist", input_list_file, "--output", accumulated_file])
+            #The images are not declared as inputs: they do not exist yet when this job starts.
+            input_files.append(input_list_file)
+            output_files.append(accumulated_file)
+        args.extend(["--precision", "float64", "--wait", str(PIPELINE_TIMEOUT)])
+        if engine == "log_euclidean":
+            args.append("--log_euclidean")
+        if quorum < 100:
+            #Which sources made the quorum is only known once the job has run.
+            contributors_file = channels[0][1].replace("_accumulated.nii.gz", "_contributors.txt")
+            args.extend(["--quorum", str(quorum), "--contributors", contributors_file])
+            output_files.append(contributors_file)
+
+        self.pegasus_job.addArguments(*args)
+
+        for inputfile in input_files:
+            self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for outputfile in output_files:
+            self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
+
+class normalize_PartialMean(object):
+    def __init__(self, subset_id, channels, transferflag, engine="dtitk"):
+        self.job_id = subset_id+"_Normalize_PartialMean"
+        self.pegasus_job = Job(name="Normalize_PartialMean", namespace="dipa", id=self.job_id)
+        self.files = {}
+
+        args = []
+        input_files = []
+        output_files = []
+        for members, partial_file in channels:
+            input_list_file = partial_file.replace(".nii.gz", "_input.txt")
+            self.files[input_list_file] = input_list_text(None, members)
+            args.extend(["--inputlist", input_list_file, "--output", partial_file])
+            input_files.extend([input_list_file] + [member for member, weight in members])
+            output_files.append(partial_file)
+        #Partial means are kept in float64, so that only the group mean itself is rounded.
+        args.extend(["--precision", "float64"])
+        if engine == "log_euclidean":
+            args.append("--log_euclidean")
+
+        self.pegasus_job.addArguments(*args)
+
+        for inputfile in input_files:
+            self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for outputfile in output_files:
+            self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
+
 class normalize_ImageDim(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, hierarchy, matrix, transferflag, template=None):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, hierarchy, source_index, transferflag, template=None):
         self.job_id = subset_id+"_Normalize_ImageDim"
         self.pegasus_job = Job(name="Normalize_ImageDim", namespace="dipa", id=self.job_id)
         self.files = {}
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputfile = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0]
+            inputfile = source_index[source_id]
         else:
             inputfile = "{0}-{1}_template.nii.gz".format(source_tier, source_id)
         if template == None:
@@ -292,12 +929,12 @@ class normalize_ImageDim(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_CreateTemplate(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, transferflag, template=None):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, transferflag, template=None, dimension_files=None, engine="dtitk"):
         self.job_id = subset_id+"_Normalize_CreateTemplate"
         self.pegasus_job = Job(name="Normalize_CreateTemplate", namespace="dipa", id=self.job_id)
         self.files = {}
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
 
         if template == None:
             args = ["--lookupfile", "{0}_dimension_files.csv".format(template_id),
@@ -307,7 +944,7 @@ class normalize_CreateTemplate(object):
                     "--isovsizefile", "{0}_template_iso_vsize.txt".format(template_id),
                     "--dimsizefile", "{0}_template_dim.txt".format(template_id),
                     "--orig", "{0}_initial_template_orig.nii.gz".format(template_id),
-                    "--initial", "{0}_initial_template.nii.gz".format(template_id)]
+                    "--initial", "{0}_initial_template.nii.gz".format(template_id)] + mean_engine_args(engine)
 
             input_files = ["{0}_dimension_files.csv".format(template_id),
                            "{0}_initial_template_input.txt".format(template_id)]
@@ -340,7 +977,7 @@ class normalize_CreateTemplate(object):
         self.pegasus_job.addArguments(*args)
 
         if source_tier == "ID":
-            spd_inputs = list(matrix[matrix[template_tier] == template_id]["SPD"])
+            spd_inputs = list(source_index.values())
         else:
             spd_inputs = []
             for source_id in source_ids:
@@ -349,16 +986,16 @@ class normalize_CreateTemplate(object):
         if template == None:
             initial_template_input_text = "\n".join(spd_inputs)+"\n"
             input_files.extend(spd_inputs)
-            input_csv_contents = matrix[[source_tier]]
-            files = input_csv_contents[source_tier].apply(lambda row: "{0}_dimensions.csv".format(row))
-            ids = input_csv_contents[source_tier]
-            contents = pandas.DataFrame({"ID":ids, "FILE":files}).drop_duplicates()
+            if dimension_files == None:
+                files = ["{0}_dimensions.csv".format(source_id) for source_id in source_ids]
+            else:
+                files = [dimension_files[source_id] for source_id in source_ids]
+            contents = pandas.DataFrame({"ID":source_ids, "FILE":files})
             input_csv_text = contents.to_csv(columns=["ID","FILE"], index=False)
 
             self.files["{0}_initial_template_input.txt".format(template_id)] = initial_template_input_text
             self.files["{0}_dimension_files.csv".format(template_id)] = input_csv_text
-            for source_id in source_ids:
-                input_files.append("{0}_dimensions.csv".format(source_id))
+            input_files.extend(files)
 
         else:
             self.files["{0}_dimension_files.csv".format(template_id)] = "ID,FILE\n{0},{0}_dimensions.csv".format(template_id)
@@ -369,15 +1006,18 @@ class normalize_CreateTemplate(object):
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
 class normalize_RigidWarp(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, sepcoarse, hierarchy, matrix, transferflag, template=None):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, sepcoarse, hierarchy, source_index, transferflag, template=None, downsample=1):
         self.job_id = subset_id+"_Normalize_RigidWarp_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_RigidWarp", namespace="dipa", id=self.job_id)
         self.files = {}
         sep=sepcoarse
+        #A downsampled image is sampled as sparsely, in voxels, as the full resolution one would be.
+        if downsample > 1:
+            sep = str(float(sepcoarse) * downsample)
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputfile = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0]
+            inputfile = source_index[source_id]
         else:
             inputfile = "{0}-{1}_template.nii.gz".format(source_tier, source_id)
 
@@ -406,7 +1046,10 @@ class normalize_RigidWarp(object):
             args.extend(["--initial","True"])
         else:
             args.extend(["--aff",inputbase+"_ri{0}.aff".format(iteration-1)])
+        if downsample > 1:
+            args.extend(["--downsample", str(downsample)])
 
+        self.output_files = outputfiles
         for inputfile in inputfiles:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
         for outputfile in outputfiles:
@@ -415,7 +1058,7 @@ class normalize_RigidWarp(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_RigidMean(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, iteration, smoption, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, iteration, smoption, transferflag, reducer=None, engine="dtitk"):
         self.job_id = subset_id+"_Normalize_RigidMean_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_RigidMean", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -426,40 +1069,48 @@ class normalize_RigidMean(object):
 
         self.pegasus_job.addArguments(*args)
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
 
         aff_image_files = []
         for source_id in source_ids:
             if source_tier == hierarchy[-1]:
-                inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+                inputbase = source_index[source_id].split(".")[0]
 
             else:
                 inputbase = "{0}-{1}_template".format(source_tier, source_id)
             aff_image_files.append(inputbase + "_ri{0}_aff.nii.gz".format(iteration))
 
 
+        partials = reducer([(aff_image_files, "{0}_mean_rigid{1}.nii.gz".format(template_id, iteration))]) if reducer != None else None
+        if partials != None:
+            aff_image_files = [partial_file for partial_file, weight in partials[0]]
+        self.pegasus_job.addArguments(*mean_engine_args(engine, partials))
+
         input_files = ["{0}_rigid_i{1}_template_input.txt".format(template_id, iteration)] + aff_image_files
 
         output_files = ["{0}_mean_rigid{1}.nii.gz".format(template_id, iteration)]
 
-        rigid_template_input_text = "\n".join(aff_image_files)+"\n"
+        rigid_template_input_text = input_list_text(aff_image_files, partials[0] if partials != None else None)
 
         self.files["{0}_rigid_i{1}_template_input.txt".format(template_id, iteration)] = rigid_template_input_text
 
+        self.output_files = output_files
         for inputfile in input_files:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for inputfile in retained_inputs(reducer):
+            self.pegasus_job.uses(inputfile, link=Link.INPUT, optional=True)
         for outputfile in output_files:
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
 class normalize_AffineWarpA(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, sepcoarse, hierarchy, matrix, template, rigid, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, sepcoarse, hierarchy, source_index, template, rigid, transferflag, downsample=1, fold=False):
         self.job_id = subset_id+"_Normalize_AffineWarpA_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_AffineWarpA", namespace="dipa", id=self.job_id)
         self.files = {}
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputfile = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0]
+            inputfile = source_index[source_id]
         else:
             inputfile = "{0}-{1}_template.nii.gz".format(source_tier, source_id)
 
@@ -468,6 +1119,11 @@ class normalize_AffineWarpA(object):
             template_image = "{0}_mean_rigid{1}.nii.gz".format(template_id, rigid)
             previous_iter = ["{0}_ri{1}_aff.nii.gz".format(inputbase, rigid),
                              "{0}_ri{1}.aff".format(inputbase, rigid)]
+        elif fold:
+            #The previous iteration's correction (its inverse average affine) is applied here, rather than by AffineWarpB.
+            template_image = "{0}_mean_affine{1}.nii.gz".format(template_id, iteration-1)
+            previous_iter = ["{0}_inv{1}.aff".format(template_id, iteration-1),
+                             "{0}_ai{1}a.aff".format(inputbase, iteration-1)]
         else:
             template_image = "{0}_mean_affine{1}.nii.gz".format(template_id, iteration-1)
             previous_iter = ["{0}_ai{1}b_aff.nii.gz".format(inputbase, iteration-1),
@@ -480,6 +1136,10 @@ class normalize_AffineWarpA(object):
         outputfiles = ["{0}_ai{1}a_aff.nii.gz".format(inputbase, iteration),
                        "{0}_ai{1}a.aff".format(inputbase, iteration)]
 
+        #A downsampled image is sampled as sparsely, in voxels, as the full resolution one would be.
+        if downsample > 1:
+            sepcoarse = str(float(sepcoarse) * downsample)
+
         args = ["--mean", template_image,
                 "--image", inputfile,
                 "--aff", previous_iter[1],
@@ -487,7 +1147,12 @@ class normalize_AffineWarpA(object):
                 "--outaff", "{0}_ai{1}a.aff".format(inputbase, iteration),
                 "--smoption", smoption,
                 "--sepcoarse", sepcoarse]
+        if fold and iteration > 1:
+            args.extend(["--invaff", previous_iter[0]])
+        if downsample > 1:
+            args.extend(["--downsample", str(downsample)])
 
+        self.output_files = outputfiles
         for inputfile in inputfiles:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
         for outputfile in outputfiles:
@@ -496,7 +1161,7 @@ class normalize_AffineWarpA(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_AffineMeanA(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, iteration, rigid, smoption, template, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, iteration, rigid, smoption, template, transferflag):
         self.job_id = subset_id+"_Normalize_AffineMeanA_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_AffineMeanA", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -515,12 +1180,12 @@ class normalize_AffineMeanA(object):
 
         self.pegasus_job.addArguments(*args)
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
 
         aff_files = []
         for source_id in source_ids:
             if source_tier == hierarchy[-1]:
-                inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+                inputbase = source_index[source_id].split(".")[0]
             else:
                 inputbase = "{0}-{1}_template".format(source_tier, source_id)
             aff_files.append(inputbase + "_ai{0}a.aff".format(iteration))
@@ -533,20 +1198,21 @@ class normalize_AffineMeanA(object):
 
         self.files["{0}_inv_affine_i{1}_input.txt".format(template_id, iteration)] = inv_template_input_text
 
+        self.output_files = output_files
         for inputfile in input_files:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
         for outputfile in output_files:
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
 class normalize_AffineWarpB(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, template, sepcoarse, rigid, hierarchy, matrix, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, smoption, template, sepcoarse, rigid, hierarchy, source_index, transferflag):
         self.job_id = subset_id+"_Normalize_AffineWarpB_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_AffineWarpB", namespace="dipa", id=self.job_id)
         self.files = {}
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+            inputbase = source_index[source_id].split(".")[0]
         else:
             inputbase = "{0}-{1}_template".format(source_tier, source_id)
         inputfile = inputbase+".nii.gz"
@@ -574,6 +1240,7 @@ class normalize_AffineWarpB(object):
                 "--outaffimage", "{0}_ai{1}b_aff.nii.gz".format(inputbase, iteration),
                 "--outaff", "{0}_ai{1}b.aff".format(inputbase, iteration)]
 
+        self.output_files = outputfiles
         for inputfile in inputfiles:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
         for outputfile in outputfiles:
@@ -582,23 +1249,27 @@ class normalize_AffineWarpB(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_AffineMeanB(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, iteration, smoption, template, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, iteration, smoption, template, transferflag, reducer=None, engine="dtitk"):
         self.job_id = subset_id+"_Normalize_AffineMeanB_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_AffineMeanB", namespace="dipa", id=self.job_id)
         self.files = {}
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
 
         aff_files = []
         if template == None:
             for source_id in source_ids:
                 if source_tier == hierarchy[-1]:
-                    inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+                    inputbase = source_index[source_id].split(".")[0]
                 else:
                     inputbase = "{0}-{1}_template".format(source_tier, source_id)
                 aff_files.append(inputbase + "_ai{0}b_aff.nii.gz".format(iteration))
 
-            aff_template_input_text = "\n".join(aff_files)+"\n"
+            partials = reducer([(aff_files, "{0}_mean_affine{1}.nii.gz".format(template_id, iteration))]) if reducer != None else None
+            if partials != None:
+                aff_files = [partial_file for partial_file, weight in partials[0]]
+            self.pegasus_job.addArguments(*mean_engine_args(engine, partials))
+            aff_template_input_text = input_list_text(aff_files, partials[0] if partials != None else None)
             self.files["{0}_affine_i{1}_template_input.txt".format(template_id, iteration)] = aff_template_input_text
 
         if template == None:
@@ -620,20 +1291,109 @@ class normalize_AffineMeanB(object):
 
         self.pegasus_job.addArguments(*args)
 
+        self.output_files = output_files
         for inputfile in input_files:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for inputfile in retained_inputs(reducer):
+            self.pegasus_job.uses(inputfile, link=Link.INPUT, optional=True)
         for outputfile in output_files:
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
+class normalize_AffineMean(object):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, iteration, rigid, transferflag, reducer=None, engine="dtitk"):
+        self.job_id = subset_id+"_Normalize_AffineMean_i{0}".format(iteration)
+        self.pegasus_job = Job(name="Normalize_AffineMean", namespace="dipa", id=self.job_id)
+        self.files = {}
+
+        if iteration == 1:
+            template_image = "{0}_mean_rigid{1}.nii.gz".format(template_id, rigid)
+        else:
+            template_image = "{0}_mean_affine{1}.nii.gz".format(template_id, iteration-1)
+
+        inv_input_list_file = "{0}_inv_affine_i{1}_input.txt".format(template_id, iteration)
+        aff_input_list_file = "{0}_affine_i{1}_template_input.txt".format(template_id, iteration)
+        mean_file = "{0}_mean_affine{1}.nii.gz".format(template_id, iteration)
+
+        args = ["--invlist", inv_input_list_file,
+                "--mean", template_image,
+                "--invaff", "{0}_inv{1}.aff".format(template_id, iteration),
+                "--affinelist", aff_input_list_file,
+                "--newmean", mean_file,
+                "--trace", "{0}_mean_affine{1}_tr.nii.gz".format(template_id, iteration),
+                "--mask", "{0}_mean_affine{1}_mask.nii.gz".format(template_id, iteration)]
+
+        self.pegasus_job.addArguments(*args)
+
+        source_ids = list(source_index.keys())
+
+        inv_files = []
+        aff_files = []
+        for source_id in source_ids:
+            if source_tier == hierarchy[-1]:
+                inputbase = source_index[source_id].split(".")[0]
+            else:
+                inputbase = "{0}-{1}_template".format(source_tier, source_id)
+            inv_files.append(inputbase + "_ai{0}a.aff".format(iteration))
+            aff_files.append(inputbase + "_ai{0}a_aff.nii.gz".format(iteration))
+
+        #The subjects are averaged before the inverse average affine is applied, to their mean.
+        partials = reducer([(aff_files, mean_file)]) if reducer != None else None
+        if partials != None:
+            aff_files = [partial_file for partial_file, weight in partials[0]]
+        self.pegasus_job.addArguments(*mean_engine_args(engine, partials))
+
+        self.files[inv_input_list_file] = "\n".join(inv_files)+"\n"
+        self.files[aff_input_list_file] = input_list_text(aff_files, partials[0] if partials != None else None)
+
+        input_files = [inv_input_list_file, aff_input_list_file, template_image] + inv_files + aff_files
+        output_files = ["{0}_inv{1}.aff".format(template_id, iteration),
+                        mean_file,
+                        "{0}_mean_affine{1}_tr.nii.gz".format(template_id, iteration),
+                        "{0}_mean_affine{1}_mask.nii.gz".format(template_id, iteration)]
+
+        self.output_files = output_files
+        for inputfile in input_files:
+            self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for inputfile in retained_inputs(reducer):
+            self.pegasus_job.uses(inputfile, link=Link.INPUT, optional=True)
+        for outputfile in output_files:
+            self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
+
+class normalize_TemplateChange(object):
+    def __init__(self, subset_id, template_id, stage, iteration, tolerance, transferflag, converged=None):
+        self.job_id = subset_id+"_Normalize_TemplateChange_{0}{1}".format(stage, iteration)
+        self.pegasus_job = Job(name="Normalize_TemplateChange", namespace="dipa", id=self.job_id)
+        self.files = {}
+
+        previous_image = "{0}_mean_{1}{2}.nii.gz".format(template_id, stage, iteration-1)
+        current_image = "{0}_mean_{1}{2}.nii.gz".format(template_id, stage, iteration)
+        self.converged_file = "{0}_{1}{2}_change.txt".format(template_id, stage, iteration)
+
+        args = ["--previous", previous_image,
+                "--current", current_image,
+                "--tolerance", str(tolerance),
+                "--output", self.converged_file]
+        input_files = [previous_image, current_image]
+        if converged != None:
+            #Once an iteration has converged, so have the ones after it.
+            args.extend(["--converged", converged])
+            input_files.append(converged)
+
+        self.pegasus_job.addArguments(*args)
+
+        for inputfile in input_files:
+            self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        self.pegasus_job.uses(self.converged_file, link=Link.OUTPUT, transfer=transferflag)
+
 class normalize_DiffeomorphicWarp(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, affine, hierarchy, matrix, transferflag, template=None):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, iteration, affine, hierarchy, source_index, transferflag, template=None, warm=False):
         self.job_id = subset_id+"_Normalize_DiffeomorphicWarp_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_DiffeomorphicWarp", namespace="dipa", id=self.job_id)
         self.files = {}
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+            inputbase = source_index[source_id].split(".")[0]
         else:
             inputbase = "{0}-{1}_template".format(source_tier, source_id)
         inputfile = inputbase+"_ai{0}b_aff.nii.gz".format(affine)
@@ -648,7 +1408,7 @@ class normalize_DiffeomorphicWarp(object):
             template_image = "{0}_mean_diffeomorphic{1}.nii.gz".format(template_id, iteration-1)
             template_mask_image = "{0}_mean_affine{1}_mask.nii.gz".format(template_id, affine)
 
-        inputfiles = [inputfile, template_image]
+        inputfiles = [inputfile, template_image, template_mask_image]
         out_image = "{0}_di{1}.nii.gz".format(inputbase, iteration)
         out_df = "{0}_di{1}.df.nii.gz".format(inputbase, iteration)
         outputfiles = [out_image, out_df]
@@ -658,6 +1418,12 @@ class normalize_DiffeomorphicWarp(object):
                 "--outimage", out_image,
                 "--outdf", out_df,
                 "--iterations", str(iteration)]
+        if warm and iteration > 1:
+            #Start from the previous iteration's field, and the image as it warped it.
+            previous_image = "{0}_di{1}.nii.gz".format(inputbase, iteration-1)
+            previous_df = "{0}_di{1}.df.nii.gz".format(inputbase, iteration-1)
+            inputfiles.extend([previous_image, previous_df])
+            args.extend(["--initimage", previous_image, "--initdf", previous_df])
 
         for inputfile in inputfiles:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
@@ -667,7 +1433,7 @@ class normalize_DiffeomorphicWarp(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_DiffeomorphicMean(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, iteration, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, iteration, transferflag, reducer=None, engine="dtitk"):
         self.job_id = subset_id+"_Normalize_DiffeomorphicMean_i{0}".format(iteration)
         self.pegasus_job = Job(name="Normalize_DiffeomorphicMean", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -688,36 +1454,44 @@ class normalize_DiffeomorphicMean(object):
 
         self.pegasus_job.addArguments(*args)
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
 
         diffeo_files = []
         df_files = []
         for source_id in source_ids:
             if source_tier == hierarchy[-1]:
-                inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+                inputbase = source_index[source_id].split(".")[0]
 
             else:
                 inputbase = "{0}-{1}_template".format(source_tier, source_id)
             diffeo_files.append("{0}_di{1}.nii.gz".format(inputbase, iteration))
             df_files.append("{0}_di{1}.df.nii.gz".format(inputbase, iteration))
 
+        partials = reducer([(diffeo_files, template_image), (df_files, df_image)]) if reducer != None else None
+        if partials != None:
+            diffeo_files = [partial_file for partial_file, weight in partials[0]]
+            df_files = [partial_file for partial_file, weight in partials[1]]
+        self.pegasus_job.addArguments(*mean_engine_args(engine, partials))
+
         input_files = [diffeo_input_list_file, df_input_list_file] + diffeo_files + df_files
 
         output_files = [template_image, df_image, invdf_image]
 
-        diffeo_input_text = "\n".join(diffeo_files)+"\n"
-        df_input_text = "\n".join(df_files)+"\n"
+        diffeo_input_text = input_list_text(diffeo_files, partials[0] if partials != None else None)
+        df_input_text = input_list_text(df_files, partials[1] if partials != None else None)
 
         self.files[diffeo_input_list_file] = diffeo_input_text
         self.files[df_input_list_file] = df_input_text
 
         for inputfile in input_files:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for inputfile in retained_inputs(reducer):
+            self.pegasus_job.uses(inputfile, link=Link.INPUT, optional=True)
         for outputfile in output_files:
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
 class normalize_ComposeWarp(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, affine, diffeomorphic, hierarchy, matrix, transferflag, template=None):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, source_id, affine, diffeomorphic, hierarchy, source_index, transferflag, template=None):
         self.job_id = subset_id+"_Normalize_ComposeWarp"
         self.pegasus_job = Job(name="Normalize_ComposeWarp", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -730,7 +1504,7 @@ class normalize_ComposeWarp(object):
         #Check to see if this is the basic level of the normalization.
         #If so, use the SPD specified. Otherwise, input is the output of a previous step.
         if source_tier == hierarchy[-1]:
-            inputbase = list(matrix[matrix[template_tier] == template_id][matrix[source_tier] == source_id]["SPD"])[0].split(".")[0]
+            inputbase = source_index[source_id].split(".")[0]
         else:
             inputbase = "{0}-{1}_template".format(source_tier, source_id)
         imagefile = inputbase+".nii.gz"
@@ -738,7 +1512,7 @@ class normalize_ComposeWarp(object):
         df_file = inputbase+"_di{0}.df.nii.gz".format(diffeomorphic)
 
         if template != None:
-            template_image = "{0}_template.nii.gz".format(template_id)
+            template_image = template
         else:
             template_image = "{0}_mean_diffeomorphic{1}.nii.gz".format(template_id, diffeomorphic)
 
@@ -746,6 +1520,7 @@ class normalize_ComposeWarp(object):
 
         inputfiles = [imagefile, template_image, aff_file, df_file, iso_vsize_file]
         outputfiles = [composed_file, invcomposed_file, warped_file, isowarped_file]
+        self.output_files = outputfiles
         args = ["--image", imagefile,
                 "--mean", template_image,
                 "--aff", aff_file,
@@ -764,7 +1539,7 @@ class normalize_ComposeWarp(object):
         self.pegasus_job.addArguments(*args)
 
 class normalize_ComposeMean(object):
-    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, matrix, template, transferflag):
+    def __init__(self, subset_id, template_tier, source_tier, template_id, hierarchy, source_index, template, transferflag, reducer=None, engine="dtitk"):
         self.job_id = subset_id+"_Normalize_ComposeMean"
         self.pegasus_job = Job(name="Normalize_ComposeMean", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -804,20 +1579,27 @@ class normalize_ComposeMean(object):
 
         self.pegasus_job.addArguments(*args)
 
-        source_ids = list(matrix[matrix[template_tier] == template_id][source_tier].unique())
+        source_ids = list(source_index.keys())
         if template == None:
             input_image_files = []
             input_iso_image_files = []
             for source_id in source_ids:
                 input_image_files.append("{0}-{1}_{2}-{3}_composed.nii.gz".format(template_tier, template_id, source_tier, source_id))
                 input_iso_image_files.append("{0}-{1}_{2}-{3}_composed_iso.nii.gz".format(template_tier, template_id, source_tier, source_id))
+            partials = reducer([(input_image_files, final_mean_file), (input_iso_image_files, final_isomean_file)]) if reducer != None else None
+            if partials != None:
+                input_image_files = [partial_file for partial_file, weight in partials[0]]
+                input_iso_image_files = [partial_file for partial_file, weight in partials[1]]
+            self.pegasus_job.addArguments(*mean_engine_args(engine, partials))
             input_files.extend(input_image_files + input_iso_image_files)
-            self.files[compose_input_list_file] = "\n".join(input_image_files)+"\n"
-            self.files[compose_iso_input_list_file] = "\n".join(input_iso_image_files)+"\n"
+            self.files[compose_input_list_file] = input_list_text(input_image_files, partials[0] if partials != None else None)
+            self.files[compose_iso_input_list_file] = input_list_text(input_iso_image_files, partials[1] if partials != None else None)
 
 
         for inputfile in input_files:
             self.pegasus_job.uses(inputfile, link=Link.INPUT)
+        for inputfile in retained_inputs(reducer):
+            self.pegasus_job.uses(inputfile, link=Link.INPUT, optional=True)
         for outputfile in output_files:
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=transferflag)
 
@@ -861,6 +1643,7 @@ class normalize_ComposeFullWarp(object):
                      "--outwarped", warped_file,
                      "--outisowarped", isowarped_file])
 
+        self.warp_files = warp_files
         input_files = warp_files + invwarp_files + [source_file, iso_vsize_file]
         output_files = [warped_file, isowarped_file, out_warp_file, out_invwarp_file]
 
@@ -28,8 +28,8 @@ class preprocess(Component):
                                is_shelled=True, multishelled=True, mask_median_radius=4, mask_numpass=4,
                                topup=False, eddy_flm="quadratic", eddy_slm="none", eddy_fwhm=0,
                                eddy_niters=5, eddy_fep=False, eddy_resample='jac', eddy_nvoxhp=1000, eddy_ff=10.0,
-                               eddy_no_sep_offs=False, eddy_dont_peas=False, transferflag=True):
-        Component.__init__(self, matrix, hierarchy, name, transferflag)
+                               eddy_no_sep_offs=False, eddy_dont_peas=False, transferflag=True, clusterer=None):
+        Component.__init__(self, matrix, hierarchy, name, transferflag, clusterer)
 
         self.correct_type = correct_type
         self.fit_type = fit_type
@@ -97,12 +97,13 @@ class preprocess(Component):
         return args
 
     def add_to_dax(self, dax, progress):
-        for full_id in list(self.matrix["FULL"]):
+        for full_id, source_id in zip(self.matrix["FULL"], self.matrix["ID"]):
             #Eddy Correction
             if self.correct_type == "eddy":
                 eddy_job = Preprocess_Eddy(full_id, self.topup, self.flm, self.slm, self.fwhm, self.niters, self.fep, self.interp, self.resample, self.nvoxhp, self.ff, self.no_sep_offs, self.dont_peas, self.transferflag)
             else:
                 eddy_job = Preprocess_EddyCorrect(full_id, self.interp, self.transferflag)
+            self.__cluster__(eddy_job, "ID")
             dax.addJob(eddy_job.pegasus_job)
             self.files.update(eddy_job.files)
             progress.increment()
@@ -110,17 +111,19 @@ class preprocess(Component):
             #Orientation Checking
             if self.orient_check:
                 orient_check_job = Preprocess_OrientationCheck(full_id, self.transferflag)
+                self.__cluster__(orient_check_job, "ID")
                 dax.addJob(orient_check_job.pegasus_job)
                 dax.depends(parent=eddy_job.pegasus_job, child=orient_check_job.pegasus_job)
                 self.files.update(orient_check_job.files)
                 progress.increment()
 
             if self.fit_type == 'dipy':
-                fit_job = Preprocess_Fit_Dipy(full_id, self.multishelled, self.fit_method, self.transferflag)
+                fit_job = Preprocess_Fit_Dipy(full_id, self.multishelled, self.fit_method, self.transferflag, dim_id=source_id)
             elif self.fit_type == 'camino':
                 fit_job = Preprocess_Fit_Camino(full_id, self.fit_method)
             else:
                 progress.add_warning(Notice("Error", "Please choose from dipy or camino for fit_type for now."))
+            self.__cluster__(fit_job, "ID")
             dax.addJob(fit_job.pegasus_job)
             self.files.update(fit_job.files)
             dax.depends(parent=eddy_job.pegasus_job, child=fit_job.pegasus_job)
@@ -263,8 +266,8 @@ class Preprocess_OrientationCheck(object):
             self.pegasus_job.uses(outputfile, link=Link.OUTPUT, transfer=True)
 
 class Preprocess_Fit_Dipy(object):
-    "A quick dipy-based tool to fit data."
-    def __init__(self, subset_id, multishelled, fitmethod, transferflag):
+    "A quick dipy-based tool to fit data. Also writes the SPD's dimensions record for normalization."
+    def __init__(self, subset_id, multishelled, fitmethod, transferflag, dim_id=None):
         self.job_id = subset_id+"_Preprocess_Fit"
         self.pegasus_job = Job(name="Preprocess_Fit_Dipy", namespace="dipa", id=self.job_id)
         self.files = {}
@@ -285,6 +288,7 @@ class Preprocess_Fit_Dipy(object):
         outmk = subset_id+"_mk.nii.gz"
         outrk = subset_id+"_rk.nii.gz"
         outak = subset_id+"_ak.nii.gz"
+        outdim = subset_id+"_dimensions.csv"
 
         args = [
         "--image", imageinputfile,
@@ -298,11 +302,13 @@ class Preprocess_Fit_Dipy(object):
         "--out_md", outmd,
         "--out_rd", outrd,
         "--out_ad", outad,
-        "--fit_method", fitmethod
+        "--fit_method", fitmethod,
+        "--out_dim", outdim,
+        "--dim_id", str(subset_id if dim_id == None else dim_id)
         ]
 
         input_files = [imageinputfile, bvecsinputfile, bvalsinputfile]
-        output_files = [outspd,outresidual,outnoise,outsnr,outfa,outmd,outrd,outad]
+        output_files = [outspd,outresidual,outnoise,outsnr,outfa,outmd,outrd,outad,outdim]
 
         if multishelled:
             args.extend([
@@ -5,14 +5,10 @@ import sys
 import os
 import shutil
 import subprocess
-import pandas
 import csv
 import json
 from docopt import docopt
-from components.normalize import normalize
-from components.preprocess import preprocess
 from utility.console import Console, Notice, Progress
-from utility.parse import matrixparser
 
 __version__ = "0.3b"
 __doc__ = """Diffusion Image Processing and Analysis. v{0}
@@ -36,6 +32,18 @@ Options:
      -k --keep_files                 Keep intermediate files. [default: False]
      -n <str> --name <str>           Add a custom name for the project. [default: Project]
      --verbosity <str>               Specify verbosity from ('log', 'alert', 'warning', 'error'). [default: log]
+     --reuse <bool>                  Prune jobs whose outputs from a previous run are still valid. [default: True]
+     --preflight <bool>              Check every input file before planning, and reject rows with missing or inconsistent files. [default: True]
+     --stage_mode <mode>             Stage source files by 'copy', 'symlink', or 'catalog' (register them in place). [default: copy]
+     --stage_width <int>             Number of threads copying source files into the project. [default: 4]
+     --cluster                       Cluster short jobs, with sizes set per transformation by "clusters.size" in conf/tc.text. [default: False]
+     --dry_run                       Plan the workflow without Pegasus and print its graph statistics, without staging inputs or submitting. [default: False]
+     --slots <list>                  (Dry run) Comma separated slot counts to simulate the makespan on. [default: 100]
+     --pool_memory <mb>              (Dry run) Memory (MB) shared by the simulated slots. [default: None]
+     --job_priority <bool>           Prioritize jobs by their estimated longest path to the end of the workflow. [default: True]
+     --cost_model <path>             Per-transformation runtime and memory estimates, for job priorities and dry runs. [default: conf/cost_model.json]
+     --kickstart <path>              (Dry run) Submit directory of a previous run, to learn runtimes and memory from its kickstart records. [default: None]
+     --stream_dax                    Write jobs to the DAX as they are planned, instead of holding the whole workflow in memory. [default: False]
      --correct_type <str>            (Preprocess) Select 'eddy' or 'eddy_correct'. [default: eddy]
      --correct_topup                 (Preprocess) Use topup, and feed this into eddy. [default: False]
      --correct_eddy_flm <str>        (Preprocess) First level EC model for eddy ('linear','quatratic', or 'cubic'). [default: quadratic]
@@ -62,7 +70,21 @@ Options:
      --rigid <rigidcount>            (Normalization) Number of rigid iterations. [default: 3]
      --affine <affinecount>          (Normalization) Number of affine iterations. [default: 3]
      --diffeo <diffeocount>          (Normalization) Number of diffeomorphic iterations. [default: 6]
+     --mean_fanin <int>              (Normalization) Average groups of more sources than this through partial means of at most this many (0 disables). [default: 0]
+     --mean_engine <engine>          (Normalization) Compute group means with 'dtitk' (TVMean/VVMean), 'native' (tensormean.py) or 'log_euclidean' (tensormean.py, log-Euclidean tensor means). [default: dtitk]
+     --pipelined_means <bool>        (Normalization) Accumulate each group mean while its warps run, rather than after them. Needs a shared filesystem. [default: False]
+     --mean_quorum <percent>         (Normalization) Build the rigid and diffeomorphic group means from the first this percent of subjects to finish their warps (pipelines means). [default: 100]
+     --template_tolerance <float>    (Normalization) Stop rigid and affine iterations early, once the template changes by at most this fraction in one (0 runs them all). [default: 0]
+     --fused_registration <bool>     (Normalization) With --template, run each subject's warps as two jobs on node-local scratch, either side of the affine mean. [default: False]
+     --pyramid_factor <int>          (Normalization) Register every rigid iteration, and the affine ones but the last, on images downsampled by this factor (1 disables). [default: 1]
+     --warm_diffeo <bool>            (Normalization) Start each diffeomorphic iteration after the first from the previous one's deformation field, registering only its own level. [default: False]
+     --single_affine_barrier <bool>  (Normalization) Without --template, give each affine iteration one group mean, which applies the inverse average affine to the mean rather than to each subject. [default: False]
+     --template_subset <int>         (Normalization) Build the template of each group of more subjects than this from this many of them, then register the rest to it (0 uses them all). [default: 0]
+     --template_strata <columns>     (Normalization) Comma separated spreadsheet columns to stratify the template subset by. [default: None]
      --tier <level>                  (Normalization) Normalize Hierarchichally. Repeat as needed in order of increasing specificity [default: PROJECT]
+     --auto_tiers <method>           (Normalization) Add tiers above ID, grouping subjects by 'random' (a hash of the ID), 'site' (--site_column) or 'dims' (DWI dimensions and voxel size). [default: None]
+     --max_group <int>               (Normalization) With --auto_tiers, the most sources of any group. [default: 0]
+     --site_column <column>          (Normalization) Spreadsheet column of the sites, for --auto_tiers site. [default: SITE]
      --export_style <style>          (ROI Extraction) Specify 'long', 'wide' or 'both' [default: long]
 """.format(__version__)
 
@@ -73,22 +95,42 @@ __arg_mapping__ = {
  "--site": "Site",
  "--keep_files": "KeepFiles",
  "--verbosity": "Verbosity",
+ "--stream_dax": "StreamDax",
+ "--dry_run": "DryRun",
+ "--slots": "Slots",
+ "--pool_memory": "PoolMemory",
+ "--cost_model": "CostModel",
+ "--job_priority": "JobPriority",
+ "--kickstart": "Kickstart",
+ "--cluster": "Cluster",
+ "--reuse": "Reuse",
+ "--stage_width": "StageWidth",
+ "--stage_mode": "StageMode",
+ "--preflight": "Preflight",
  "--tier": "Hierarchy",
+ "--auto_tiers": "AutoTiers",
+ "--max_group": "MaxGroup",
+ "--site_column": "SiteColumn",
 }
 
-for component in [preprocess, normalize]:
-    __arg_mapping__.update(component.get_arg_mappings())
-
-pegasus_config = "pegasus-config --python-dump"
-config = subprocess.Popen(pegasus_config, stdout=subprocess.PIPE, shell=True).communicate()[0]
-exec config
-
-try:
-    from Pegasus.DAX3 import *
-except:
-    proto_console = Console()
-    proto_console.log(Notice("Error", "DIPA was unable to find your installation of Pegasus. Ensure you have Pegasus and HTCondor installed."))
-    sys.exit(1)
+def load_components(dry_run=False):
+    """
+    Imports Pegasus, pandas and the components, which are only needed once the arguments
+    have been parsed. Adds the components' options to __arg_mapping__.
+    A dry run plans against the Pegasus.DAX3 stand-in, so Pegasus need not be installed.
+    """
+    from utility.pegasusconfig import load_pegasus
+    if dry_run:
+        from utility import standin
+        standin.install()
+    elif not load_pegasus():
+        proto_console = Console()
+        proto_console.log(Notice("Error", "DIPA was unable to find your installation of Pegasus. Ensure you have Pegasus and HTCondor installed."))
+        sys.exit(1)
+    from components.normalize import normalize
+    from components.preprocess import preprocess
+    for component in [preprocess, normalize]:
+        __arg_mapping__.update(component.get_arg_mappings())
 
 def clean_path(path):
   if path.startswith("~"):
@@ -117,14 +159,37 @@ def read_json(jsonpath):
         sys.exit(1)
 
 
-def create_workflow(options, console):
+def create_workflow(options, console, manifest=None):
     """
-    This generates a dipa dax
+    This generates a dipa dax.
+    If a manifest is given, every job is recorded in it, along with the files it reads.
     """
+    import pandas
+    from Pegasus.DAX3 import ADAG
+    from components.normalize import normalize
+    from components.preprocess import preprocess
+    from utility.parse import matrixparser
+    from utility.staging import Stager
+    from utility.preflight import Preflight
+    from utility.daxwriter import StreamingADAG
+    from utility.cluster import Clusterer, read_cluster_sizes
+    from utility.graph import GraphStats
+    from utility.simulate import Simulator, read_cost_model, read_kickstart_records, learn_cost_model
+    from utility.priority import Prioritizer
+
     if options["ProjectName"] == "Project":
-        dax = ADAG( "DIPA")
+        dax_name = "DIPA"
+    else:
+        dax_name = "DIPA-"+options["ProjectName"]
+    if options["JobPriority"]:
+        prioritizer = Prioritizer(read_cost_model(options["CostModel"]))
+    else:
+        prioritizer = None
+    if options["StreamDax"]:
+        console.log(Notice("Log", "Streaming DAX to {0}".format(options["DaxFile"])))
+        dax = StreamingADAG(dax_name, options["DaxFile"], recorder=manifest.record if manifest != None else None, prioritizer=prioritizer)
     else:
-        dax = ADAG( "DIPA-"+options["ProjectName"])
+        dax = ADAG(dax_name)
     try:
         matrix = pandas.read_csv(clean_path(options["InputFile"]))
 
@@ -133,10 +198,22 @@ def create_workflow(options, console):
         sys.exit(1)
 
     console.log(Notice("Log", "Parsing input file."))
-    parser = matrixparser(matrix, options["Hierarchy"], name=options["ProjectName"], eddy_correction=options["CorrectType"], is_shelled=options["Shelled"], template=options["Template"])
+    parser = matrixparser(matrix, options["Hierarchy"], name=options["ProjectName"], eddy_correction=options["CorrectType"], is_shelled=options["Shelled"], template=options["Template"],
+                          auto_tiers=options["AutoTiers"], max_group=int(options["MaxGroup"]), site_column=options["SiteColumn"])
     for warning in parser.warnings:
         console.log(warning)
     if parser.is_valid:
+        if options["Preflight"] not in ["False", "false", False]:
+            preflight = Preflight(parser.matrix, eddy_correction=parser.eddy_correction)
+            progressbar = Progress(console, "Checking input files", count=len(preflight.tasks))
+            progressbar.start()
+            rejected = preflight.check(progressbar)
+            progressbar.close("Normal")
+            for notice in preflight.notices():
+                console.log(notice)
+            parser.reject(rejected)
+            if len(parser.matrix) == 0:
+                console.log(Notice("Error", "Every row of the input file was rejected."))
         matrix = parser.matrix
         options["Hierarchy"] = parser.hierarchy
         options["CorrectType"] = parser.eddy_correction
@@ -144,6 +221,13 @@ def create_workflow(options, console):
     else:
         sys.exit(1)
 
+    if options["Cluster"]:
+        cluster_sizes = read_cluster_sizes(options["ConfDir"]+"/tc.text")
+        console.log(Notice("Log", "Clustering jobs of {0}.".format(", ".join(["{0} ({1})".format(key, value) for key, value in sorted(cluster_sizes.items())]))))
+        clusterer = Clusterer(cluster_sizes)
+    else:
+        clusterer = None
+
     #Preprocessing
     console.log(Notice("Log", "Adding preprocessing to workflow."))
     #print(options)
@@ -152,7 +236,7 @@ def create_workflow(options, console):
                                                is_shelled=options["Shelled"], multishelled=options["Multishelled"], mask_median_radius=options["MaskMedianRadius"], mask_numpass=options["MaskNumpass"],
                                                topup=options["Topup"], eddy_flm=options["EddyFLM"], eddy_slm=options["EddySLM"], eddy_fwhm=options["EddyFWHM"],
                                                eddy_niters=options["EddyNiters"], eddy_fep=options["EddyFEP"], eddy_resample=options["EddyResample"], eddy_nvoxhp=options["EddyNvoxhp"], eddy_ff=options["EddyFF"],
-                                               eddy_no_sep_offs=options["EddyNoSepOffs"], eddy_dont_peas=options["EddyDontPeas"], transferflag=options["KeepFiles"])
+                                               eddy_no_sep_offs=options["EddyNoSepOffs"], eddy_dont_peas=options["EddyDontPeas"], transferflag=options["KeepFiles"], clusterer=clusterer)
     for message in preprocessing_section.messages:
         console.log(message)
     preprocessing_section.reset_messages()
@@ -172,7 +256,20 @@ def create_workflow(options, console):
                                           diffeomorphic=int(options["DiffeomorphicIterations"]),
                                           transferflag=options["KeepFiles"],
                                           similarity_metric=options["SimilarityMetric"],
-                                          species=options["Species"])
+                                          species=options["Species"],
+                                          clusterer=clusterer,
+                                          fit_dimensions=preprocessing_section.fit_type == "dipy",
+                                          mean_fanin=options["MeanFanin"],
+                                          mean_engine=options["MeanEngine"],
+                                          pipelined_means=options["PipelinedMeans"],
+                                          mean_quorum=options["MeanQuorum"],
+                                          template_tolerance=options["TemplateTolerance"],
+                                          fused_registration=options["FusedRegistration"],
+                                          pyramid_factor=options["PyramidFactor"],
+                                          warm_diffeomorphic=options["WarmDiffeomorphic"],
+                                          single_affine_barrier=options["SingleAffineBarrier"],
+                                          template_subset=int(options["TemplateSubset"]),
+                                          template_strata=options["TemplateStrata"])
     for message in normalize_section.messages:
         console.log(message)
     normalize_section.reset_messages()
@@ -188,23 +285,50 @@ def create_workflow(options, console):
     progressbar.start()
     for index, subset_id in enumerate(subset_ids):
         fit_job_id = "{0}_Preprocess_Fit".format(subset_id)
-        normalize_job_id = "{0}_Normalize_ImageDim".format(subset_id)
+        normalize_job_id = normalize_section.initial_step_ids[subset_id]
         dax.depends(parent=fit_job_id, child=normalize_job_id)
         progressbar.update(index+1)
     progressbar.close("Normal")
 
-    progressbar = Progress(console, "Copying source files.", count=len(parser.mappings))
-    progressbar.start()
-    for index, mapping in parser.mappings.iterrows():
-        try:
-            shutil.copyfile(mapping["SOURCE"], options["ProjectDir"]+"/input/"+mapping["DESTINATION"])
-            progressbar.update(index+1)
-        except:
-            progressbar.add_warning(Notice("Error", "Could not copy file {0} to {1}".format(mapping["SOURCE"], options["ProjectDir"]+"/input/"+mapping["DESTINATION"])))
-    progressbar.close("Normal")
+    if prioritizer != None and not options["StreamDax"]:
+        console.log(Notice("Log", "Prioritizing jobs by their critical path."))
+        prioritizer.apply(dax)
+
+    stager = Stager(parser.mappings, options["ProjectDir"]+"/input", width=options["StageWidth"], mode=options["StageMode"])
+    if options["DryRun"]:
+        stats = GraphStats(dax)
+        stats.add_sources(stager.sources, mode=options["StageMode"])
+        for line in stats.summary():
+            print(line)
+        model = read_cost_model(options["CostModel"])
+        if options["Kickstart"] != None:
+            records = read_kickstart_records(options["Kickstart"])
+            console.log(Notice("Log", "Learned runtimes of {0} transformations from {1} kickstart records.".format(len(records), sum([len(values) for values in records.values()]))))
+            model = learn_cost_model(model, records)
+        simulator = Simulator(dax, model)
+        results = [simulator.run(slots, options["PoolMemory"]) for slots in options["Slots"]]
+        for line in simulator.summary(results):
+            print(line)
+        return dax
+    if options["StageMode"] == "catalog":
+        console.log(stager.catalog(options["InputCache"], options["Site"]))
+    else:
+        progressbar = Progress(console, "Copying source files." if options["StageMode"] == "copy" else "Linking source files.", count=len(stager.sources))
+        progressbar.start()
+        summary = stager.stage(progressbar)
+        progressbar.close("Normal")
+        console.log(summary)
     print("Saving files.")
     normalize_section.save_files(options["ProjectDir"]+"/input/")
 
+    if manifest != None:
+        if not options["StreamDax"]:
+            for job in dax.jobs.values():
+                manifest.record(job)
+        manifest.add_sources(parser.mappings)
+        manifest.add_files(preprocessing_section.files)
+        manifest.add_files(normalize_section.files)
+
 
     return dax
 
@@ -218,6 +342,9 @@ def main():
 
     # Obtain command-line arguments
     arguments = docopt(__doc__, version='DIPA v{0}'.format(__version__))
+    load_components(dry_run=arguments["--dry_run"])
+    from utility.staging import Stager
+    from utility.reuse import OutputManifest
     options = {}
     for argument_flag, argument_value in __arg_mapping__.iteritems():
         options[argument_value] = arguments[argument_flag]
@@ -243,7 +370,18 @@ def main():
     options["DaxFile"] = options["ProjectDir"]+"/conf/master.dax"
     options["DotFile"] = options["ProjectDir"]+"/conf/master.dot"
     options["PDFFile"] = options["ProjectDir"]+"/conf/master.pdf"
-    options["ChangedDax"] = False
+    options["PreviousDax"] = None
+    options["Reuse"] = options["Reuse"] not in ["False", "false", False]
+    options["InputCache"] = options["ProjectDir"]+"/conf/inputs.cache"
+    options["JobPriority"] = options["JobPriority"] not in ["False", "false", False]
+    options["PipelinedMeans"] = options["PipelinedMeans"] not in ["False", "false", False]
+    options["FusedRegistration"] = options["FusedRegistration"] not in ["False", "false", False]
+    options["WarmDiffeomorphic"] = options["WarmDiffeomorphic"] not in ["False", "false", False]
+    options["SingleAffineBarrier"] = options["SingleAffineBarrier"] not in ["False", "false", False]
+    options["TemplateStrata"] = [] if options["TemplateStrata"] in ["None", None] else options["TemplateStrata"].split(",")
+    options["AutoTiers"] = None if options["AutoTiers"] in ["None", None] else options["AutoTiers"]
+    if options["StageMode"] not in Stager.modes:
+        console.log(Notice("Error", "--stage_mode must be one of {0}".format(", ".join(Stager.modes))))
     options["DipaDir"] = os.path.dirname(os.path.realpath(__file__))
     environment = dict(os.environ)
     jsonsettings = read_json(clean_path(options["DipaDir"]+"/conf/site_setup.json"))
@@ -256,6 +394,24 @@ def main():
     environment["ProjectDir"] = options["ProjectDir"]
     environment["DipaDir"] = options["DipaDir"]
 
+    if options["CostModel"] == "conf/cost_model.json":
+        options["CostModel"] = options["DipaDir"]+"/conf/cost_model.json"
+    else:
+        options["CostModel"] = os.path.abspath(options["CostModel"])
+    if not os.path.exists(options["CostModel"]):
+        console.log(Notice("Error", "Cost model '{0}' does not exist.".format(options["CostModel"])))
+
+    #A dry run only plans the workflow, leaving the project directory untouched.
+    if options["DryRun"]:
+        options["ConfDir"] = options["DipaDir"]+"/conf"
+        options["Slots"] = [int(slots) for slots in options["Slots"].split(",")]
+        options["PoolMemory"] = None if options["PoolMemory"] in ["None", None] else float(options["PoolMemory"])
+        options["Kickstart"] = None if options["Kickstart"] in ["None", None] else os.path.abspath(options["Kickstart"])
+        options["StreamDax"] = False
+        create_workflow(options, console)
+        return
+    options["ConfDir"] = options["ProjectDir"]+"/conf"
+
     #Create directories
     progressbar = Progress(console, "Setting up directories", count=4)
     progressbar.start()
@@ -273,30 +429,62 @@ def main():
     progressbar.close("Normal")
 
     if os.path.exists(options["ProjectDir"]+"/conf"):
-        if os.path.exists(options["ProjectDir"]+"/conf/input.csv"):
-            with open(options["ProjectDir"]+"/conf/input.csv") as f1:
-                with open(options["InputFile"]) as f2:
-                    if f1.read() == f2.read():
-                        options["ChangedDax"] = True
+        if os.path.exists(options["DaxFile"]):
+            with open(options["DaxFile"]) as f:
+                options["PreviousDax"] = f.read()
         shutil.rmtree(options["ProjectDir"]+"/conf")
     shutil.copytree(options["DipaDir"]+"/conf",options["ProjectDir"]+"/conf")
     shutil.copyfile(options["InputFile"], options["ProjectDir"]+"/conf/input.csv")
 
 
     #Create the DAX
-    dax = create_workflow(options, console)
+    if options["Reuse"]:
+        manifest = OutputManifest(options["ProjectDir"]+"/outputs")
+    else:
+        manifest = None
+    dax = create_workflow(options, console, manifest)
     console.log(Notice("Log", "Saving the workflow"))
-    with open( options["DaxFile"],"w" ) as f:
-        console.log(Notice("Log", "Writing DAX to {0}".format(options["DaxFile"])))
-        dax.writeXML(f)
+    if options["StreamDax"]:
+        console.log(Notice("Log", "Writing dependencies to {0}".format(options["DaxFile"])))
+        dax.close()
+    else:
+        with open( options["DaxFile"],"w" ) as f:
+            console.log(Notice("Log", "Writing DAX to {0}".format(options["DaxFile"])))
+            dax.writeXML(f)
 
-    #Run pegasus-plan with these settings.
+    #Resume the previous submission only if the workflow is unchanged. Otherwise re-plan,
+    #letting Pegasus prune the jobs whose outputs are still valid.
     os.chdir(options["ProjectDir"])
     console.log(Notice("Log", "Submitting the workflow"))
-    if os.listdir("{ProjectDir}/outputs".format(**options)) == [] or options["ChangedDax"] == True:
-        pegasus_command = "pegasus-plan --conf {ProjectDir}/conf/pegasusrc --sites {Site} --input-dir {ProjectDir}/input --output-site local --dir {ProjectDir}/working --relative-submit-dir ./condorsubmit --dax {DaxFile} --cleanup none --submit -vv".format(**options)
+    submit_dir = "{ProjectDir}/working/condorsubmit".format(**options)
+    #Sources that are linked or registered in place are symlinked into the jobs rather than copied.
+    if options["StageMode"] == "copy":
+        options["Properties"] = ""
+    else:
+        options["Properties"] = "-Dpegasus.transfer.links=true "
+    with open(options["DaxFile"]) as f:
+        unchanged_dax = options["PreviousDax"] == f.read()
+    if unchanged_dax and os.path.exists(submit_dir):
+        pegasus_command = "pegasus-run {0}".format(submit_dir)
     else:
-        pegasus_command = "pegasus-run {ProjectDir}/working/condorsubmit".format(**options)
+        if os.path.exists(submit_dir):
+            rotation = 1
+            while os.path.exists("{0}.{1:03d}".format(submit_dir, rotation)):
+                rotation += 1
+            console.log(Notice("Log", "Moving the previous submit directory to {0}.{1:03d}".format(submit_dir, rotation)))
+            os.rename(submit_dir, "{0}.{1:03d}".format(submit_dir, rotation))
+        pegasus_command = "pegasus-plan {Properties}--conf {ProjectDir}/conf/pegasusrc --sites {Site} --input-dir {ProjectDir}/input --output-site local --dir {ProjectDir}/working --relative-submit-dir ./condorsubmit --dax {DaxFile} --cleanup none --submit -vv".format(**options)
+        if options["Cluster"]:
+            pegasus_command += " --cluster label"
+        caches = []
+        if options["StageMode"] == "catalog":
+            caches.append(options["InputCache"])
+        if manifest != None:
+            reusable = manifest.update()
+            console.log(Notice("Log", "{0} outputs from previous runs can be reused.".format(reusable)))
+            caches.append(manifest.cachefile)
+        if len(caches) > 0:
+            pegasus_command += " --cache {0}".format(",".join(caches))
     pegasus_graphviz_command = "pegasus-graphviz {DaxFile} -o {DotFile} -s -l id".format(**options)
     dot_command = "dot -Tpdf {DotFile} -o {PDFFile}".format(**options)
     system_call(pegasus_command, environment)
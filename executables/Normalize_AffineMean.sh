@@ -0,0 +1,69 @@
+#!/bin/bash -e
+
+#Defaults:
+carry=()
+engine="dtitk"
+
+#Accept Arguments
+while [[ "$#" > 1 ]]; do case $1 in
+    --help) show_help="True";;
+    -h) show_help="True";;
+    --invlist) inv_list_file="$2";;
+    --mean) mean_file="$2";;
+    --invaff) inv_aff_file="$2";;
+    --affinelist) affine_list_file="$2";;
+    --newmean) new_mean_file="$2";;
+    --trace) tr_file="$2";;
+    --mask) mask_file="$2";;
+    --engine) engine="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
+    *);;
+  esac; shift
+done
+
+if [[ "${show_help}" == "True" ]] ; then
+  echo "Normalize_AffineMean"
+  echo "Usage: "
+  echo "    Normalize_AffineMean.sh [options] --invlist <FILE> --mean <FILE> --invaff <FILE> --affinelist <FILE> --newmean <FILE> --trace <FILE> --mask <FILE>"
+  exit 0
+fi
+
+#Environmental variable checking
+if [ x${DTITK_ROOT} == x ] ; then
+    echo "DTITK_ROOT is not set "
+fi
+
+
+if [ x${EXECUTABLE_DIR} == x ] ; then
+    echo "EXECUTABLE_DIR is not set "
+fi
+
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
+#Source dtitk_common.sh
+source ${DTITK_ROOT}/scripts/dtitk_common.sh
+
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
+#The inverse of the group's average affine, as in Normalize_AffineMeanA
+${DTITK_ROOT}/bin/affine3DShapeAverage ${inv_list_file} ${mean_file} ${inv_aff_file} 1
+
+#Average the subjects as registered, then apply the inverse average affine to their mean once,
+#rather than to each subject (Normalize_AffineWarpB) before averaging them.
+uncorrected_mean_file="${new_mean_file%%.*}_uncorrected.nii.gz"
+if [[ $engine != "dtitk" ]] ; then
+  ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${affine_list_file} --output ${uncorrected_mean_file}
+else
+  ${DTITK_ROOT}/bin/TVMean -in ${affine_list_file} -out ${uncorrected_mean_file}
+fi
+${DTITK_ROOT}/bin/affineSymTensor3DVolume -in ${uncorrected_mean_file} -trans ${inv_aff_file} -target ${mean_file} -out ${new_mean_file}
+rm -f ${uncorrected_mean_file}
+
+${DTITK_ROOT}/bin/TVtool -tr -in ${new_mean_file} -out ${tr_file}
+
+${DTITK_ROOT}/utilities/BinaryThresholdImageFilter ${tr_file} ${mask_file} 0 .01 100 1 0
@@ -1,6 +1,7 @@
 #!/bin/bash -e
 
 #Defaults:
+carry=()
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -9,6 +10,8 @@ while [[ "$#" > 1 ]]; do case $1 in
     --invlist) inv_list_file="$2";;
     --mean) mean_file="$2";;
     --invaff) inv_aff_file="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -30,6 +33,9 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
@@ -1,6 +1,8 @@
 #!/bin/bash -e
 
 #Defaults:
+carry=()
+engine="dtitk"
 static="False"
 
 #Accept Arguments
@@ -12,6 +14,9 @@ while [[ "$#" > 1 ]]; do case $1 in
     --trace) tr_file="$2";;
     --mask) mask_file="$2";;
     --staticmean) static="True";;
+    --engine) engine="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -33,12 +38,24 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
 if [[ ${static} == "False" ]] ; then
 
-  ${DTITK_ROOT}/bin/TVMean -in ${affine_list_file} -out ${mean_file}
+  if [[ $engine != "dtitk" ]] ; then
+    ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${affine_list_file} --output ${mean_file}
+  else
+    ${DTITK_ROOT}/bin/TVMean -in ${affine_list_file} -out ${mean_file}
+  fi
 
 fi
 
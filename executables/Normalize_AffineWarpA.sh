@@ -1,7 +1,9 @@
 #!/bin/bash -e
 
 #Defaults:
+carry=()
 smoption="NMI"
+downsample="1"
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -10,10 +12,14 @@ while [[ "$#" > 1 ]]; do case $1 in
     --mean) mean="$2";;
     --image) image="$2";;
     --aff) aff="$2";;
+    --invaff) invaff="$2";;
     --outimage) outimage="$2";;
     --outaff) outaff="$2";;
     --smoption) smoption="$2";;
     --sepcoarse) sepcoarse="$2";;
+    --downsample) downsample="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -21,7 +27,7 @@ done
 if [[ $show_help == "True" ]] ; then
   echo "Normalize_AffineWarpA"
   echo "Usage: "
-  echo "    Normalize_AffineWarpA.sh [options] --mean <FILE> --image <FILE> --smoption <STR> --sepcoarse <STR>"
+  echo "    Normalize_AffineWarpA.sh [options] --mean <FILE> --image <FILE> --smoption <STR> --sepcoarse <STR> [--invaff <FILE>] [--downsample <INT>]"
   exit 0
 fi
 
@@ -35,14 +41,40 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
 imagebasename="${image%%.*}"
-ln -s $aff ${imagebasename}.aff
 
-${DTITK_ROOT}/scripts/dti_affine_reg ${mean} ${image} ${smoption} ${sepcoarse} ${sepcoarse} ${sepcoarse} 0.01 1
+#Register downsampled copies of the image and template in the coarse iterations of a pyramid.
+#The transform is in world coordinates, so it is then applied to the full resolution image.
+if [[ ${downsample} != "1" ]] ; then
+  regmean="${outaff%.*}_coarse_mean.nii.gz"
+  regimage="${outaff%.*}_coarse.nii.gz"
+  ${EXECUTABLE_DIR}/downsample.py --input ${mean} --factor ${downsample} --output ${regmean}
+  ${EXECUTABLE_DIR}/downsample.py --input ${image} --factor ${downsample} --output ${regimage}
+else
+  regmean=${mean}
+  regimage=${image}
+fi
+regbasename="${regimage%%.*}"
+if [[ -n "${invaff}" ]] ; then
+  #Start from the previous transform as corrected by that iteration's inverse average affine.
+  ${DTITK_ROOT}/bin/affine3Dtool -in ${aff} -compose ${invaff} -out ${regbasename}.aff
+else
+  ln -s $aff ${regbasename}.aff
+fi
+
+${DTITK_ROOT}/scripts/dti_affine_reg ${regmean} ${regimage} ${smoption} ${sepcoarse} ${sepcoarse} ${sepcoarse} 0.01 1
 
 #Output the files, named correctly.
-mv ${imagebasename}_aff.nii.gz ${outimage}
-mv ${imagebasename}.aff ${outaff}
+if [[ ${downsample} != "1" ]] ; then
+  ${DTITK_ROOT}/bin/affineSymTensor3DVolume -in ${image} -trans ${regbasename}.aff -target ${mean} -out ${outimage}
+  rm -f ${regmean} ${regimage} ${regbasename}_aff.nii.gz
+else
+  mv ${imagebasename}_aff.nii.gz ${outimage}
+fi
+mv ${regbasename}.aff ${outaff}
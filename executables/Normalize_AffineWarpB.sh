@@ -1,6 +1,7 @@
 #!/bin/bash -e
 
 #Defaults:
+carry=()
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -12,6 +13,8 @@ while [[ "$#" > 1 ]]; do case $1 in
     --inaff) inaff="$2";;
     --outaff) outaff="$2";;
     --outaffimage) outaffimage="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -33,6 +36,9 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
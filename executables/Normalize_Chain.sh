@@ -0,0 +1,53 @@
+#!/bin/bash -e
+
+#Defaults
+inputs=()
+outputs=()
+
+#Accept Arguments
+while [[ "$#" > 1 ]]; do case $1 in
+    --help) show_help="True";;
+    -h) show_help="True";;
+    --steps) steps_file="$2";;
+    --input) inputs+=("$2");;
+    --output) outputs+=("$2");;
+    *);;
+  esac; shift
+done
+
+if [[ $show_help == "True" ]] ; then
+  echo "Normalize_Chain"
+  echo "Usage: "
+  echo "    Normalize_Chain.sh [options] --steps <FILE> [--input <FILE>]... [--output <FILE>]..."
+  echo "Each line of the steps file is a script in EXECUTABLE_DIR followed by its arguments."
+  exit 0
+fi
+
+#Environmental variable checking
+if [ x${DTITK_ROOT} == x ] ; then
+    echo "DTITK_ROOT is not set "
+fi
+
+
+if [ x${EXECUTABLE_DIR} == x ] ; then
+    echo "EXECUTABLE_DIR is not set "
+fi
+
+#Run the steps in a scratch directory on the node, so that only the outputs are written back.
+workdir=`pwd`
+scratch=`mktemp -d ${TMPDIR:-/tmp}/dipa_chain.XXXXXX`
+trap "rm -rf ${scratch}" EXIT
+
+for input in "${inputs[@]}" ; do
+  ln -s ${workdir}/${input} ${scratch}/${input}
+done
+
+cd ${scratch}
+while read -r step ; do
+  echo ${step}
+  ${EXECUTABLE_DIR}/${step} < /dev/null
+done < ${workdir}/${steps_file}
+
+for output in "${outputs[@]}" ; do
+  mv ${output} ${workdir}/${output}
+done
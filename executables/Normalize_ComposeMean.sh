@@ -1,6 +1,7 @@
 #!/bin/bash -e
 
 #Defaults
+engine="dtitk"
 static="False"
 
 #Accept Arguments
@@ -17,6 +18,7 @@ while [[ "$#" > 1 ]]; do case $1 in
     --isovsizefile) iso_vsize_file="$2";;                 #Registration
     --dimsizefile) dim_file="$2";;                        #Registration
     --statictemplate) static="True";;                     #Registration
+    --engine) engine="$2";;
     *);;
   esac; shift
 done
@@ -41,12 +43,22 @@ fi
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
 if [[ $static == "True" ]] ; then
   cp ${orig_file} ${final_mean_file}
   ${DTITK_ROOT}/bin/TVResample -in ${final_mean_file} -vsize `cat ${iso_vsize_file}` -size `cat ${dim_file}` -out ${iso_final_mean_file}
 else
-  ${DTITK_ROOT}/bin/TVMean -in ${input_list_file} -out ${final_mean_file}
-  ${DTITK_ROOT}/bin/TVMean -in ${iso_input_list_file} -out ${iso_final_mean_file}
+  if [[ $engine != "dtitk" ]] ; then
+    ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${input_list_file} --output ${final_mean_file}
+    ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${iso_input_list_file} --output ${iso_final_mean_file}
+  else
+    ${DTITK_ROOT}/bin/TVMean -in ${input_list_file} -out ${final_mean_file}
+    ${DTITK_ROOT}/bin/TVMean -in ${iso_input_list_file} -out ${iso_final_mean_file}
+  fi
 fi
 
 ${DTITK_ROOT}/bin/TVtool -fa -in ${final_mean_file} -out ${fa_final_mean_file}
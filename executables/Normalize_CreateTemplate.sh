@@ -6,6 +6,7 @@ vsize_file="./template_vsize.txt"
 iso_vsize_file="./template_iso_vsize.txt"
 dim_file="./template_dim.txt"
 existing_template_file="None"  #"None" being a dummy value replaced with a filename if it exists.
+engine="dtitk"
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -20,6 +21,7 @@ while [[ "$#" > 1 ]]; do case $1 in
     --orig) orig_template_file="$2";;
     --initial) initial_template_file="$2";;
     --srctemplate) existing_template_file="$2";;
+    --engine) engine="$2";;
     *);;
   esac; shift
 done
@@ -45,6 +47,11 @@ fi
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
 
 ${EXECUTABLE_DIR}/settemplatedim.py --inputfile ${lookup_file} --out_dim ${dim_file} --out_vsize ${vsize_file} --out_iso_vsize ${iso_vsize_file} --out_resample_bool ${resample_bool_file}
 
@@ -52,7 +59,11 @@ resample=`cat ${resample_bool_file}`
 
 if [[ "${existing_template_file}" == "None" ]] ; then
 
-  ${DTITK_ROOT}/bin/TVMean -in ${template_inputs_file} -out ${orig_template_file}
+  if [[ $engine != "dtitk" ]] ; then
+    ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${template_inputs_file} --output ${orig_template_file}
+  else
+    ${DTITK_ROOT}/bin/TVMean -in ${template_inputs_file} -out ${orig_template_file}
+  fi
 
 else
 
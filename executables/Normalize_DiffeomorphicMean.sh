@@ -1,6 +1,7 @@
 #!/bin/bash -e
 
 #Defaults:
+engine="dtitk"
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -11,6 +12,7 @@ while [[ "$#" > 1 ]]; do case $1 in
     --mean) mean_file="$2";;
     --dfmean) dfmean_file="$2";;
     --invdfmean) inv_dfmean_file="$2";;
+    --engine) engine="$2";;
     *);;
   esac; shift
 done
@@ -35,7 +37,17 @@ fi
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
-${DTITK_ROOT}/bin/TVMean -in ${diffeo_list_file} -out ${mean_file}
-${DTITK_ROOT}/bin/VVMean -in ${df_list_file} -out ${dfmean_file}
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
+if [[ $engine != "dtitk" ]] ; then
+  ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${diffeo_list_file} --output ${mean_file}
+  ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${df_list_file} --output ${dfmean_file}
+else
+  ${DTITK_ROOT}/bin/TVMean -in ${diffeo_list_file} -out ${mean_file}
+  ${DTITK_ROOT}/bin/VVMean -in ${df_list_file} -out ${dfmean_file}
+fi
 ${DTITK_ROOT}/bin/dfToInverse -in ${dfmean_file} -out ${inv_dfmean_file}
 ${DTITK_ROOT}/bin/deformationSymTensor3DVolume -in ${mean_file} -out ${mean_file} -trans ${inv_dfmean_file}
@@ -13,6 +13,8 @@ while [[ "$#" > 1 ]]; do case $1 in
     --iterations) iterations="$2";;
     --outimage) outimage="$2";;
     --outdf) outdf="$2";;
+    --initimage) init_image="$2";;
+    --initdf) init_df="$2";;
     *);;
   esac; shift
 done
@@ -20,7 +22,7 @@ done
 if [[ $show_help == "True" ]] ; then
   echo "Normalize_DiffeomorphicWarp"
   echo "Usage: "
-  echo "    Normalize_DiffeomorphicWarp.sh [options] --mean <FILE> --image <FILE> --iterations <INT> --outimage <FILE> --outdf <FILE>"
+  echo "    Normalize_DiffeomorphicWarp.sh [options] --mean <FILE> --image <FILE> --iterations <INT> --outimage <FILE> --outdf <FILE> [--initimage <FILE> --initdf <FILE>]"
   exit 0
 fi
 
@@ -37,9 +39,21 @@ fi
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
-${DTITK_ROOT}/scripts/dti_diffeomorphic_reg ${mean} ${image} ${mask} 1 ${iterations} 0.002
-
-#Output the files, named correctly.
-imagebasename="${image%%.*}"
-mv ${imagebasename}_diffeo.nii.gz ${outimage}
-mv ${imagebasename}_diffeo.df.nii.gz ${outdf}
+if [[ -n "${init_df}" ]] ; then
+  #Warm start: levels 1 to iterations-1 were solved by the previous iteration, so only this
+  #iteration's level is registered, from the image as the previous field warped it. The
+  #refinement is then composed with the previous field, and the image warped once by the result.
+  warmbasename="${outimage%%.*}_warm"
+  ln -s ${init_image} ${warmbasename}.nii.gz
+  ${DTITK_ROOT}/scripts/dti_diffeomorphic_reg ${mean} ${warmbasename}.nii.gz ${mask} ${iterations} ${iterations} 0.002
+  ${DTITK_ROOT}/bin/dfComposition -df1 ${warmbasename}_diffeo.df.nii.gz -df2 ${init_df} -out ${outdf}
+  ${DTITK_ROOT}/bin/deformationSymTensor3DVolume -in ${image} -trans ${outdf} -target ${mean} -out ${outimage}
+  rm -f ${warmbasename}.nii.gz ${warmbasename}_diffeo.nii.gz ${warmbasename}_diffeo.df.nii.gz
+else
+  ${DTITK_ROOT}/scripts/dti_diffeomorphic_reg ${mean} ${image} ${mask} 1 ${iterations} 0.002
+
+  #Output the files, named correctly.
+  imagebasename="${image%%.*}"
+  mv ${imagebasename}_diffeo.nii.gz ${outimage}
+  mv ${imagebasename}_diffeo.df.nii.gz ${outdf}
+fi
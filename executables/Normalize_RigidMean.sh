@@ -1,6 +1,8 @@
 #!/bin/bash -e
 
 #Defaults:
+carry=()
+engine="dtitk"
 smoption="NMI"
 
 #Accept Arguments
@@ -12,6 +14,9 @@ while [[ "$#" > 1 ]]; do case $1 in
     --previousmean) previous_mean_file="$2";;
     --smoption) smoption="${2}";;
     --statictemplate) static="True";;
+    --engine) engine="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -33,11 +38,23 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
+native_options=""
+if [[ $engine == "log_euclidean" ]] ; then
+  native_options="--log_euclidean"
+fi
+
 if [[ $static == "True" ]] ; then
   cp ${previous_mean_file} ${new_mean_file}
 else
-  ${DTITK_ROOT}/bin/TVMean -in ${affine_list_file} -out ${new_mean_file}
+  if [[ $engine != "dtitk" ]] ; then
+    ${EXECUTABLE_DIR}/tensormean.py ${native_options} --inputlist ${affine_list_file} --output ${new_mean_file}
+  else
+    ${DTITK_ROOT}/bin/TVMean -in ${affine_list_file} -out ${new_mean_file}
+  fi
 fi
@@ -1,9 +1,11 @@
 #!/bin/bash -e
 
 #Defaults
+carry=()
 smoption="NMI"
 initial="False"
 aff="None"
+downsample="1"
 
 #Accept Arguments
 while [[ "$#" > 1 ]]; do case $1 in
@@ -17,6 +19,9 @@ while [[ "$#" > 1 ]]; do case $1 in
     --smoption) smoption="$2";;
     --sep) sep="$2";;
     --initial) initial="True";;
+    --downsample) downsample="$2";;
+    --converged) converged_file="$2";;
+    --carry) carry+=("$2");;
     *);;
   esac; shift
 done
@@ -24,7 +29,7 @@ done
 if [[ $show_help == "True" ]] ; then
   echo "Normalize_RigidWarp"
   echo "Usage: "
-  echo "    Normalize_RigidWarp.sh [options] --mean <FILE> --image <FILE> --outimage <FILE> --outaff <FILE> --smoption <STR> --sep <STR> [--initial 1]"
+  echo "    Normalize_RigidWarp.sh [options] --mean <FILE> --image <FILE> --outimage <FILE> --outaff <FILE> --smoption <STR> --sep <STR> [--initial 1] [--downsample <INT>]"
   exit 0
 fi
 
@@ -38,21 +43,42 @@ if [ x${EXECUTABLE_DIR} == x ] ; then
     echo "EXECUTABLE_DIR is not set "
 fi
 
+#Carry a converged iteration forward, rather than running it
+source ${EXECUTABLE_DIR}/converged.sh
+
 #Source dtitk_common.sh
 source ${DTITK_ROOT}/scripts/dtitk_common.sh
 
 imagebasename="${image%%.*}"
 
+#Register downsampled copies of the image and template in the coarse iterations of a pyramid.
+#The transform is in world coordinates, so it is then applied to the full resolution image.
+if [[ ${downsample} != "1" ]] ; then
+  regmean="${outaff%.*}_coarse_mean.nii.gz"
+  regimage="${outaff%.*}_coarse.nii.gz"
+  ${EXECUTABLE_DIR}/downsample.py --input ${mean} --factor ${downsample} --output ${regmean}
+  ${EXECUTABLE_DIR}/downsample.py --input ${image} --factor ${downsample} --output ${regimage}
+else
+  regmean=${mean}
+  regimage=${image}
+fi
+regbasename="${regimage%%.*}"
+
 if [ $initial == "True" ] ; then
   endcode=""
 else
   endcode="1"
-  ln -s $aff ${imagebasename}.aff
+  ln -s $aff ${regbasename}.aff
 fi
-echo ${DTITK_ROOT}/scripts/dti_rigid_reg ${mean} ${image} ${smoption} ${sep} ${sep} ${sep} 0.01 ${endcode}
-${DTITK_ROOT}/scripts/dti_rigid_reg ${mean} ${image} ${smoption} ${sep} ${sep} ${sep} 0.01 ${endcode}
+echo ${DTITK_ROOT}/scripts/dti_rigid_reg ${regmean} ${regimage} ${smoption} ${sep} ${sep} ${sep} 0.01 ${endcode}
+${DTITK_ROOT}/scripts/dti_rigid_reg ${regmean} ${regimage} ${smoption} ${sep} ${sep} ${sep} 0.01 ${endcode}
 
 #Output the files, named correctly.
 
-mv ${imagebasename}_aff.nii.gz ${outimage}
-mv ${imagebasename}.aff ${outaff}
+if [[ ${downsample} != "1" ]] ; then
+  ${DTITK_ROOT}/bin/affineSymTensor3DVolume -in ${image} -trans ${regbasename}.aff -target ${mean} -out ${outimage}
+  rm -f ${regmean} ${regimage} ${regbasename}_aff.nii.gz
+else
+  mv ${imagebasename}_aff.nii.gz ${outimage}
+fi
+mv ${regbasename}.aff ${outaff}
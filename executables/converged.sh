@@ -0,0 +1,13 @@
+#!/bin/bash -e
+
+#Sourced by the template iteration scripts once their arguments are read.
+#If ${converged_file} (written by templatechange.py) says the template has converged, this
+#iteration is not run: each "previous:current" pair in ${carry[@]} is copied forward instead.
+
+if [[ -n "${converged_file}" ]] && [[ `head -n 1 ${converged_file}` == "True" ]] ; then
+  for pair in "${carry[@]}" ; do
+    cp "${pair%%:*}" "${pair##*:}"
+  done
+  echo "The template has converged, carried ${#carry[@]} files forward."
+  exit 0
+fi
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import os, sys
+import numpy as np
+import nibabel as nib
+from docopt import docopt
+
+Version = "0.1"
+
+doc = """
+Downsample, Version {0}.
+
+Downsamples a tensor (or any) image by an integer factor, for the coarse iterations of a
+registration pyramid. Each output voxel is the mean of a block of factor x factor x factor
+input voxels, and lies at the centre of that block, so a downsampled image stays aligned
+with its original in world coordinates. Edges that do not fill a block are padded with zeros.
+
+Usage:
+    downsample.py [options] --input <FILE> --factor <INT> --output <FILE>
+
+Options:
+    -h --help                Show this screen.
+    -v --version             Show version.
+    --input <FILE>           Input image (path).
+    --factor <INT>           Downsampling factor.
+    --output <FILE>          Output image (path).
+""".format(Version)
+
+#============================================================================
+#             General Utility
+#============================================================================
+
+def cleanPathString(path):
+  if path.endswith("/"):
+    path = path[:-1]
+  if path.startswith("="):
+    path = path[1:]
+  realpath = os.path.realpath(path)
+  return realpath
+
+#============================================================================
+#             Downsample
+#============================================================================
+
+def block_mean(data, factor):
+    #Averages factor^3 blocks of the first three axes, zero padding them to a multiple of factor.
+    padding = [(0, -size % factor) for size in data.shape[:3]] + [(0, 0)] * (data.ndim - 3)
+    data = np.pad(data, padding, mode="constant")
+    shape = []
+    for size in data.shape[:3]:
+        shape.extend([size // factor, factor])
+    blocks = data.reshape(tuple(shape) + data.shape[3:])
+    return blocks.mean(axis=(1, 3, 5))
+
+def downsampled_affine(affine, factor):
+    #Voxel (i, j, k) of the output is at the centre of input voxels factor*(i, j, k) ... factor*(i, j, k) + factor-1.
+    scale = np.diag([factor, factor, factor, 1.0])
+    scale[:3, 3] = (factor - 1) / 2.0
+    return np.dot(affine, scale)
+
+def downsample(image, factor):
+    data = np.asarray(image.dataobj, dtype=np.float64)
+    affine = downsampled_affine(image.affine, factor)
+    output = nib.Nifti1Image(block_mean(data, factor).astype(image.get_data_dtype()), affine, image.header)
+    output.set_qform(affine)
+    output.set_sform(affine)
+    return output
+
+def run(rawargs):
+    arguments = docopt(doc, argv=rawargs, version='Downsample v{0}'.format(Version))
+    factor = int(arguments["--factor"])
+    if factor < 1:
+        print("The factor must be a positive integer.")
+        sys.exit(1)
+    image = nib.load(cleanPathString(arguments["--input"]))
+    nib.save(downsample(image, factor), arguments["--output"])
+    print("Downsampled {0} by {1} to {2}".format(arguments["--input"], factor, arguments["--output"]))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    del args[0]
+    run(args)
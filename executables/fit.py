@@ -9,6 +9,7 @@ from dipy.align.reslice import reslice
 from dipy.core.gradients import gradient_table
 from dipy.io import read_bvals_bvecs
 from docopt import docopt
+from getimagedim import dimension_record
 
 Version = "0.1"
 
@@ -37,6 +38,8 @@ Options:
     --out_mk <FILE>             Output the MK from the dki model (path). [default: None]
     --out_rk <FILE>             Output the RK from the dki model (path). [default: None]
     --out_ak <FILE>             Output the AK from the dki model (path). [default: None]
+    --out_dim <FILE>            Output the image dimensions record, as written by getimagedim.py (path). [default: None]
+    --dim_id <ID>               ID to use in the image dimensions record. [default: None]
     --fit_method <METHOD>       Specify a method for fitting (WLS or OLS). [default: WLS]
     --mask_median_radius <INT>  Radius (in voxels) of the applied median filter [default: 4]
     --mask_numpass <INT>        Number of pass of the median filter [default: 4]
@@ -48,7 +51,7 @@ Options:
 #============================================================================
 
 class Fitter(object):
-    def __init__(self, data, mask, gradient_table, fit_method, median_radius=4, numpass=4, out_dti=None, out_dki=None, out_residual=None, out_noise=None, out_snr=None, out_fa=None, out_md=None, out_rd=None, out_ad=None, out_mk=None, out_rk=None, out_ak=None):
+    def __init__(self, data, mask, gradient_table, fit_method, median_radius=4, numpass=4, out_dti=None, out_dki=None, out_residual=None, out_noise=None, out_snr=None, out_fa=None, out_md=None, out_rd=None, out_ad=None, out_mk=None, out_rk=None, out_ak=None, out_dim=None, dim_id=None):
         self.raw_data = data
         self.mask = mask
         self.data = self.raw_data
@@ -108,6 +111,10 @@ class Fitter(object):
         self.out_rk = None
         self.out_ak = None
 
+        #Dimensions record for normalization, so that no separate job needs to read the SPD again
+        self.out_dim_path = out_dim
+        self.dim_id = dim_id
+
 
     def save(self):
         out_matrix = [
@@ -134,6 +141,10 @@ class Fitter(object):
                     path += ".nii.gz"
                 print("Saving {0}".format(path))
                 nib.nifti1.save(contents, path)
+        if self.out_dim_path != None and self.out_dti != None:
+            print("Saving {0}".format(self.out_dim_path))
+            record = dimension_record(self.dim_id, self.out_dti.shape, self.out_dti.header.get_zooms())
+            record.to_csv(self.out_dim_path, index=False)
 
     def apply_mask(self):
         """
@@ -262,6 +273,8 @@ def run(rawargs):
               "--out_mk": "out_mk",
               "--out_rk": "out_rk",
               "--out_ak": "out_ak",
+              "--out_dim": "out_dim",
+              "--dim_id": "dim_id",
               "--mask_median_radius": "median_radius",
               "--mask_numpass": "numpass"}
 
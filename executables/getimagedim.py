@@ -47,6 +47,17 @@ def exists(path):
 #   p = subprocess.Popen(command.split(" "), stdout=subprocess.PIPE, shell=False)
 #   return p.stdout.read()
 
+def dimension_record(idval, shape, pixdim):
+    #One row of the dimensions table read by settemplatedim.py
+    xdim, ydim, zdim = [int(value) for value in shape[0:3]]
+    xpixdim, ypixdim, zpixdim = [float(value) for value in pixdim[0:3]]
+
+    xdimLogRounded = math.pow(2, round(math.log(xdim, 2)))
+    ydimLogRounded = math.pow(2, round(math.log(ydim, 2)))
+    zdimLogRounded = math.pow(2, round(math.log(zdim, 2)))
+
+    return pandas.DataFrame([{"ID": idval, "XDIM": xdim, "YDIM": ydim, "ZDIM": zdim, "XPIXDIM": xpixdim, "YPIXDIM": ypixdim, "ZPIXDIM": zpixdim, "XDIMLOG": xdimLogRounded, "YDIMLOG": ydimLogRounded, "ZDIMLOG": zdimLogRounded}])
+
 def run(rawargs):
     arguments = docopt(doc, argv=rawargs, version='Get Image Dimensions v{0}'.format(Version))
     if not exists(arguments["--inputfile"]):
@@ -55,19 +66,7 @@ def run(rawargs):
 
     try:
         image = nibabel.load(arguments["--inputfile"])
-
-        xdim = image.shape[0]
-        ydim = image.shape[1]
-        zdim = image.shape[2]
-        xpixdim = image._header["pixdim"][1]
-        ypixdim = image._header["pixdim"][2]
-        zpixdim = image._header["pixdim"][3]
-
-        xdimLogRounded = math.pow(2, round(math.log(xdim, 2)))
-        ydimLogRounded = math.pow(2, round(math.log(ydim, 2)))
-        zdimLogRounded = math.pow(2, round(math.log(zdim, 2)))
-
-        dimdataframe = pandas.DataFrame([{"ID": arguments["--id"], "XDIM": xdim, "YDIM": ydim, "ZDIM": zdim, "XPIXDIM": xpixdim, "YPIXDIM": ypixdim, "ZPIXDIM": zpixdim, "XDIMLOG": xdimLogRounded, "YDIMLOG": ydimLogRounded, "ZDIMLOG": zdimLogRounded}])
+        dimdataframe = dimension_record(arguments["--id"], image.shape, image._header["pixdim"][1:4])
         print(dimdataframe)
         dimdataframe.to_csv(arguments["--outputfile"], index=False)
 
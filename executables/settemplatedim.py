@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 
-import os, sys, pandas, math
+import os, sys, csv, pandas, math
 from docopt import docopt
 
 Version = "0.1"
@@ -15,7 +15,7 @@ Usage:
 Options:
     -h --help                     Show this screen.
     -v --version                  Show version.
-    --inputfile <FILE>            Input File (path).
+    --inputfile <FILE>            Input File (path). Either a dimensions table (ID,XDIM,...,ZDIMLOG), or a lookup (ID,FILE) of single-row dimensions files.
     --out_dim <FILE>              Output path to the file which contains information about the number of voxels in the image. [default: ./template_dim.txt]
     --out_vsize <FILE>            Output path to the file which contains information about the size of voxels in the image. [default: ./template_vsize.txt]
     --out_iso_vsize <FILE>        Output path to the file which contains information about the size of voxels in the isometric image. [default: ./template_iso_vsize.txt]
@@ -74,11 +74,16 @@ def run(rawargs):
         sys.exit(1)
 
     inputfile = pandas.read_csv(cleanPathString(arguments["--inputfile"]))
-    tablelist = []
-    for index, row in inputfile.iterrows():
-        if exists(row["FILE"]):
-            tablelist.append(pandas.read_csv(cleanPathString(row["FILE"])))
-    masterdimfile = pandas.concat(tablelist)
+    if "FILE" in inputfile.columns:
+        #Aggregate the records into one table before taking the mode.
+        rows = []
+        for filename in inputfile["FILE"]:
+            if exists(filename):
+                with open(cleanPathString(filename), "r") as f:
+                    rows.extend(list(csv.DictReader(f)))
+        masterdimfile = pandas.DataFrame(rows).apply(pandas.to_numeric, errors="ignore")
+    else:
+        masterdimfile = inputfile
 
     if len(masterdimfile) != 1:
         masterdimfile = masterdimfile.mode()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import os, sys
+import numpy as np
+import nibabel as nib
+from docopt import docopt
+
+Version = "0.1"
+
+doc = """
+Template Change, Version {0}.
+
+Measures how much a template changed in an iteration: the Frobenius norm of the difference
+between the current and previous templates, relative to the norm of the previous one. Writes
+'True' (converged) or 'False' on the first line of the output, and the change on the second.
+Once an iteration has converged (--converged), the following ones are too.
+
+Usage:
+    templatechange.py [options] --previous <FILE> --current <FILE> --tolerance <FLOAT> --output <FILE>
+
+Options:
+    -h --help                Show this screen.
+    -v --version             Show version.
+    --previous <FILE>        Template of the previous iteration (path).
+    --current <FILE>         Template of this iteration (path).
+    --tolerance <FLOAT>      Relative change at or below which the template has converged.
+    --output <FILE>          Output file (path).
+    --converged <FILE>       Output of the previous iteration's check, if any. [default: None]
+""".format(Version)
+
+#Weights of the tensor components (xx, xy, yy, xz, yz, zz) in the Frobenius norm
+TENSOR_WEIGHTS = np.array([1.0, 2.0, 1.0, 2.0, 2.0, 1.0])
+
+#============================================================================
+#             General Utility
+#============================================================================
+
+def cleanPathString(path):
+  if path.endswith("/"):
+    path = path[:-1]
+  if path.startswith("="):
+    path = path[1:]
+  realpath = os.path.realpath(path)
+  return realpath
+
+def read_converged(path):
+    with open(cleanPathString(path), "r") as f:
+        return f.readline().strip() == "True"
+
+#============================================================================
+#             Change
+#============================================================================
+
+def squared_norm(data):
+    if data.shape[-1] == 6:
+        return float(np.sum(np.square(data) * TENSOR_WEIGHTS))
+    return float(np.sum(np.square(data)))
+
+def template_change(previous_path, current_path):
+    previous = np.asarray(nib.load(cleanPathString(previous_path)).dataobj, dtype=np.float64)
+    current = np.asarray(nib.load(cleanPathString(current_path)).dataobj, dtype=np.float64)
+    if previous.shape != current.shape:
+        return float("inf")
+    scale = squared_norm(previous)
+    if scale == 0:
+        return 0.0 if squared_norm(current) == 0 else float("inf")
+    return np.sqrt(squared_norm(current - previous) / scale)
+
+def run(rawargs):
+    arguments = docopt(doc, argv=rawargs, version='Template Change v{0}'.format(Version))
+    change = template_change(arguments["--previous"], arguments["--current"])
+    converged = change <= float(arguments["--tolerance"])
+    if arguments["--converged"] not in ["None", None]:
+        converged = converged or read_converged(arguments["--converged"])
+    with open(arguments["--output"], "w") as f:
+        f.write("{0}\n{1}\n".format(converged, change))
+    print("Template change {0}, converged: {1}".format(change, converged))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    del args[0]
+    run(args)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+import os, sys, math, time, tempfile
+import numpy as np
+import nibabel as nib
+from multiprocessing.pool import ThreadPool
+from docopt import docopt
+
+Version = "0.3"
+
+doc = """
+Tensor Mean, Version {0}.
+
+Computes the (weighted) mean of tensor or displacement field images, as a drop-in for
+DTI-TK's TVMean and VVMean. Each line of an input list is an image path, optionally followed
+by its weight (the number of images it is a mean of, for partial means). The weighted mean of
+partial means, weighted by their counts, is the mean of all of their images.
+
+Images are added one at a time to a float64 accumulator, so memory stays at about one
+volume per reading thread, however many images there are. With --memmap, the accumulator
+itself is a memory-mapped file. With --log_euclidean, tensor images (6 components, in DTI-TK
+order) are averaged as matrix logarithms; voxels whose tensor is not positive definite are
+left out of that voxel's mean. Displacement fields are always averaged as they are.
+
+With --wait, inputs that do not exist yet are polled for, and each is added once it has
+settled, so a group mean can be accumulated while its warps are still running. This needs
+the inputs to be written where this job runs (a shared filesystem). With a --quorum below
+100, the means are of the first subjects whose images are all in, and --contributors records
+who they were.
+
+Usage:
+    tensormean.py [options] (--inputlist <FILE> --output <FILE>)...
+
+Options:
+    -h --help                Show this screen.
+    -v --version             Show version.
+    --inputlist <FILE>       List of input images, each optionally followed by a weight (path).
+    --output <FILE>          Output mean image (path).
+    --precision <TYPE>       Data type of the output: 'float32', as DTI-TK expects, or 'float64', which partial means use so that only the final mean is rounded. [default: float32]
+    --threads <INT>          Number of images read at once. Defaults to $PEGASUS_CORES, or 1. [default: None]
+    --memmap <DIR>           Keep the accumulator in a memory-mapped file in this directory. [default: None]
+    --log_euclidean          Average tensors in the log-Euclidean metric. [default: False]
+    --wait <SECONDS>         Wait up to this long for inputs that do not exist yet. [default: None]
+    --settle <SECONDS>       Seconds an awaited input must go unmodified before it is read. [default: 30]
+    --quorum <PERCENT>       With --wait, average only the first of the input rows (a subject's image from each list) to be complete, this percentage of them, rounded up. [default: 100]
+    --contributors <FILE>    Write the inputs that were averaged, a row per line. [default: None]
+""".format(Version)
+
+#Order of the tensor components in DTI-TK images: xx, xy, yy, xz, yz, zz
+TENSOR_INDICES = [(0, 0), (0, 1), (1, 1), (0, 2), (1, 2), (2, 2)]
+SLAB = 8
+#Seconds between polls for awaited inputs
+POLL = 10
+
+#============================================================================
+#             General Utility
+#============================================================================
+
+def cleanPathString(path):
+  if path.endswith("/"):
+    path = path[:-1]
+  if path.startswith("="):
+    path = path[1:]
+  realpath = os.path.realpath(path)
+  return realpath
+
+def read_input_list(path):
+    #Returns a list of (image path, weight)
+    inputs = []
+    with open(cleanPathString(path), "r") as f:
+        for line in f:
+            values = line.split()
+            if len(values) == 0:
+                continue
+            weight = float(values[1]) if len(values) > 1 else 1.0
+            inputs.append((values[0], weight))
+    return inputs
+
+def read_image(path):
+    image = nib.load(path)
+    return image, np.asarray(image.dataobj, dtype=np.float64)
+
+#============================================================================
+#             Log-Euclidean Tensors
+#============================================================================
+
+def tensor_matrices(data):
+    matrices = np.empty(data.shape[:-1] + (3, 3), dtype=np.float64)
+    for component, (row, column) in enumerate(TENSOR_INDICES):
+        matrices[..., row, column] = data[..., component]
+        matrices[..., column, row] = data[..., component]
+    return matrices
+
+def tensor_components(matrices):
+    return np.stack([matrices[..., row, column] for row, column in TENSOR_INDICES], axis=-1)
+
+def eigen_compose(values, vectors):
+    return np.einsum("...ij,...j,...kj->...ik", vectors, values, vectors)
+
+def tensor_log(data):
+    """
+    Returns the matrix logarithm of each tensor, and whether the tensor was positive definite.
+    Tensors are decomposed a slab of slices at a time, to bound the memory of the 3x3 matrices.
+    """
+    logs = np.zeros(data.shape, dtype=np.float64)
+    valid = np.zeros(data.shape[:-1], dtype=bool)
+    for start in range(0, data.shape[2], SLAB):
+        values, vectors = np.linalg.eigh(tensor_matrices(data[:, :, start:start+SLAB]))
+        positive = values.min(axis=-1) > 0
+        values = np.log(np.where(values > 0, values, 1.0))
+        slab = tensor_components(eigen_compose(values, vectors))
+        logs[:, :, start:start+SLAB] = np.where(positive[..., np.newaxis], slab, 0.0)
+        valid[:, :, start:start+SLAB] = positive
+    return logs, valid
+
+def tensor_exp(logs):
+    data = np.empty(logs.shape, dtype=np.float64)
+    for start in range(0, logs.shape[2], SLAB):
+        values, vectors = np.linalg.eigh(tensor_matrices(logs[:, :, start:start+SLAB]))
+        data[:, :, start:start+SLAB] = tensor_components(eigen_compose(np.exp(values), vectors))
+    return data
+
+#============================================================================
+#             Mean
+#============================================================================
+
+class MeanAccumulator(object):
+    """
+    A float64 running weighted sum of images, optionally kept in a memory-mapped file.
+
+    Attributes:
+        count
+        weights
+
+    Methods:
+        add
+        mean
+    """
+    def __init__(self, log_euclidean=False, memmap_dir=None):
+        self.log_euclidean = log_euclidean
+        self.memmap_dir = memmap_dir
+        self.first = None
+        self.total = None
+        self.voxel_weights = None
+        self.weights = 0.0
+        self.count = 0
+
+    def __allocate__(self, shape):
+        if self.memmap_dir == None:
+            return np.zeros(shape, dtype=np.float64)
+        #The file is unlinked at once; the mapping keeps it until the accumulator is freed.
+        handle, path = tempfile.mkstemp(suffix=".accumulator", dir=self.memmap_dir)
+        os.close(handle)
+        total = np.memmap(path, dtype=np.float64, mode="w+", shape=shape)
+        os.remove(path)
+        return total
+
+    def add(self, path, image, data, weight):
+        if self.first is None:
+            #Only tensors have a log-Euclidean mean.
+            self.log_euclidean = self.log_euclidean and data.shape[-1] == 6
+            self.first = image
+            self.total = self.__allocate__(data.shape)
+            if self.log_euclidean:
+                self.voxel_weights = np.zeros(data.shape[:-1], dtype=np.float64)
+        elif data.shape != self.total.shape:
+            raise ValueError("{0} has shape {1}, expected {2}".format(path, data.shape, self.total.shape))
+        if self.log_euclidean:
+            logs, valid = tensor_log(data)
+            self.total += weight * logs
+            self.voxel_weights += weight * valid
+        else:
+            self.total += weight * data
+        self.weights += weight
+        self.count += 1
+
+    def mean(self, precision="float32"):
+        """
+        Returns the mean as a Nifti1Image with the first image's header, in the data type
+        given by precision.
+        """
+        if self.log_euclidean:
+            covered = self.voxel_weights > 0
+            logs = self.total / np.where(covered, self.voxel_weights, 1.0)[..., np.newaxis]
+            mean = np.where(covered[..., np.newaxis], tensor_exp(logs), 0.0)
+        else:
+            mean = self.total / self.weights
+        dtype = np.float64 if precision == "float64" else np.float32
+        image = nib.Nifti1Image(np.asarray(mean).astype(dtype), self.first.affine, self.first.header)
+        image.set_data_dtype(dtype)
+        return image
+
+def read_settled_image(path):
+    #A file can look settled while its writer is stalled, so a failed read is retried on a later poll.
+    try:
+        return read_image(path)
+    except Exception:
+        return None
+
+def settled(path, settle):
+    try:
+        return time.time() - os.path.getmtime(path) >= settle
+    except OSError:
+        return False
+
+def weighted_means(input_lists, precision="float32", threads=1, memmap_dir=None, log_euclidean=False, wait=None, settle=30, quorum=None):
+    """
+    Returns the mean of each input list, and the rows of inputs that were added. Images are
+    read 'threads' at a time and added to their list's accumulator in list order, so that
+    the means do not depend on the number of threads.
+
+    With 'wait' (seconds), inputs that do not exist yet are waited for: each is added once
+    it has not been modified for 'settle' seconds, in the order they appear, so the mean can
+    be accumulated while the jobs writing its inputs are still running.
+
+    With a 'quorum' (a count), the input lists are read as rows, one image from each list
+    (one subject's images), and the means are of the first 'quorum' rows that are complete.
+    """
+    accumulators = [MeanAccumulator(log_euclidean=log_euclidean, memmap_dir=memmap_dir) for inputs in input_lists]
+    items = [[(index, path, weight) for path, weight in inputs] for index, inputs in enumerate(input_lists)]
+    if quorum == None:
+        pending = [[item] for channel in items for item in channel]
+        needed = len(pending)
+    else:
+        pending = [list(row) for row in zip(*items)]
+        needed = min(quorum, len(pending))
+    load = read_image if wait == None else read_settled_image
+    deadline = None if wait == None else time.time() + wait
+    pool = ThreadPool(processes=threads) if threads > 1 else None
+    added = []
+    size = max(1, threads // len(pending[0]))
+    try:
+        while len(added) < needed:
+            if wait == None:
+                candidates = list(pending)
+            else:
+                candidates = [row for row in pending if all([settled(path, settle) for index, path, weight in row])]
+            progress = 0
+            #Every settled row is tried once per poll, so one that cannot be read yet does not hold up the rest.
+            while len(candidates) > 0 and len(added) < needed:
+                batch = candidates[:size][:needed-len(added)]
+                candidates = candidates[len(batch):]
+                paths = [path for row in batch for index, path, weight in row]
+                images = pool.map(load, paths) if pool != None else [load(path) for path in paths]
+                for row in batch:
+                    loaded = images[:len(row)]
+                    images = images[len(row):]
+                    #A row is added whole, so that each mean is of the same subjects.
+                    if None in loaded:
+                        #Retried on a later poll, after the rows that have not been tried yet.
+                        pending.remove(row)
+                        pending.append(row)
+                        continue
+                    for (index, path, weight), (image, data) in zip(row, loaded):
+                        accumulators[index].add(path, image, data, weight)
+                    pending.remove(row)
+                    added.append(row)
+                    progress += 1
+                images = loaded = None
+            if progress == 0:
+                if time.time() > deadline:
+                    raise IOError("Timed out waiting for {0}".format(", ".join([path for row in pending for index, path, weight in row])))
+                time.sleep(POLL)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    return [accumulator.mean(precision) for accumulator in accumulators], added
+
+def run(rawargs):
+    arguments = docopt(doc, argv=rawargs, version='Tensor Mean v{0}'.format(Version))
+    if arguments["--threads"] in ["None", None]:
+        threads = int(os.environ.get("PEGASUS_CORES", 1))
+    else:
+        threads = int(arguments["--threads"])
+    memmap_dir = None if arguments["--memmap"] in ["None", None] else cleanPathString(arguments["--memmap"])
+    wait = None if arguments["--wait"] in ["None", None] else float(arguments["--wait"])
+    input_lists = []
+    for inputlist in arguments["--inputlist"]:
+        inputs = read_input_list(inputlist)
+        if len(inputs) == 0:
+            print("Input list '{0}' is empty!".format(inputlist))
+            sys.exit(1)
+        input_lists.append(inputs)
+    quorum = None
+    if float(arguments["--quorum"]) < 100:
+        if wait == None or len(set([len(inputs) for inputs in input_lists])) != 1:
+            print("A quorum needs --wait, and input lists of the same length.")
+            sys.exit(1)
+        quorum = int(math.ceil(float(arguments["--quorum"]) * len(input_lists[0]) / 100))
+    means, added = weighted_means(input_lists, arguments["--precision"], threads=max(1, threads), memmap_dir=memmap_dir,
+                                  log_euclidean=arguments["--log_euclidean"], wait=wait, settle=float(arguments["--settle"]), quorum=quorum)
+    for inputs, mean, output in zip(input_lists, means, arguments["--output"]):
+        nib.save(mean, output)
+        print("Wrote the mean of {0} images to {1}".format(len(added) if quorum != None else len(inputs), output))
+    if arguments["--contributors"] not in ["None", None]:
+        with open(arguments["--contributors"], "w") as f:
+            for row in added:
+                f.write(" ".join([path for index, path, weight in row])+"\n")
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    del args[0]
+    run(args)
@@ -0,0 +1,51 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import re
+from Pegasus.DAX3 import Profile, Namespace
+
+#============================================================================
+#             Label Clustering
+#============================================================================
+
+def read_cluster_sizes(tcpath):
+    """
+    Reads the 'profile pegasus "clusters.size"' entry of each transformation in a
+    text transformation catalog. Returns a dictionary of transformation name -> size.
+    """
+    sizes = {}
+    transformation = None
+    with open(tcpath, "r") as f:
+        for line in f:
+            match = re.match(r'\s*tr\s+(?:\w+::)?([\w\.]+)', line)
+            if match:
+                transformation = match.group(1)
+                continue
+            match = re.match(r'\s*profile\s+pegasus\s+"clusters\.size"\s+"?(\d+)"?', line)
+            if match and transformation != None:
+                sizes[transformation] = int(match.group(1))
+    return sizes
+
+class Clusterer(object):
+    """
+    Tags jobs with a pegasus 'label' profile, so that 'pegasus-plan --cluster label'
+    merges each run of 'size' jobs into one clustered job.
+
+    Jobs are grouped by transformation and by the level they were planned at (the tier,
+    plus the iteration where there is one). Jobs within a level never depend on each other,
+    so chunking them cannot introduce a cycle. Transformations without a size above 1
+    are left unlabelled and run as individual jobs.
+    """
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.counts = {}
+
+    def label(self, pegasus_job, level):
+        size = self.sizes.get(pegasus_job.name, 1)
+        if size <= 1:
+            return
+        key = "{0}_{1}".format(pegasus_job.name, level)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        pegasus_job.addProfile(Profile(Namespace.PEGASUS, "label", "{0}_c{1}".format(key, count // size)))
@@ -0,0 +1,132 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import tempfile
+from xml.sax.saxutils import quoteattr
+from Pegasus.DAX3 import Element, DuplicateError, FormatError, SCHEMA_NAMESPACE, SCHEMA_LOCATION, SCHEMA_VERSION
+from priority import PLACEHOLDER
+
+#============================================================================
+#             Streaming DAX Writer
+#============================================================================
+
+class StreamingADAG(object):
+    """
+    A drop-in for ADAG (addJob/depends) that writes each job to the DAX file as soon as
+    it is added, instead of holding every Job, uses() and dependency in memory until
+    writeXML. Edges are spooled to a temporary file and appended when the DAX is closed,
+    because the DAX schema requires all <child> elements to follow the jobs.
+
+    Only job ids are retained, to reject duplicate jobs and edges to unknown jobs.
+    Jobs must be complete when they are added; later changes to them are not written.
+    An optional recorder is called with each job as it is added (e.g. OutputManifest.record).
+
+    With a prioritizer (utility.priority.Prioritizer), jobs are spooled as well, with a
+    placeholder priority profile, and only each job's weight is retained. The priorities
+    depend on the whole graph, so they are filled in as the jobs are copied to the DAX on close.
+
+    Attributes:
+        job_count
+        edge_count
+
+    Methods:
+        addJob
+        depends
+        close
+    """
+    def __init__(self, name, path, recorder=None, prioritizer=None):
+        self.name = name
+        self.path = path
+        self.recorder = recorder
+        self.prioritizer = prioritizer
+        self.job_ids = set()
+        self.job_count = 0
+        self.edge_count = 0
+        self.edges = tempfile.TemporaryFile()
+        if self.prioritizer != None:
+            self.jobs = tempfile.TemporaryFile()
+            self.job_order = []
+            self.weights = {}
+        self.stream = open(path, "w")
+        self.stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.stream.write('<!-- generator: python (DIPA streaming writer) -->\n')
+        self.stream.write('<adag xmlns="{0}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="{0} {1}" version="{2}" name={3}>\n'.format(SCHEMA_NAMESPACE, SCHEMA_LOCATION, SCHEMA_VERSION, quoteattr(self.name)))
+
+    def addJob(self, job):
+        if job.id in self.job_ids:
+            raise DuplicateError("Duplicate job {0}".format(job.id))
+        self.job_ids.add(job.id)
+        self.job_count += 1
+        if self.recorder != None:
+            self.recorder(job)
+        element = job.toXML()
+        stream = self.stream
+        if self.prioritizer != None:
+            #Profiles follow the job's argument, if it has one.
+            index = 1 if len(element.children) > 0 and getattr(element.children[0], "name", None) == "argument" else 0
+            element.children.insert(index, self.prioritizer.placeholder())
+            self.job_order.append(job.id)
+            self.weights[job.id] = self.prioritizer.weight(job)
+            stream = self.jobs
+        stream.write("\t")
+        element.write(stream, level=1)
+        stream.write("\n")
+
+    def depends(self, child, parent, edge_label=None):
+        child_id = getattr(child, "id", child)
+        parent_id = getattr(parent, "id", parent)
+        self.edges.write("{0}\t{1}\n".format(child_id, parent_id))
+        self.edge_count += 1
+
+    def close(self):
+        """
+        Appends the spooled edges and closes the DAX. Consecutive edges into the same
+        child are written as one <child> element, which covers the planner's fan-ins.
+        """
+        if self.prioritizer != None:
+            self.__write_prioritized_jobs__()
+        self.edges.seek(0)
+        current, current_id = None, None
+        for line in self.edges:
+            child_id, parent_id = self.__read_edge__(line)
+            if child_id != current_id:
+                self.__write_child__(current)
+                current, current_id = Element("child", [("ref", child_id)]), child_id
+            current.element(Element("parent", [("ref", parent_id)]))
+        self.__write_child__(current)
+        self.stream.write("</adag>\n")
+        self.stream.close()
+        self.edges.close()
+
+    def __read_edge__(self, line):
+        child_id, parent_id = line.rstrip("\n").split("\t")
+        for job_id in [child_id, parent_id]:
+            if job_id not in self.job_ids:
+                raise FormatError("Dependency {0} -> {1} refers to a job that was never added".format(parent_id, child_id))
+        return child_id, parent_id
+
+    def __write_prioritized_jobs__(self):
+        children = dict([(job_id, []) for job_id in self.job_order])
+        parents = dict([(job_id, 0) for job_id in self.job_order])
+        self.edges.seek(0)
+        for line in self.edges:
+            child_id, parent_id = self.__read_edge__(line)
+            children[parent_id].append(child_id)
+            parents[child_id] += 1
+        priorities = self.prioritizer.priorities(self.weights, children, parents)
+        del children, parents
+        #Each spooled job holds exactly one placeholder, in the order the jobs were added.
+        order = iter(self.job_order)
+        self.jobs.seek(0)
+        for line in self.jobs:
+            if PLACEHOLDER in line:
+                line = line.replace(PLACEHOLDER, priorities[next(order)])
+            self.stream.write(line)
+        self.jobs.close()
+
+    def __write_child__(self, element):
+        if element is not None:
+            self.stream.write("\t")
+            element.write(self.stream, level=1)
+            self.stream.write("\n")
@@ -0,0 +1,132 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+
+#============================================================================
+#             Workflow Graph Statistics
+#============================================================================
+
+def format_bytes(count):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if count < 1024.0:
+            return "{0:.1f} {1}".format(count, unit)
+        count /= 1024.0
+    return "{0:.1f} TB".format(count)
+
+def adjacency(dax):
+    """
+    The children of each job in an in-memory ADAG, and the number of parents of each job.
+    """
+    children = dict([(job_id, []) for job_id in dax.jobs])
+    parents = dict([(job_id, 0) for job_id in dax.jobs])
+    for dependency in dax.dependencies:
+        parent = getattr(dependency.parent, "id", dependency.parent)
+        child = getattr(dependency.child, "id", dependency.child)
+        children[parent].append(child)
+        parents[child] += 1
+    return children, parents
+
+def topological_order(children, parents):
+    "Job ids ordered so that every job comes after all of its parents (Kahn's algorithm)."
+    remaining = dict(parents)
+    ready = [job_id for job_id, count in remaining.iteritems() if count == 0]
+    order = []
+    while len(ready) > 0:
+        job_id = ready.pop()
+        order.append(job_id)
+        for child in children[job_id]:
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                ready.append(child)
+    return order
+
+def longest_paths(children, parents, weights):
+    """
+    The longest weighted path from each job to the end of the workflow, including the job
+    itself, and the child that path continues through (None for the last job).
+    """
+    remaining = {}
+    following = {}
+    for job_id in reversed(topological_order(children, parents)):
+        longest = None
+        for child in children[job_id]:
+            if longest == None or remaining[child] > remaining[longest]:
+                longest = child
+        following[job_id] = longest
+        remaining[job_id] = weights[job_id] + (remaining[longest] if longest != None else 0)
+    return remaining, following
+
+class GraphStats(object):
+    """
+    Summarizes the job graph of a planned (in-memory) ADAG.
+
+    Each job's level is the length of the longest chain of jobs above it, so the jobs in a
+    level can all run at once once the level above has finished. The number of levels is
+    the critical path length in jobs, and the widest level bounds the useful number of slots.
+
+    Attributes:
+        job_count
+        edge_count
+        transformations
+        level_widths
+        critical_path
+
+    Methods:
+        add_sources
+        summary
+    """
+    def __init__(self, dax):
+        self.job_count = len(dax.jobs)
+        self.edge_count = len(dax.dependencies)
+        self.transformations = {}
+        for job in dax.jobs.values():
+            self.transformations[job.name] = self.transformations.get(job.name, 0) + 1
+        self.levels = self.__levels__(dax)
+        self.level_widths = [0] * (max(self.levels.values()) + 1 if len(self.levels) > 0 else 0)
+        for level in self.levels.values():
+            self.level_widths[level] += 1
+        self.critical_path = len(self.level_widths)
+        self.source_count = 0
+        self.source_bytes = 0
+        self.missing_sources = 0
+        self.stage_mode = "copy"
+
+    def __levels__(self, dax):
+        #The longest distance from a root for each job, filled in parents-first.
+        children, parents = adjacency(dax)
+        levels = {}
+        for job_id in topological_order(children, parents):
+            level = levels.setdefault(job_id, 0)
+            for child in children[job_id]:
+                levels[child] = max(levels.get(child, 0), level + 1)
+        return levels
+
+    def add_sources(self, sources, mode="copy"):
+        """
+        Estimates the bytes staged for the given distinct source files. Nothing is copied in
+        the 'symlink' and 'catalog' modes.
+        """
+        self.stage_mode = mode
+        for source in sources:
+            self.source_count += 1
+            try:
+                self.source_bytes += os.path.getsize(source)
+            except OSError:
+                self.missing_sources += 1
+
+    def summary(self):
+        lines = ["Jobs: {0}".format(self.job_count), "Edges: {0}".format(self.edge_count)]
+        lines.append("Jobs per transformation:")
+        width = max([len(name) for name in self.transformations] + [0])
+        for name, count in sorted(self.transformations.iteritems(), key=lambda item: (-item[1], item[0])):
+            lines.append("    {0} {1:>8}".format(name.ljust(width), count))
+        lines.append("Critical path: {0} jobs".format(self.critical_path))
+        if self.critical_path > 0:
+            lines.append("Maximum width: {0} jobs (level {1})".format(max(self.level_widths), self.level_widths.index(max(self.level_widths))))
+        lines.append("Width per level: {0}".format(" ".join([str(count) for count in self.level_widths])))
+        staged = self.source_bytes if self.stage_mode == "copy" else 0
+        lines.append("Estimated bytes staged: {0} ({1} source files{2}, stage mode '{3}')".format(format_bytes(staged), self.source_count,
+                     ", {0} not found".format(self.missing_sources) if self.missing_sources > 0 else "", self.stage_mode))
+        return lines
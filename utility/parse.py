@@ -4,8 +4,13 @@
 
 import sys
 import math
+import hashlib
 import pandas
 from console import Notice
+from preflight import read_nifti_header
+
+#Orders in which tiers are synthesized: a hash of the ID, the site column, or image dimensions and voxel size
+AUTO_TIER_METHODS = ["random", "site", "dims"]
 
 #============================================================================
 #             Console Class
@@ -13,7 +18,7 @@ from console import Notice
 
 class matrixparser(object):
     "Processes a matrix."
-    def __init__(self, matrix, hierarchy, name="Project", eddy_correction="eddy", is_shelled=True, template=None):
+    def __init__(self, matrix, hierarchy, name="Project", eddy_correction="eddy", is_shelled=True, template=None, auto_tiers=None, max_group=0, site_column="SITE"):
         self.name = name
         self.hierarchy = hierarchy
         self.eddy_correction = eddy_correction
@@ -46,24 +51,129 @@ class matrixparser(object):
             missingcols = list(set(expected_columns).difference(set(self.matrix.columns)))
             self.warnings.append(Notice("Error", "You are missing required columns [{0}] in your input file.".format(", ".join(missingcols))))
 
-        self.matrix["FULL"] = self.matrix.apply(lambda row: self.__get_unique_matrix_key__(row), axis=1)
+        #Tiers synthesized between the last one given and ID, so that no group has more than max_group sources.
+        self.max_group = int(max_group)
+        if auto_tiers != None and self.is_valid:
+            if template != None:
+                self.warnings.append(Notice("Warning", "Subjects registered to a template (--template) are not grouped, so no tiers were added."))
+            else:
+                self.__add_tiers__(auto_tiers, site_column)
+
+        self.matrix["FULL"] = self.__get_unique_matrix_keys__(self.matrix)
 
+        #One frame per file column, interleaved back into row order (DWI, BVALS, BVECS, ...).
+        file_columns = [("DWI", "_dwi.nii.gz"), ("BVALS", "_bvals.txt"), ("BVECS", "_bvecs.txt")]
+        if self.eddy_correction == "eddy":
+            file_columns.extend([("MASK", "_dwi_mask.nii.gz"), ("INDEX", "_index.txt"), ("ACQPARAMS", "_acqparams.txt")])
+        file_columns = [(column, suffix) for column, suffix in file_columns if column in self.matrix.columns]
         assembler = []
-        for index, row in self.matrix.iterrows():
-            assembler.append({"SOURCE":row["DWI"],"DESTINATION":row["FULL"]+"_dwi.nii.gz"})
-            assembler.append({"SOURCE":row["BVALS"],"DESTINATION":row["FULL"]+"_bvals.txt"})
-            assembler.append({"SOURCE":row["BVECS"],"DESTINATION":row["FULL"]+"_bvecs.txt"})
-            if self.eddy_correction == "eddy":
-                assembler.append({"SOURCE":row["MASK"],"DESTINATION":row["FULL"]+"_dwi_mask.nii.gz"})
-                assembler.append({"SOURCE":row["INDEX"],"DESTINATION":row["FULL"]+"_index.txt"})
-                assembler.append({"SOURCE":row["ACQPARAMS"],"DESTINATION":row["FULL"]+"_acqparams.txt"})
+        for column, suffix in file_columns:
+            assembler.append(pandas.DataFrame({"SOURCE": self.matrix[column], "DESTINATION": self.matrix["FULL"]+suffix, "FULL": self.matrix["FULL"]}))
+        if len(assembler) > 0:
+            mappings = pandas.concat(assembler).sort_index(kind="mergesort")
+        else:
+            mappings = pandas.DataFrame(columns=["SOURCE", "DESTINATION", "FULL"])
 
         if template != None:
-            assembler.append({"SOURCE":template,"DESTINATION":self.name+"_template_orig.nii.gz"})
-        self.mappings = pandas.DataFrame(assembler)
+            mappings = mappings.append(pandas.DataFrame([{"SOURCE":template,"DESTINATION":self.name+"_template_orig.nii.gz","FULL":None}]))
+        self.mappings = mappings.reset_index(drop=True)[["SOURCE", "DESTINATION", "FULL"]]
+
+    def __add_tiers__(self, method, site_column):
+        """
+        Inserts AUTO1, AUTO2, ... tiers above ID, as few as keep every group to max_group sources.
+        The subjects of each group are ordered by the method, then split into contiguous groups of
+        near-equal size, tier by tier, with the same fan-out (the least that fits) in every tier.
+        Group ids are unique across tiers, as template files are named by them.
+        """
+        if method not in AUTO_TIER_METHODS:
+            self.warnings.append(Notice("Error", "Tiers can only be added by one of {0}.".format(AUTO_TIER_METHODS)))
+            self.is_valid = False
+            return
+        if self.max_group < 2:
+            self.warnings.append(Notice("Error", "Adding tiers needs a largest group size (--max_group) of at least 2."))
+            self.is_valid = False
+            return
+        if method == "site" and site_column not in self.matrix.columns:
+            self.warnings.append(Notice("Error", "The site column {0} is not in your input file.".format(site_column)))
+            self.is_valid = False
+            return
+
+        groups = [group.index for key, group in self.matrix.groupby(self.hierarchy[:-1], sort=False)]
+        largest = max([len(group) for group in groups])
+        depth = 0
+        while self.max_group ** (depth+1) < largest:
+            depth += 1
+        if depth == 0:
+            return
+        tiers = ["AUTO{0}".format(level) for level in range(1, depth+1)]
+        clashes = [tier for tier in tiers if tier in self.matrix.columns]
+        if len(clashes) > 0:
+            self.warnings.append(Notice("Error", "Your input file already has the columns [{0}], which would be added as tiers.".format(", ".join(clashes))))
+            self.is_valid = False
+            return
+
+        keys = self.__order_keys__(method, site_column)
+        values = [{} for tier in tiers]
+        counters = [0 for tier in tiers]
+        for group in groups:
+            rows = sorted(group, key=lambda row: keys[row])
+            fanout = 1
+            while fanout ** (depth+1) < len(rows):
+                fanout += 1
+            self.__split__(rows, fanout, 0, depth, values, counters)
+        for tier, tier_values in zip(tiers, values):
+            self.matrix[tier] = pandas.Series(tier_values)
+        self.hierarchy = self.hierarchy[:-1] + tiers + ["ID"]
+        self.warnings.append(Notice("Log", "Added the tiers [{0}] ({1}), so that no group has more than {2} sources.".format(", ".join(tiers), method, self.max_group)))
+
+    def __order_keys__(self, method, site_column):
+        #A sort key per row. Ties keep the order of the input file.
+        ids = [hashlib.md5(str(value).encode("utf-8")).hexdigest() for value in self.matrix["ID"]]
+        if method == "random":
+            #A hash, rather than a shuffle, so subjects keep their groups when others are added or removed.
+            return dict(zip(self.matrix.index, ids))
+        if method == "site":
+            sites = self.matrix[site_column].fillna("").astype(str)
+            return dict(zip(self.matrix.index, zip(sites, range(len(sites)))))
+        keys = {}
+        unreadable = 0
+        for position, (row, path) in enumerate(zip(self.matrix.index, self.matrix["DWI"])):
+            try:
+                header = read_nifti_header(path)
+                keys[row] = (0, [round(pixdim, 3) for pixdim in header["pixdim"][0:3]], header["dim"][0:3], position)
+            except Exception:
+                unreadable += 1
+                keys[row] = (1, [], [], position)
+        if unreadable > 0:
+            self.warnings.append(Notice("Warning", "Could not read the DWI header of {0} rows, which were grouped last.".format(unreadable)))
+        return keys
+
+    def __split__(self, rows, fanout, level, depth, values, counters):
+        #Splits rows into as few near-equal groups as hold at most fanout ** (depth - level) rows each.
+        capacity = fanout ** (depth - level)
+        count = int(math.ceil(len(rows) / float(capacity)))
+        for part in range(count):
+            part_rows = rows[len(rows) * part // count:len(rows) * (part+1) // count]
+            group_id = "A{0}G{1}".format(level+1, counters[level])
+            counters[level] += 1
+            for row in part_rows:
+                values[level][row] = group_id
+            if level+1 < depth:
+                self.__split__(part_rows, fanout, level+1, depth, values, counters)
+
+    def reject(self, full_ids):
+        """
+        Removes rows (by FULL key) from the matrix and the file mappings.
+        """
+        self.matrix = self.matrix[~self.matrix["FULL"].isin(full_ids)].reset_index(drop=True)
+        self.mappings = self.mappings[~self.mappings["FULL"].isin(full_ids)].reset_index(drop=True)
 
-    def __get_unique_matrix_key__(self, row):
-        values = []
+    def __get_unique_matrix_keys__(self, matrix):
+        keys = None
         for level in self.hierarchy:
-            values.append(level+"-"+str(row[level]))
-        return "_".join(values)
+            values = level+"-"+matrix[level].astype(str)
+            if keys is None:
+                keys = values
+            else:
+                keys = keys+"_"+values
+        return keys
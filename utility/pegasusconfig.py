@@ -0,0 +1,87 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+import sys
+import json
+import subprocess
+
+#============================================================================
+#             Pegasus Python Lookup
+#============================================================================
+
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "dipa", "pegasus-config.json")
+
+def find_executable(name):
+    "The resolved path of 'name' on the PATH, or None."
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+    return None
+
+def read_cache():
+    try:
+        with open(CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_cache(cache):
+    try:
+        if not os.path.exists(os.path.dirname(CACHE_FILE)):
+            os.makedirs(os.path.dirname(CACHE_FILE))
+        with open(CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    except (IOError, OSError):
+        #The cache only saves time; failing to write it is not an error.
+        pass
+
+def pegasus_python_paths():
+    """
+    The directories of Pegasus' Python modules and their externals ('pegasus-config --python'
+    and '--python-externals').
+    Results are cached per installation (the resolved pegasus-config), and recomputed
+    whenever that pegasus-config changes or one of the cached directories disappears.
+    """
+    config = find_executable("pegasus-config")
+    if config == None:
+        return []
+    mtime = os.path.getmtime(config)
+    cache = read_cache()
+    entry = cache.get(config)
+    if entry != None and entry["mtime"] == mtime and all([os.path.isdir(path) for path in entry["paths"]]):
+        return [str(path) for path in entry["paths"]]
+
+    paths = []
+    for option in ["--python", "--python-externals"]:
+        try:
+            path = subprocess.Popen([config, option], stdout=subprocess.PIPE).communicate()[0].strip()
+        except OSError:
+            return []
+        if path != "" and os.path.isdir(path):
+            paths.append(path)
+    cache[config] = {"mtime": mtime, "paths": paths}
+    write_cache(cache)
+    return paths
+
+def load_pegasus():
+    """
+    Makes Pegasus.DAX3 importable. An already importable Pegasus (e.g. via PYTHONPATH) is
+    used as is; otherwise the cached pegasus-config lookup is added to sys.path.
+    Returns True if Pegasus.DAX3 could be imported.
+    """
+    try:
+        import Pegasus.DAX3
+        return True
+    except ImportError:
+        pass
+    for path in reversed(pegasus_python_paths()):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    try:
+        import Pegasus.DAX3
+        return True
+    except ImportError:
+        return False
@@ -0,0 +1,176 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+import gzip
+import struct
+from multiprocessing.pool import ThreadPool
+from console import Notice
+
+#============================================================================
+#             NIfTI Headers
+#============================================================================
+
+def read_nifti_header(path):
+    """
+    Reads the dims, pixdims and datatype of a NIfTI-1 or NIfTI-2 file (optionally gzipped),
+    from the header alone. Returns a dictionary, or raises IOError if it is not a NIfTI file.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        header = f.read(540)
+    if len(header) < 348:
+        raise IOError("{0} is too short to be a NIfTI file".format(path))
+    for endian in ["<", ">"]:
+        sizeof_hdr = struct.unpack(endian+"i", header[0:4])[0]
+        if sizeof_hdr == 348:
+            dim = struct.unpack(endian+"8h", header[40:56])
+            datatype = struct.unpack(endian+"h", header[70:72])[0]
+            pixdim = struct.unpack(endian+"8f", header[76:108])
+            break
+        elif sizeof_hdr == 540 and len(header) == 540:
+            datatype = struct.unpack(endian+"h", header[12:14])[0]
+            dim = struct.unpack(endian+"8q", header[16:80])
+            pixdim = struct.unpack(endian+"8d", header[104:168])
+            break
+    else:
+        raise IOError("{0} does not have a NIfTI header".format(path))
+    ndim = dim[0]
+    if ndim < 1 or ndim > 7:
+        raise IOError("{0} has an invalid number of dimensions ({1})".format(path, ndim))
+    return {"ndim": ndim, "dim": list(dim[1:ndim+1]), "pixdim": list(pixdim[1:ndim+1]), "datatype": datatype}
+
+def is_path(value):
+    #An empty cell is read by pandas as NaN, a float, rather than a path.
+    return isinstance(value, basestring) and value.strip() != ""
+
+def read_table(path):
+    #Whitespace (or comma) separated numbers, as in bvals/bvecs/index/acqparams files.
+    with open(path, "r") as f:
+        return [line.replace(",", " ").split() for line in f if line.strip() != ""]
+
+#============================================================================
+#             Preflight Checks
+#============================================================================
+
+class Preflight(object):
+    """
+    Checks the input files of every row before anything is staged or submitted.
+
+    Every distinct path is read concurrently in a pool of 'width' threads: images for their
+    NIfTI header, and text files for their table of values. Each row is then checked for
+    missing or unreadable files, a 4D DWI, a mask that matches the DWI grid, and bvals, bvecs
+    and index files that have one entry per volume.
+
+    Attributes:
+        problems
+
+    Methods:
+        check
+        notices
+    """
+    image_columns = ["DWI", "MASK"]
+
+    def __init__(self, matrix, eddy_correction="eddy", width=16):
+        self.matrix = matrix
+        self.width = max(1, int(width))
+        self.columns = ["DWI", "BVALS", "BVECS"]
+        if eddy_correction == "eddy":
+            self.columns.extend(["MASK", "INDEX", "ACQPARAMS"])
+        self.problems = {}
+        self.tasks = []
+        seen = set()
+        for column in self.columns:
+            for path in self.matrix[column].unique():
+                if is_path(path) and path not in seen:
+                    seen.add(path)
+                    self.tasks.append((path, column in self.image_columns))
+
+    def __read__(self, task):
+        #Runs in a worker thread. Returns (path, contents, error).
+        path, is_image = task
+        try:
+            if os.path.getsize(path) == 0:
+                return path, None, "is empty"
+            if is_image:
+                return path, read_nifti_header(path), None
+            return path, read_table(path), None
+        except (IOError, OSError, struct.error) as e:
+            if not os.path.exists(path):
+                return path, None, "does not exist"
+            return path, None, "could not be read ({0})".format(e)
+
+    def __check_row__(self, row, contents, errors):
+        problems = []
+        for column in self.columns:
+            if not is_path(row[column]):
+                problems.append("{0} is missing".format(column))
+            elif row[column] in errors:
+                problems.append("{0} {1} {2}".format(column, row[column], errors[row[column]]))
+        if len(problems) > 0:
+            return problems
+
+        dwi = contents[row["DWI"]]
+        if dwi["ndim"] != 4 or dwi["dim"][3] < 2:
+            return ["DWI {0} is not a 4D series (dims {1})".format(row["DWI"], dwi["dim"])]
+        volumes = dwi["dim"][3]
+
+        bvals = [value for line in contents[row["BVALS"]] for value in line]
+        if len(bvals) != volumes:
+            problems.append("BVALS has {0} values for {1} DWI volumes".format(len(bvals), volumes))
+        bvecs = contents[row["BVECS"]]
+        bvec_shape = (len(bvecs), len(bvecs[0]) if len(bvecs) > 0 else 0)
+        if bvec_shape not in [(3, volumes), (volumes, 3)]:
+            problems.append("BVECS is {0}x{1}, expected 3x{2}".format(bvec_shape[0], bvec_shape[1], volumes))
+
+        if "MASK" in self.columns:
+            mask = contents[row["MASK"]]
+            if mask["dim"][0:3] != dwi["dim"][0:3]:
+                problems.append("MASK dims {0} do not match DWI dims {1}".format(mask["dim"][0:3], dwi["dim"][0:3]))
+            elif any([abs(a - b) > 1e-3 for a, b in zip(mask["pixdim"][0:3], dwi["pixdim"][0:3])]):
+                problems.append("MASK voxel size {0} does not match DWI voxel size {1}".format(mask["pixdim"][0:3], dwi["pixdim"][0:3]))
+            index = [value for line in contents[row["INDEX"]] for value in line]
+            acqparams = contents[row["ACQPARAMS"]]
+            if len(index) != volumes:
+                problems.append("INDEX has {0} values for {1} DWI volumes".format(len(index), volumes))
+            if any([len(line) != 4 for line in acqparams]):
+                problems.append("ACQPARAMS does not have 4 columns on every line")
+            elif len(index) > 0 and max([int(float(value)) for value in index]) > len(acqparams):
+                problems.append("INDEX refers to more ACQPARAMS lines than the {0} present".format(len(acqparams)))
+        return problems
+
+    def check(self, progressbar=None):
+        """
+        Reads every file and checks every row. Returns the FULL keys of the rows that failed,
+        with their problems in self.problems.
+        """
+        contents = {}
+        errors = {}
+        pool = ThreadPool(processes=self.width)
+        try:
+            for index, result in enumerate(pool.imap_unordered(self.__read__, self.tasks)):
+                path, content, error = result
+                if error != None:
+                    errors[path] = error
+                else:
+                    contents[path] = content
+                if progressbar != None:
+                    progressbar.update(index+1)
+        finally:
+            pool.close()
+            pool.join()
+
+        columns = self.columns + ["FULL"]
+        for values in zip(*[self.matrix[column] for column in columns]):
+            row = dict(zip(columns, values))
+            try:
+                problems = self.__check_row__(row, contents, errors)
+            except (ValueError, IndexError, KeyError) as e:
+                problems = ["could not be checked ({0})".format(e)]
+            if len(problems) > 0:
+                self.problems[row["FULL"]] = problems
+        return list(self.problems.keys())
+
+    def notices(self):
+        return [Notice("Warning", "Rejecting {0}: {1}.".format(full_id, "; ".join(problems))) for full_id, problems in sorted(self.problems.iteritems())]
@@ -0,0 +1,64 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+from Pegasus.DAX3 import Profile, Namespace, Element
+from graph import adjacency, longest_paths
+from simulate import job_runtime
+
+#============================================================================
+#             Critical Path Priorities
+#============================================================================
+
+PLACEHOLDER = "@DIPA_PRIORITY@"
+#Jobs that wait, holding a slot, for jobs that run beside them (pipelined means' accumulators).
+#They get the lowest priority, so that they are never run ahead of the jobs they wait for.
+WAITING_TRANSFORMATIONS = ["Normalize_MeanAccumulate"]
+
+class Prioritizer(object):
+    """
+    Gives every job a condor 'priority' profile: the estimated seconds on its longest path
+    to the end of the workflow, weighted by the cost model. Jobs that gate a group mean early
+    in the template iterations have the longest paths, so they are run before jobs, such as
+    the orientation check renders, that nothing else is waiting for. Jobs that wait for the
+    jobs beside them (WAITING_TRANSFORMATIONS) are given priority 0 instead.
+
+    An in-memory ADAG is prioritized with apply, once every job and edge has been added.
+    A StreamingADAG has already written its jobs by then, so it is given the prioritizer
+    instead: it records each job's weight, writes a placeholder profile, and fills in the
+    priorities with priorities() when it is closed.
+
+    Methods:
+        apply
+        weight
+        placeholder
+        priorities
+    """
+    def __init__(self, model):
+        self.model = model
+        self.waiting = set()
+
+    def weight(self, job):
+        if job.name in WAITING_TRANSFORMATIONS:
+            self.waiting.add(job.id)
+        return job_runtime(self.model, job)
+
+    def __priority__(self, job_id, remaining):
+        if job_id in self.waiting:
+            return "0"
+        return str(int(round(remaining[job_id])))
+
+    def apply(self, dax):
+        weights = dict([(job_id, self.weight(job)) for job_id, job in dax.jobs.iteritems()])
+        children, parents = adjacency(dax)
+        remaining, following = longest_paths(children, parents, weights)
+        for job_id, job in dax.jobs.iteritems():
+            job.addProfile(Profile(Namespace.CONDOR, "priority", self.__priority__(job_id, remaining)))
+        return dax
+
+    def placeholder(self):
+        return Element("profile", [("namespace", Namespace.CONDOR), ("key", "priority")]).text(PLACEHOLDER)
+
+    def priorities(self, weights, children, parents):
+        remaining, following = longest_paths(children, parents, weights)
+        return dict([(job_id, self.__priority__(job_id, remaining)) for job_id in remaining])
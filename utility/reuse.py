@@ -0,0 +1,141 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+import json
+import time
+import hashlib
+from Pegasus.DAX3 import Link
+
+#============================================================================
+#             Output Manifest
+#============================================================================
+
+class OutputManifest(object):
+    """
+    Tracks which files in ${ProjectDir}/outputs are still valid for the workflow being planned.
+
+    Every output is given a signature: a hash of the transformation and arguments of the job
+    that makes it, and of the signatures of that job's inputs. Staged source files are keyed
+    by their source path, size and mtime, and generated list files by their contents. An
+    output from a previous run is reused only if its signature has not changed since it
+    was planned, and the file in outputs/ was written after that plan. Pegasus then prunes
+    every job whose outputs are all listed in the replica cache.
+
+    Attributes:
+        outputdir
+        manifestfile
+        cachefile
+
+    Methods:
+        record
+        add_sources
+        add_files
+        update
+    """
+    def __init__(self, outputdir):
+        self.outputdir = outputdir
+        self.manifestfile = outputdir+"/dipa_manifest.json"
+        self.cachefile = outputdir+"/dipa_replicas.cache"
+        self.jobs = {}
+        self.producers = {}
+        self.sources = {}
+        self.files = {}
+
+    def record(self, job):
+        #Only what the signature needs is kept, so this also works alongside a StreamingADAG.
+        inputs = []
+        outputs = []
+        for use in job.used:
+            lfn = getattr(use.name, "name", use.name)
+            if use.link == Link.INPUT:
+                inputs.append(lfn)
+            else:
+                outputs.append(lfn)
+        arguments = " ".join([str(getattr(argument, "name", argument)) for argument in job.arguments])
+        self.jobs[job.id] = (hashlib.sha1(job.name+"\0"+arguments).hexdigest(), sorted(inputs))
+        for lfn in outputs:
+            self.producers[lfn] = job.id
+
+    def add_sources(self, mappings):
+        self.sources.update(zip(mappings["DESTINATION"], mappings["SOURCE"]))
+
+    def add_files(self, files):
+        self.files.update(files)
+
+    def __input_signature__(self, lfn):
+        if lfn in self.files:
+            return "file:"+hashlib.sha1(self.files[lfn]).hexdigest()
+        if lfn in self.sources:
+            try:
+                stat = os.stat(self.sources[lfn])
+                return "source:{0}:{1}:{2}".format(self.sources[lfn], stat.st_size, int(stat.st_mtime))
+            except OSError:
+                return "missing:"+self.sources[lfn]
+        return "unknown:"+lfn
+
+    def __job_signatures__(self):
+        #Resolves job signatures parents-first, without recursing down long iteration chains.
+        signatures = {}
+        for job_id in self.jobs:
+            stack = [job_id]
+            while len(stack) > 0:
+                current = stack[-1]
+                if current in signatures:
+                    stack.pop()
+                    continue
+                parameters, inputs = self.jobs[current]
+                pending = [self.producers[lfn] for lfn in inputs if lfn in self.producers and self.producers[lfn] not in signatures]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                parts = [parameters]
+                for lfn in inputs:
+                    if lfn in self.producers:
+                        parts.append(lfn+"="+signatures[self.producers[lfn]])
+                    else:
+                        parts.append(lfn+"="+self.__input_signature__(lfn))
+                signatures[current] = hashlib.sha1("\n".join(parts)).hexdigest()
+                stack.pop()
+        return signatures
+
+    def __existing_outputs__(self):
+        existing = {}
+        for root, dirs, filenames in os.walk(self.outputdir):
+            for filename in filenames:
+                existing[filename] = os.path.join(root, filename)
+        return existing
+
+    def update(self):
+        """
+        Compares the planned outputs against the previous manifest and the files in outputs/.
+        Writes the new manifest and a replica cache of the outputs that can be reused.
+        Returns the number of reusable outputs.
+        """
+        previous = {}
+        if os.path.exists(self.manifestfile):
+            with open(self.manifestfile, "r") as f:
+                previous = json.load(f)
+
+        planned = time.time()
+        signatures = self.__job_signatures__()
+        existing = self.__existing_outputs__()
+        manifest = {}
+        reusable = []
+        for lfn, job_id in sorted(self.producers.iteritems()):
+            signature = signatures[job_id]
+            if lfn in previous and previous[lfn]["signature"] == signature:
+                manifest[lfn] = previous[lfn]
+                #An older file in outputs/ may predate the plan that this signature came from.
+                if lfn in existing and os.path.getmtime(existing[lfn]) >= previous[lfn]["planned"]:
+                    reusable.append((lfn, existing[lfn]))
+            else:
+                manifest[lfn] = {"signature": signature, "planned": planned}
+
+        with open(self.manifestfile, "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+        with open(self.cachefile, "w") as f:
+            for lfn, path in reusable:
+                f.write('{0} file://{1} site="local"\n'.format(lfn, path))
+        return len(reusable)
@@ -0,0 +1,186 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+import re
+import json
+import heapq
+from Pegasus.DAX3 import Link
+from graph import adjacency, longest_paths
+
+#============================================================================
+#             Cost Model
+#============================================================================
+
+def read_cost_model(path):
+    """
+    Reads a cost model: for each transformation (and a 'default'), its 'runtime' in seconds,
+    the 'runtime_per_input' in seconds added for each input file (for the means), and its
+    'memory' in MB.
+    """
+    with open(path, "r") as f:
+        model = json.load(f)
+    return dict([(str(name), entry) for name, entry in model.iteritems()])
+
+def read_kickstart_records(directory):
+    """
+    Reads the kickstart invocation records (XML or YAML) of the *.out files under a submit
+    directory. Returns a dictionary of transformation -> list of (duration, maxrss in MB).
+    """
+    records = {}
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            if not re.search(r"\.out(\.\d+)?$", filename):
+                continue
+            with open(os.path.join(root, filename), "r") as f:
+                contents = f.read()
+            #A clustered job holds one record per clustered invocation.
+            for record in re.split(r"<invocation\b|^- invocation:", contents, flags=re.M)[1:]:
+                transformation = re.search(r'transformation\s*[=:]\s*"?(?:\w+::)?([\w\.]+)', record)
+                duration = re.search(r'\bduration\s*[=:]\s*"?([\d\.]+)', record)
+                if transformation == None or duration == None:
+                    continue
+                maxrss = [int(value) for value in re.findall(r'\bmaxrss\s*[=:]\s*"?(\d+)', record)]
+                records.setdefault(transformation.group(1), []).append((float(duration.group(1)), max(maxrss + [0]) / 1024.0))
+    return records
+
+def learn_cost_model(model, records):
+    """
+    Replaces each transformation's runtime with its median recorded duration, and its
+    memory with its largest recorded maxrss. The records do not say how many inputs a job
+    read, so learned transformations lose their per-input runtime.
+    """
+    learned = dict(model)
+    for transformation, values in records.iteritems():
+        durations = sorted([duration for duration, maxrss in values])
+        entry = dict(learned.get(transformation, learned.get("default", {})))
+        entry["runtime"] = durations[len(durations) // 2]
+        entry["runtime_per_input"] = 0
+        memory = max([maxrss for duration, maxrss in values])
+        if memory > 0:
+            entry["memory"] = memory
+        learned[transformation] = entry
+    return learned
+
+def job_runtime(model, job):
+    "The estimated runtime of a job in seconds. Optional inputs are not counted, as they may not be read."
+    entry = model.get(job.name, model.get("default", {}))
+    inputs = len([use for use in job.used if use.link == Link.INPUT and not use.optional])
+    return float(entry.get("runtime", 60)) + float(entry.get("runtime_per_input", 0)) * inputs
+
+def format_duration(seconds):
+    days, seconds = divmod(int(round(seconds)), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days > 0:
+        return "{0}d {1}h {2}m".format(days, hours, minutes)
+    if hours > 0:
+        return "{0}h {1}m".format(hours, minutes)
+    return "{0}m {1}s".format(minutes, seconds)
+
+#============================================================================
+#             Makespan Simulation
+#============================================================================
+
+class Simulator(object):
+    """
+    Predicts the makespan of a planned (in-memory) ADAG on a pool of slots.
+
+    Each job's runtime and memory come from the cost model. The simulation is a list
+    scheduler driven by job completion events: whenever a slot (and enough pool memory)
+    is free, the ready job with the longest remaining path to the end of the workflow is
+    started, as a DAGMan with job priorities would. Barriers, such as each tier's means,
+    show up as levels where the pool drains before the next level can start.
+
+    Attributes:
+        runtimes
+        memory
+        critical_path
+        critical_seconds
+
+    Methods:
+        run
+        summary
+    """
+    def __init__(self, dax, model):
+        default = model.get("default", {})
+        self.names = {}
+        self.runtimes = {}
+        self.memory = {}
+        for job_id, job in dax.jobs.iteritems():
+            self.names[job_id] = job.name
+            self.runtimes[job_id] = job_runtime(model, job)
+            self.memory[job_id] = float(model.get(job.name, default).get("memory", 512))
+        self.children, self.parents = adjacency(dax)
+        self.remaining, following = longest_paths(self.children, self.parents, self.runtimes)
+        self.critical_path = []
+        if len(self.remaining) > 0:
+            job_id = max(self.remaining, key=lambda key: self.remaining[key])
+            self.critical_seconds = self.remaining[job_id]
+            while job_id != None:
+                self.critical_path.append(job_id)
+                job_id = following[job_id]
+        else:
+            self.critical_seconds = 0
+
+    def run(self, slots, pool_memory=None):
+        """
+        Simulates the workflow on 'slots' slots, sharing 'pool_memory' MB if given.
+        Returns a dictionary with the makespan, utilization and peak memory in use.
+        """
+        slots = max(1, int(slots))
+        waiting = dict(self.parents)
+        ready = [(-self.remaining[job_id], job_id) for job_id, count in waiting.iteritems() if count == 0]
+        heapq.heapify(ready)
+        running = []
+        now = 0.0
+        busy = 0.0
+        memory_in_use = 0.0
+        peak_memory = 0.0
+        while len(ready) > 0 or len(running) > 0:
+            deferred = []
+            while len(ready) > 0 and len(running) < slots:
+                priority, job_id = heapq.heappop(ready)
+                #A job that needs more than the whole pool runs once the pool is empty.
+                memory = self.memory[job_id] if pool_memory == None else min(self.memory[job_id], pool_memory)
+                if pool_memory != None and memory_in_use + memory > pool_memory:
+                    deferred.append((priority, job_id))
+                    continue
+                memory_in_use += memory
+                peak_memory = max(peak_memory, memory_in_use)
+                busy += self.runtimes[job_id]
+                heapq.heappush(running, (now + self.runtimes[job_id], job_id, memory))
+            for item in deferred:
+                heapq.heappush(ready, item)
+            if len(running) == 0:
+                break
+            now, job_id, memory = heapq.heappop(running)
+            finished = [(job_id, memory)]
+            while len(running) > 0 and running[0][0] == now:
+                finished.append(heapq.heappop(running)[1:])
+            for job_id, memory in finished:
+                memory_in_use -= memory
+                for child in self.children[job_id]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        heapq.heappush(ready, (-self.remaining[child], child))
+        utilization = busy / (slots * now) if now > 0 else 0.0
+        return {"slots": slots, "makespan": now, "utilization": utilization, "peak_memory": peak_memory}
+
+    def summary(self, results):
+        lines = []
+        for result in results:
+            lines.append("Simulated on {0} slots: makespan {1}, utilization {2:.1f}%, peak memory {3:.0f} MB".format(
+                         result["slots"], format_duration(result["makespan"]), 100 * result["utilization"], result["peak_memory"]))
+        lines.append("Weighted critical path: {0} over {1} jobs".format(format_duration(self.critical_seconds), len(self.critical_path)))
+        seconds = {}
+        counts = {}
+        for job_id in self.critical_path:
+            name = self.names[job_id]
+            seconds[name] = seconds.get(name, 0) + self.runtimes[job_id]
+            counts[name] = counts.get(name, 0) + 1
+        width = max([len(name) for name in seconds] + [0])
+        for name in sorted(seconds, key=lambda key: -seconds[key]):
+            lines.append("    {0} {1:>6} jobs {2:>12}".format(name.ljust(width), counts[name], format_duration(seconds[name])))
+        return lines
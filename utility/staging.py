@@ -0,0 +1,169 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import os
+import time
+import shutil
+from multiprocessing.pool import ThreadPool
+from console import Notice
+
+#============================================================================
+#             Input Staging
+#============================================================================
+
+class Stager(object):
+    """
+    Stages the SOURCE -> DESTINATION mappings of a matrixparser into a directory.
+
+    In 'copy' mode, copies run in a pool of 'width' threads, since they are bound by the (often NFS) source.
+    Each distinct source is copied once. Further destinations of a shared source, such as
+    the index and acqparams files, are hardlinked to that copy. A destination is skipped if
+    it already matches its source's size and mtime (copies keep the source mtime).
+
+    When the sources are on a filesystem that the site can already read, nothing needs to be
+    copied. The 'symlink' mode fills the directory with symlinks to the sources instead, and
+    the 'catalog' mode leaves the directory alone and writes a replica cache that maps each
+    destination name straight to its source. With pegasus.transfer.links set, Pegasus will
+    then symlink the sources into the jobs' working directories as well.
+
+    Attributes:
+        directory
+        width
+        copied_bytes
+        copied
+        linked
+        skipped
+
+    Methods:
+        stage
+        catalog
+    """
+    modes = ["copy", "symlink", "catalog"]
+
+    def __init__(self, mappings, directory, width=4, mode="copy"):
+        self.directory = directory
+        self.width = max(1, int(width))
+        self.mode = mode
+        self.names = {}
+        self.sources = []
+        destinations = {}
+        for source, destination in zip(mappings["SOURCE"], mappings["DESTINATION"]):
+            if source not in destinations:
+                destinations[source] = []
+                self.sources.append(source)
+            destinations[source].append(os.path.join(directory, destination))
+            self.names[destination] = source
+        self.destinations = destinations
+        self.copied_bytes = 0
+        self.copied = 0
+        self.linked = 0
+        self.skipped = 0
+
+    def __is_current__(self, source, destination):
+        if os.path.islink(destination):
+            return False
+        try:
+            source_stat = os.stat(source)
+            destination_stat = os.stat(destination)
+        except OSError:
+            return False
+        return source_stat.st_size == destination_stat.st_size and int(source_stat.st_mtime) == int(destination_stat.st_mtime)
+
+    def __stage_source__(self, source):
+        #Runs in a worker thread. Returns (copied bytes, copied, linked, skipped, errors).
+        copied_bytes, copied, linked, skipped, errors = 0, 0, 0, 0, []
+        first = self.destinations[source][0]
+        partial = first+".part"
+        try:
+            if self.__is_current__(source, first):
+                skipped += 1
+            else:
+                #Copy under a temporary name, so an interrupted copy is never mistaken for a current one.
+                shutil.copy2(source, partial)
+                os.rename(partial, first)
+                copied_bytes += os.path.getsize(first)
+                copied += 1
+        except (IOError, OSError):
+            if os.path.exists(partial):
+                os.remove(partial)
+            errors.append("Could not copy file {0} to {1}".format(source, first))
+            return copied_bytes, copied, linked, skipped, errors
+
+        for destination in self.destinations[source][1:]:
+            try:
+                if os.path.exists(destination) and os.path.samefile(first, destination):
+                    skipped += 1
+                    continue
+                if os.path.lexists(destination):
+                    os.remove(destination)
+                os.link(first, destination)
+                linked += 1
+            except (IOError, OSError):
+                #Hardlinks can be refused (e.g. by some network filesystems), so fall back to copying.
+                try:
+                    shutil.copy2(first, destination)
+                    copied_bytes += os.path.getsize(destination)
+                    copied += 1
+                except (IOError, OSError):
+                    errors.append("Could not copy file {0} to {1}".format(source, destination))
+        return copied_bytes, copied, linked, skipped, errors
+
+    def __link_source__(self, source):
+        #Runs in a worker thread. Symlinks every destination to the source itself.
+        linked, skipped, errors = 0, 0, []
+        if not os.path.exists(source):
+            return 0, 0, linked, skipped, ["Could not find file {0}".format(source)]
+        #A relative target would be resolved against the link's directory, not ours.
+        target = os.path.abspath(source)
+        for destination in self.destinations[source]:
+            try:
+                if os.path.islink(destination) and os.readlink(destination) == target:
+                    skipped += 1
+                    continue
+                if os.path.lexists(destination):
+                    os.remove(destination)
+                os.symlink(target, destination)
+                linked += 1
+            except (IOError, OSError):
+                errors.append("Could not link file {0} to {1}".format(source, destination))
+        return 0, 0, linked, skipped, errors
+
+    def catalog(self, path, site):
+        """
+        Writes a replica cache mapping every destination name to its source on 'site'.
+        """
+        with open(path, "w") as f:
+            for name, source in sorted(self.names.iteritems()):
+                f.write('{0} file://{1} site="{2}"\n'.format(name, os.path.abspath(source), site))
+        return Notice("Log", "Registered {0} source files in {1}.".format(len(self.names), path))
+
+    def stage(self, progressbar=None):
+        """
+        Stages every source, updating the progressbar as each one finishes.
+        Returns a Notice summarizing the throughput.
+        """
+        start = time.time()
+        pool = ThreadPool(processes=self.width)
+        try:
+            if self.mode == "symlink":
+                worker = self.__link_source__
+            else:
+                worker = self.__stage_source__
+            for index, result in enumerate(pool.imap_unordered(worker, self.sources)):
+                copied_bytes, copied, linked, skipped, errors = result
+                self.copied_bytes += copied_bytes
+                self.copied += copied
+                self.linked += linked
+                self.skipped += skipped
+                if progressbar != None:
+                    for error in errors:
+                        progressbar.add_warning(Notice("Error", error))
+                    progressbar.update(index+1)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = max(time.time() - start, 0.001)
+        return Notice("Log", "Staged {0} files: {1} copied ({2:.1f} MB at {3:.1f} MB/s), {4} linked, {5} already current, using {6} threads.".format(
+                      self.copied + self.linked + self.skipped, self.copied, self.copied_bytes / 1048576.0,
+                      self.copied_bytes / 1048576.0 / elapsed, self.linked, self.skipped, self.width))
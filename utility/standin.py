@@ -0,0 +1,217 @@
+#============================================================================
+#             Importing Things
+#============================================================================
+
+import sys
+import types
+from xml.sax.saxutils import escape, quoteattr
+
+#============================================================================
+#             Pegasus.DAX3 Stand-in
+#============================================================================
+
+#A minimal stand-in for Pegasus.DAX3, covering the parts of the API that the DIPA
+#components use (ADAG, Job, Link, Profile, Namespace). It mirrors the attribute names
+#of the real module (ADAG.jobs, ADAG.dependencies, Job.used, Job.arguments, Job.profiles)
+#so that anything written against it also works against a real Pegasus install.
+#Call install() before importing the components to plan workflows without Pegasus.
+
+__all__ = ["ADAG", "Job", "File", "Link", "Profile", "Namespace", "Element", "Dependency", "DuplicateError", "FormatError"]
+
+SCHEMA_NAMESPACE = "http://pegasus.isi.edu/schema/DAX"
+SCHEMA_LOCATION = "http://pegasus.isi.edu/schema/dax-3.6.xsd"
+SCHEMA_VERSION = "3.6"
+
+class DuplicateError(Exception): pass
+class FormatError(Exception): pass
+
+class Link(object):
+    INPUT = "input"
+    OUTPUT = "output"
+    INOUT = "inout"
+
+class Namespace(object):
+    PEGASUS = "pegasus"
+    CONDOR = "condor"
+    DAGMAN = "dagman"
+    ENV = "env"
+    HINTS = "hints"
+    GLOBUS = "globus"
+    SELECTOR = "selector"
+    STAT = "stat"
+
+class Element(object):
+    "An XML element, written the same way Pegasus.DAX3 writes its elements."
+    def __init__(self, name, attrs=[]):
+        self.name = name
+        self.attrs = []
+        for attr, value in attrs:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = str(value).lower()
+            self.attrs.append((attr, str(value)))
+        self.children = []
+        self.content = None
+
+    def element(self, element):
+        self.children.append(element)
+        return element
+
+    def text(self, value):
+        self.content = str(value)
+        return self
+
+    def write(self, stream=sys.stdout, level=0):
+        attrs = "".join([" {0}={1}".format(attr, quoteattr(value)) for attr, value in self.attrs])
+        if self.content is not None:
+            stream.write("<{0}{1}>{2}</{0}>".format(self.name, attrs, escape(self.content)))
+        elif len(self.children) == 0:
+            stream.write("<{0}{1}/>".format(self.name, attrs))
+        else:
+            stream.write("<{0}{1}>".format(self.name, attrs))
+            for child in self.children:
+                stream.write("\n" + "\t"*(level+1))
+                child.write(stream, level+1)
+            stream.write("\n" + "\t"*level + "</{0}>".format(self.name))
+
+class File(object):
+    def __init__(self, name):
+        self.name = name
+
+class Profile(object):
+    def __init__(self, namespace, key, value):
+        self.namespace = namespace
+        self.key = key
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Profile) and (self.namespace, self.key) == (other.namespace, other.key)
+
+    def __hash__(self):
+        return hash((self.namespace, self.key))
+
+    def toXML(self):
+        return Element("profile", [("namespace", self.namespace), ("key", self.key)]).text(self.value)
+
+class Use(object):
+    def __init__(self, name, link=None, register=None, transfer=None, optional=None, size=None):
+        self.name = name
+        self.link = link
+        self.register = register
+        self.transfer = transfer
+        self.optional = optional
+        self.size = size
+
+    def __eq__(self, other):
+        return isinstance(other, Use) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def toXML(self):
+        return Element("uses", [("name", self.name), ("link", self.link), ("register", self.register),
+                                ("transfer", self.transfer), ("optional", self.optional), ("size", self.size)])
+
+class Job(object):
+    def __init__(self, name, id=None, namespace=None, version=None, node_label=None):
+        self.name = name
+        self.id = id
+        self.namespace = namespace
+        self.version = version
+        self.node_label = node_label
+        self.arguments = []
+        self.profiles = set()
+        self.used = set()
+
+    def addArguments(self, *arguments):
+        self.arguments.extend(arguments)
+
+    def addProfile(self, profile):
+        if profile in self.profiles:
+            raise DuplicateError("Duplicate profile {0}::{1} on job {2}".format(profile.namespace, profile.key, self.id))
+        self.profiles.add(profile)
+
+    def uses(self, arg, link=None, register=None, transfer=None, optional=None, size=None, **kwargs):
+        name = arg.name if isinstance(arg, File) else arg
+        use = Use(name, link=link, register=register, transfer=transfer, optional=optional, size=size)
+        if use in self.used:
+            raise DuplicateError("Duplicate uses of {0} on job {1}".format(name, self.id))
+        self.used.add(use)
+
+    def toXML(self):
+        e = Element("job", [("id", self.id), ("namespace", self.namespace), ("name", self.name),
+                            ("version", self.version), ("node-label", self.node_label)])
+        if len(self.arguments) > 0:
+            e.element(Element("argument").text(" ".join([str(argument) for argument in self.arguments])))
+        for profile in sorted(self.profiles, key=lambda p: (p.namespace, p.key)):
+            e.element(profile.toXML())
+        for use in sorted(self.used, key=lambda u: u.name):
+            e.element(use.toXML())
+        return e
+
+class Dependency(object):
+    def __init__(self, parent, child, edge_label=None):
+        self.parent = parent.id if hasattr(parent, "id") else parent
+        self.child = child.id if hasattr(child, "id") else child
+        self.edge_label = edge_label
+        if not self.parent or not self.child:
+            raise FormatError("Dependencies require both a parent and a child id")
+
+    def __eq__(self, other):
+        return isinstance(other, Dependency) and (self.parent, self.child) == (other.parent, other.child)
+
+    def __hash__(self):
+        return hash((self.parent, self.child))
+
+class ADAG(object):
+    def __init__(self, name, count=None, index=None):
+        self.name = name
+        self.count = count
+        self.index = index
+        self.jobs = {}
+        self.dependencies = set()
+
+    def addJob(self, job):
+        if job.id in self.jobs:
+            raise DuplicateError("Duplicate job {0}".format(job.id))
+        self.jobs[job.id] = job
+
+    def hasJob(self, job):
+        return getattr(job, "id", job) in self.jobs
+
+    def depends(self, child, parent, edge_label=None):
+        dependency = Dependency(parent, child, edge_label)
+        if dependency in self.dependencies:
+            raise DuplicateError("Duplicate dependency {0} -> {1}".format(dependency.parent, dependency.child))
+        self.dependencies.add(dependency)
+
+    def writeXML(self, out):
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<!-- generator: python (DIPA stand-in) -->\n')
+        out.write('<adag xmlns="{0}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="{0} {1}" version="{2}" name={3}>\n'.format(SCHEMA_NAMESPACE, SCHEMA_LOCATION, SCHEMA_VERSION, quoteattr(self.name)))
+        for job_id in sorted(self.jobs):
+            out.write("\t")
+            self.jobs[job_id].toXML().write(out, level=1)
+            out.write("\n")
+        children = {}
+        for dependency in self.dependencies:
+            children.setdefault(dependency.child, []).append(dependency.parent)
+        for child in sorted(children):
+            e = Element("child", [("ref", child)])
+            for parent in sorted(children[child]):
+                e.element(Element("parent", [("ref", parent)]))
+            out.write("\t")
+            e.write(out, level=1)
+            out.write("\n")
+        out.write("</adag>\n")
+
+def install():
+    """
+    Registers this module as Pegasus.DAX3. Must be called before the components are imported.
+    """
+    module = sys.modules[__name__]
+    package = types.ModuleType("Pegasus")
+    package.DAX3 = module
+    sys.modules["Pegasus"] = package
+    sys.modules["Pegasus.DAX3"] = module